@@ -0,0 +1,1464 @@
+import os
+import copy
+import time
+import tempfile
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from model.music_transformer import MusicTransformer
+from model.rpr import MultiheadAttentionRPR, SelfAttentionRPR, multi_head_attention_cached_rpr
+from model.linear_attention import LinearAttention
+from model.cache import AttentionCache, LinearAttentionCache
+from model.sampling import PianoRollSampler
+from model.beam_search import beam_search
+from model.quantization import quantize_dynamic_int8
+from model.export import export_model
+from model.speculative import speculative_generate
+from model.sparse_attention import AttentionPattern
+from dataset.lpd_mmap import LpdMmapDataset, convert_lpd_npz, unpack_collate
+from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.dataloader import default_collate
+
+from model.loss import chunked_head_loss, SmoothCrossEntropyLoss, SmoothBCEWithLogitsLoss
+
+from utilities.constants import *
+from utilities.device import get_device, cpu_device, use_cuda
+from utilities.argument_funcs import parse_benchmark_args, print_benchmark_args
+from utilities.piano_roll import MidiStreamWriter, frames_to_midi, pack_frames, unpack_frames, to_frames, frames_to_active, active_to_frames
+from utilities.precision import autocast, keep_norms_fp32, MasterWeights
+
+# build_model
+def build_model(args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Builds the model described by the benchmark arguments, loading weights if given
+    ----------
+    """
+
+    model = MusicTransformer(n_layers=args.n_layers, num_heads=args.num_heads,
+                d_model=args.d_model, dim_feedforward=args.dim_feedforward,
+                max_sequence=args.max_sequence, rpr=args.rpr).to(get_device())
+
+    if(args.model_weights is not None):
+        model.load_state_dict(torch.load(args.model_weights, map_location=get_device()))
+
+    model.eval()
+    return model
+
+# random_frames
+def random_frames(batch_size, seq_len, density=0.05):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Random binary piano-roll frames (batch_size, seq_len, 84, 5) with the given note density
+    ----------
+    """
+
+    frames = torch.rand((batch_size, seq_len, 84, 5), device=get_device()) < density
+    return frames.type(TORCH_FLOAT)
+
+# timed
+def timed(func, n_trials):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Returns the average wall time in seconds of func over n_trials calls
+    ----------
+    """
+
+    total = 0.0
+    for _ in range(n_trials):
+        if(torch.cuda.is_available()):
+            torch.cuda.synchronize()
+        time_before = time.time()
+        func()
+        if(torch.cuda.is_available()):
+            torch.cuda.synchronize()
+        total += time.time() - time_before
+
+    return total / n_trials
+
+# check_kv_cache
+def check_kv_cache(model, seq_len, n_primer):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Numerical equivalence check between forward() on the full sequence and cached decoding
+    (primer prefill, then one frame at a time with forward_step). Returns the max absolute
+    difference between the two sets of logits.
+    ----------
+    """
+
+    x = random_frames(1, seq_len)
+
+    with torch.set_grad_enabled(False):
+        y_full = model(x)
+
+        cache = model.init_cache(1, seq_len)
+        y_steps = [model.forward_step(x[:, :n_primer], cache)]
+        for i in range(n_primer, seq_len):
+            y_steps.append(model.forward_step(x[:, i:i+1], cache))
+
+        y_cached = torch.cat(y_steps, dim=1)
+
+    return float((y_full - y_cached).abs().max())
+
+# benchmark_kv_cache
+def benchmark_kv_cache(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Checks cached decoding against the full forward pass, then times generation with and without
+    the cache
+    ----------
+    """
+
+    max_diff = check_kv_cache(model, args.seq_len, args.n_primer)
+    print("Max abs logit difference (full vs cached):", max_diff)
+    print("")
+
+    primer = random_frames(1, args.n_primer)[0]
+    with torch.set_grad_enabled(False):
+        uncached = timed(lambda: model.generate(primer, args.seq_len, use_cache=False), args.n_trials)
+        cached = timed(lambda: model.generate(primer, args.seq_len, use_cache=True), args.n_trials)
+
+    n_new = args.seq_len - args.n_primer
+    print(SEPERATOR)
+    print("Uncached generation (s):", uncached, "(", uncached / n_new * 1000, "ms / frame )")
+    print("Cached generation (s):", cached, "(", cached / n_new * 1000, "ms / frame )")
+    print("Speedup:", uncached / cached)
+    print(SEPERATOR)
+
+# benchmark_batch_generate
+def benchmark_batch_generate(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Times generating batch_size sequences one at a time versus as a single generate_batch call.
+    Primers get different lengths to exercise the padding path.
+    ----------
+    """
+
+    primers = [random_frames(1, args.n_primer + (i % 4))[0] for i in range(args.batch_size)]
+
+    with torch.set_grad_enabled(False):
+        sequential = timed(lambda: [model.generate_batch([p], args.seq_len) for p in primers], args.n_trials)
+        batched = timed(lambda: model.generate_batch(primers, args.seq_len), args.n_trials)
+
+    print(SEPERATOR)
+    print("Sequential generation of", args.batch_size, "sequences (s):", sequential)
+    print("Batched generation of", args.batch_size, "sequences (s):", batched)
+    print("Speedup:", sequential / batched)
+    print(SEPERATOR)
+
+# benchmark_sampler
+def benchmark_sampler(args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Times drawing a batch of frames with PianoRollSampler with and without the optional limits
+    ----------
+    """
+
+    logits = torch.randn((args.batch_size, 84, 5), device=get_device()) - 3.0
+
+    samplers = [
+        ("plain", PianoRollSampler()),
+        ("temperature+thresholds", PianoRollSampler(temperature=0.9, thresholds=[0.3, 0.2, 0.2, 0.2, 0.2])),
+        ("top_k+polyphony", PianoRollSampler(top_k=16, max_polyphony=[4, 6, 4, 2, 6])),
+    ]
+
+    print(SEPERATOR)
+    n_steps = 1000
+    for name, sampler in samplers:
+        took = timed(lambda: [sampler(logits) for _ in range(n_steps)], args.n_trials)
+        frames = sampler(logits)
+        print(name, ": ", took / n_steps * 1e6, " us / step, mean notes per frame: ",
+              float(frames.flatten(1).sum(dim=-1).mean()), sep="")
+    print(SEPERATOR)
+
+# benchmark_beam_search
+def benchmark_beam_search(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Times beam search over batch_size primers run one primer at a time versus as one batch
+    ----------
+    """
+
+    primers = [random_frames(1, args.n_primer + (i % 4))[0] for i in range(args.batch_size)]
+
+    sequential = timed(lambda: [beam_search(model, [p], args.seq_len, args.beam) for p in primers], args.n_trials)
+    batched = timed(lambda: beam_search(model, primers, args.seq_len, args.beam), args.n_trials)
+
+    n_new = args.seq_len - args.n_primer
+    print(SEPERATOR)
+    print("Beam", args.beam, "over", args.batch_size, "primers")
+    print("Sequential (s):", sequential, "(", sequential / n_new * 1000, "ms / frame )")
+    print("Batched (s):", batched, "(", batched / n_new * 1000, "ms / frame )")
+    print("Speedup:", sequential / batched)
+    print(SEPERATOR)
+
+# benchmark_long_form
+def benchmark_long_form(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Streams seq_len frames from generate_long with the given window and reports the per-frame time
+    over the run, which should stay flat once the window is full
+    ----------
+    """
+
+    window = args.window if args.window is not None else args.max_sequence
+    primer = random_frames(1, args.n_primer)[0]
+    bucket = max(1, args.seq_len // 10)
+
+    print(SEPERATOR)
+    print("Window:", window)
+    time_before = time.time()
+    for i, _ in enumerate(model.generate_long(primer, args.seq_len, window=window)):
+        if((i+1) % bucket == 0):
+            time_after = time.time()
+            print("Frames", i+2-bucket, "-", i+1, ":", (time_after - time_before) / bucket * 1000, "ms / frame")
+            time_before = time_after
+    print(SEPERATOR)
+
+# benchmark_stream
+def benchmark_stream(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Compares the time until the first frames are playable as midi when streaming (generate_stream
+    into a MidiStreamWriter) with waiting for generate and converting the whole piece afterwards
+    ----------
+    """
+
+    primer = random_frames(1, args.n_primer)[0]
+    chunk_size = args.stream_chunk
+
+    for _ in range(args.n_trials):
+        time_before = time.time()
+        full = model.generate(primer, args.seq_len)[0]
+        frames_to_midi(full)
+        full_time = time.time() - time_before
+
+        time_before = time.time()
+        writer = MidiStreamWriter()
+        writer.write(primer)
+        first_time = None
+        for chunk in model.generate_stream(primer, args.seq_len, chunk_size=chunk_size):
+            writer.write(chunk)
+            if(first_time is None):
+                first_time = time.time() - time_before
+        writer.close()
+        stream_time = time.time() - time_before
+
+        print(SEPERATOR)
+        print("generate then midi, first audio after (s):", full_time)
+        print("generate_stream chunk", chunk_size, "first audio after (s):", first_time, "total (s):", stream_time)
+    print(SEPERATOR)
+
+# frame_f1
+def frame_f1(pred, tgt):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    F1 score of the sounding notes in binary frames pred against tgt
+    ----------
+    """
+
+    return f1_from_counts(f1_counts(pred, tgt))
+
+# f1_counts
+def f1_counts(pred, tgt):
+    # True positive, false positive and false negative notes of pred against tgt, summable over batches
+    pred = pred.bool()
+    tgt = tgt.bool()
+
+    return np.array([float((pred & tgt).sum()), float((pred & ~tgt).sum()), float((~pred & tgt).sum())])
+
+# f1_from_counts
+def f1_from_counts(counts):
+    tp, fp, fn = counts
+    if(tp == 0.0):
+        return 0.0
+    return 2 * tp / (2 * tp + fp + fn)
+
+# benchmark_quantize
+def benchmark_quantize(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Accuracy and throughput of the int8 dynamically quantized model against fp32 on the cpu.
+
+    Both models predict the next frame of every seq_len window of the test split of -input_dir (a
+    folder written by preprocess_lpd.py), or without it of batch_size random sequences, which only
+    make the int8 vs fp32 agreement meaningful. Reports BCE loss and frame F1 (notes with
+    logit > 0) against the targets, F1 of the int8 predictions against the fp32 ones, and the
+    cached generation speed of each.
+    ----------
+    """
+
+    assert get_device() == cpu_device(), "Quantized inference runs on the cpu only, use --force_cpu"
+
+    q_model = quantize_dynamic_int8(model)
+
+    if(args.input_dir is not None):
+        test_dataset = LpdMmapDataset(args.input_dir, "test", args.seq_len, across_pieces=False)
+        batches = ((to_frames(x, get_device()), to_frames(tgt, get_device())) for x, tgt in DataLoader(test_dataset, batch_size=args.batch_size))
+        source = str(len(test_dataset)) + " test windows of " + args.input_dir
+    else:
+        x = random_frames(args.batch_size, args.seq_len + 1)
+        batches = [(x[:, :-1], x[:, 1:])]
+        source = str(args.batch_size) + " random sequences"
+
+    losses = {"fp32": 0.0, "int8": 0.0}
+    counts = {"fp32": 0.0, "int8": 0.0, "int8 vs fp32": 0.0}
+    max_diff = 0.0
+    n_cells = 0
+
+    with torch.set_grad_enabled(False):
+        for inputs, tgt in batches:
+            y_fp32 = model(inputs)
+            y_int8 = q_model(inputs)
+
+            for name, y in (("fp32", y_fp32), ("int8", y_int8)):
+                losses[name] += float(F.binary_cross_entropy_with_logits(y, tgt, reduction="sum"))
+                counts[name] = counts[name] + f1_counts(y > 0, tgt)
+            counts["int8 vs fp32"] = counts["int8 vs fp32"] + f1_counts(y_int8 > 0, y_fp32 > 0)
+
+            max_diff = max(max_diff, float((y_int8 - y_fp32).abs().max()))
+            n_cells += tgt.numel()
+
+    assert n_cells > 0, "No test windows of " + str(args.seq_len + 1) + " frames in " + str(args.input_dir)
+
+    print(SEPERATOR)
+    print("Accuracy on", source, "(", args.seq_len, "frames )")
+    for name in ("fp32", "int8"):
+        print(name, "BCE loss:", losses[name] / n_cells, "frame F1:", f1_from_counts(counts[name]))
+    print("int8 vs fp32 frame F1:", f1_from_counts(counts["int8 vs fp32"]))
+    print("Max abs logit difference:", max_diff)
+    print("")
+
+    primer = random_frames(1, args.n_primer)[0]
+    n_new = args.seq_len - args.n_primer
+
+    fp32_time = timed(lambda: model.generate(primer, args.seq_len), args.n_trials)
+    int8_time = timed(lambda: q_model.generate(primer, args.seq_len), args.n_trials)
+
+    print("fp32 generation (s):", fp32_time, "(", n_new / fp32_time, "frames / s )")
+    print("int8 generation (s):", int8_time, "(", n_new / int8_time, "frames / s )")
+    print("Speedup:", fp32_time / int8_time)
+    print(SEPERATOR)
+
+# benchmark_export
+def benchmark_export(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Per-frame latency of cached decoding in eager mode (forward_step) versus the TorchScript
+    export at the benchmark batch size
+    ----------
+    """
+
+    scripted = export_model(model)
+    x = random_frames(args.batch_size, args.seq_len)
+
+    def run_eager():
+        cache = model.init_cache(args.batch_size, args.seq_len)
+        model.forward_step(x[:, :args.n_primer], cache)
+        for i in range(args.n_primer, args.seq_len):
+            model.forward_step(x[:, i:i+1], cache)
+
+    def run_scripted():
+        keys, values = scripted.init_state(args.batch_size, args.seq_len)
+        scripted(x[:, :args.n_primer], keys, values, 0)
+        for i in range(args.n_primer, args.seq_len):
+            scripted(x[:, i:i+1], keys, values, i)
+
+    with torch.set_grad_enabled(False):
+        # The first scripted calls run the profiling / optimization passes
+        run_scripted()
+        eager = timed(run_eager, args.n_trials)
+        script = timed(run_scripted, args.n_trials)
+
+    n_new = args.seq_len - args.n_primer
+    print(SEPERATOR)
+    print("Batch size:", args.batch_size)
+    print("Eager forward_step (s):", eager, "(", eager / n_new * 1000, "ms / frame )")
+    print("TorchScript (s):", script, "(", script / n_new * 1000, "ms / frame )")
+    print("Speedup:", eager / script)
+    print(SEPERATOR)
+
+# benchmark_speculative
+def benchmark_speculative(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Acceptance rate and speedup of speculative decoding with a draft model over plain cached
+    generation. With random weights the two models disagree and almost nothing is accepted, so
+    pass trained -model_weights and -draft_weights (or --self_draft) for meaningful numbers.
+    ----------
+    """
+
+    if(args.self_draft):
+        draft_model = model
+    else:
+        draft_model = MusicTransformer(n_layers=args.draft_n_layers, num_heads=args.draft_num_heads,
+                    d_model=args.draft_d_model, dim_feedforward=args.draft_dim_feedforward,
+                    max_sequence=args.max_sequence, rpr=args.draft_rpr).to(get_device())
+
+        if(args.draft_weights is not None):
+            draft_model.load_state_dict(torch.load(args.draft_weights, map_location=get_device()))
+        draft_model.eval()
+
+    primer = random_frames(1, args.n_primer)[0]
+    stats = []
+
+    plain = timed(lambda: model.generate(primer, args.seq_len), args.n_trials)
+    speculative = timed(lambda: stats.append(speculative_generate(model, draft_model, primer, args.seq_len,
+                                                                  n_draft=args.n_draft)[1]), args.n_trials)
+
+    proposed = sum(s["proposed"] for s in stats)
+    accepted = sum(s["accepted"] for s in stats)
+    rounds = sum(s["rounds"] for s in stats)
+    n_new = args.seq_len - args.n_primer
+
+    print(SEPERATOR)
+    print("Draft frames per step:", args.n_draft)
+    print("Acceptance rate:", accepted / proposed)
+    print("Frames per model pass:", n_new * args.n_trials / rounds)
+    print("Plain generation (s):", plain, "(", plain / n_new * 1000, "ms / frame )")
+    print("Speculative generation (s):", speculative, "(", speculative / n_new * 1000, "ms / frame )")
+    print("Speedup:", plain / speculative)
+    print(SEPERATOR)
+
+# set_attn_block_size
+def set_attn_block_size(model, block_size):
+    # Switches every RPR layer between full (None) and blockwise attention
+    for layer in model.transformer.encoder.layers:
+        layer.self_attn.block_size = block_size
+
+# train_step_stats
+def train_step_stats(model, x, tgt, n_trials):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Average time of a training step (forward, BCE loss, backward) and its peak memory in MB (None
+    on the cpu)
+    ----------
+    """
+
+    def step():
+        model.zero_grad()
+        loss = F.binary_cross_entropy_with_logits(model(x), tgt)
+        loss.backward()
+
+    step()
+    if(torch.cuda.is_available()):
+        torch.cuda.reset_peak_memory_stats()
+
+    took = timed(step, n_trials)
+
+    peak = None
+    if(torch.cuda.is_available()):
+        peak = torch.cuda.max_memory_allocated() / 2**20
+
+    return took, peak
+
+# benchmark_rpr_attention
+def benchmark_rpr_attention(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Compares full RPR attention (skewed (L, L) relative logits) with blockwise_attention_rpr at
+    attn_block_size: max logit difference in eval, then training step time and peak memory
+    ----------
+    """
+
+    assert args.rpr, "rpr_attention needs --rpr"
+
+    x = random_frames(args.batch_size, args.seq_len + 1)
+    inputs, tgt = x[:, :-1], x[:, 1:]
+
+    with torch.set_grad_enabled(False):
+        set_attn_block_size(model, None)
+        y_full = model(inputs)
+        set_attn_block_size(model, args.attn_block_size)
+        y_block = model(inputs)
+
+    print(SEPERATOR)
+    print("Max abs logit difference (full vs blockwise):", float((y_full - y_block).abs().max()))
+    print("")
+
+    model.train()
+    for name, block_size in (("Full", None), ("Blockwise " + str(args.attn_block_size), args.attn_block_size)):
+        set_attn_block_size(model, block_size)
+        took, peak = train_step_stats(model, inputs, tgt, args.n_trials)
+        print(name, "train step (s):", took, " peak memory (MB):", peak if peak is not None else "n/a on cpu")
+    model.eval()
+    print(SEPERATOR)
+
+# benchmark_self_attention
+def benchmark_self_attention(args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Training step time of one layer's attention as MultiheadAttentionRPR versus SelfAttentionRPR.
+    The lean module is loaded from the old module's state_dict, which also checks that old
+    checkpoints load, and outputs are compared.
+    ----------
+    """
+
+    device = get_device()
+    old_attn = MultiheadAttentionRPR(args.d_model, args.num_heads, dropout=0.0, er_len=args.max_sequence).to(device)
+    new_attn = SelfAttentionRPR(args.d_model, args.num_heads, dropout=0.0, er_len=args.max_sequence).to(device)
+    new_attn.load_state_dict(old_attn.state_dict())
+
+    x = torch.randn((args.seq_len, args.batch_size, args.d_model), device=device, requires_grad=True)
+    mask = torch.triu(torch.full((args.seq_len, args.seq_len), float("-inf"), device=device), diagonal=1)
+
+    with torch.set_grad_enabled(False):
+        max_diff = float((old_attn(x, x, x, attn_mask=mask)[0] - new_attn(x, attn_mask=mask)[0]).abs().max())
+
+    def step(attn):
+        attn.zero_grad()
+        attn(x, x, x, attn_mask=mask)[0].sum().backward()
+
+    old_time = timed(lambda: step(old_attn), args.n_trials)
+    new_time = timed(lambda: step(new_attn), args.n_trials)
+
+    print(SEPERATOR)
+    print("Max abs output difference:", max_diff)
+    print("MultiheadAttentionRPR train step (s):", old_time)
+    print("SelfAttentionRPR train step (s):", new_time)
+    print("Speedup:", old_time / new_time)
+    print(SEPERATOR)
+
+# benchmark_masks
+def benchmark_masks(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Reports the mask and relative index allocations the MaskRegistry saves per forward and per
+    cached generation step, and forward time with and without the registry in the layers
+    ----------
+    """
+
+    x = random_frames(args.batch_size, args.seq_len)
+    primer = random_frames(1, args.n_primer)[0]
+    layers = model.transformer.encoder.layers
+
+    def set_layer_masks(masks):
+        for layer in layers:
+            if(hasattr(layer.self_attn, "masks")):
+                layer.self_attn.masks = masks
+
+    with torch.set_grad_enabled(False):
+        model(x)
+        model.masks.reset_stats()
+        model(x)
+        forward_stats = dict(model.masks.stats)
+
+        model.masks.reset_stats()
+        model.generate(primer, args.seq_len)
+        step_bytes = model.masks.stats["bytes_saved"] / (args.seq_len - args.n_primer)
+
+        with_registry = timed(lambda: model(x), args.n_trials)
+        set_layer_masks(None)
+        without_registry = timed(lambda: model(x), args.n_trials)
+        set_layer_masks(model.masks)
+
+    print(SEPERATOR)
+    print("Views served per forward:", forward_stats["views"])
+    print("Allocation saved per forward (MB):", forward_stats["bytes_saved"] / 2**20)
+    print("Allocation saved per generation step (KB):", step_bytes / 2**10)
+    print("Forward with registry (s):", with_registry)
+    print("Forward without registry in the layers (s):", without_registry)
+    print(SEPERATOR)
+
+# saved_activation_mb
+def saved_activation_mb(model, x, tgt):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    MB of tensors autograd saves for backward during one training forward (see saved_mb)
+    ----------
+    """
+
+    model.zero_grad()
+    return saved_mb(lambda: F.binary_cross_entropy_with_logits(model(x), tgt))
+
+# saved_mb
+def saved_mb(loss_func):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Runs loss_func and backward on its result. Returns the MB of tensors autograd saved for
+    backward during the forward. Counted with saved tensor hooks, so it works on the cpu too.
+    Tensors saved by several ops count each time.
+    ----------
+    """
+
+    total = [0]
+
+    def pack(tensor):
+        total[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    def unpack(tensor):
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, unpack):
+        loss = loss_func()
+    loss.backward()
+
+    return total[0] / 2**20
+
+# benchmark_checkpoint
+def benchmark_checkpoint(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Memory / compute trade-off of the activation checkpointing modes of TransformerEncoderRPR:
+    activations saved for backward, peak memory (gpu only) and training step time. Also checks
+    that gradients (with dropout) match the uncheckpointed model under the same seed.
+    ----------
+    """
+
+    assert args.rpr, "checkpoint needs --rpr"
+
+    x = random_frames(args.batch_size, args.seq_len + 1)
+    inputs, tgt = x[:, :-1], x[:, 1:]
+    encoder = model.transformer.encoder
+
+    def gradients():
+        torch.manual_seed(args.seed)
+        model.zero_grad()
+        F.binary_cross_entropy_with_logits(model(inputs), tgt).backward()
+        return [p.grad.clone() for p in model.parameters() if p.grad is not None]
+
+    settings = [
+        ("None", None, 1),
+        ("Every layer", "layers", 1),
+        ("Every " + str(args.checkpoint_every) + " layers", "layers", args.checkpoint_every),
+        ("Attention only", "attention", 1),
+    ]
+
+    model.train()
+    reference = gradients()
+
+    print(SEPERATOR)
+    for name, mode, every in settings:
+        encoder.set_checkpoint(mode, every)
+
+        grad_diff = max(float((g - r).abs().max()) for g, r in zip(gradients(), reference))
+        saved = saved_activation_mb(model, inputs, tgt)
+        took, peak = train_step_stats(model, inputs, tgt, args.n_trials)
+
+        print(name + ":")
+        print("    saved for backward (MB):", saved)
+        print("    peak memory (MB):", peak if peak is not None else "n/a on cpu")
+        print("    train step (s):", took)
+        print("    max abs grad difference:", grad_diff)
+
+    encoder.set_checkpoint(None)
+    model.eval()
+    print(SEPERATOR)
+
+# benchmark_sparse_attention
+def benchmark_sparse_attention(args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Scaling of one SelfAttentionRPR layer with full causal attention versus the local, dilated and
+    global block-sparse patterns over -seq_lens: training step time and memory (peak on gpu,
+    saved for backward on cpu). Attention is asked to be causal with is_causal, so the sparse
+    patterns run without any (L, L) mask, only full attention builds one. At the first length the
+    sparse outputs are also checked against full attention under the pattern's dense mask.
+    ----------
+    """
+
+    device = get_device()
+    seq_lens = [int(l) for l in args.seq_lens.split(",")]
+
+    attn = SelfAttentionRPR(args.d_model, args.num_heads, dropout=0.0, er_len=max(seq_lens)).to(device)
+    patterns = [AttentionPattern(kind, args.pattern_block, args.pattern_window, args.pattern_dilation) for kind in ATTENTION_PATTERNS]
+    settings = [("full", None)] + [(p.kind, p) for p in patterns]
+
+    # Equivalence with dense masking
+    seq_len = seq_lens[0]
+    x = torch.randn((seq_len, args.batch_size, args.d_model), device=device)
+    positions = torch.arange(seq_len, device=device)
+
+    print(SEPERATOR)
+    with torch.set_grad_enabled(False):
+        for pattern in patterns:
+            allowed = pattern.allowed(positions.unsqueeze(1), positions.unsqueeze(0), args.num_heads)
+            dense_mask = torch.zeros(allowed.shape, device=device).masked_fill_(~allowed, float("-inf"))
+
+            attn.pattern = None
+            y_dense = attn(x, attn_mask=dense_mask)[0]
+            attn.pattern = pattern
+            y_sparse = attn(x, is_causal=True)[0]
+
+            print(pattern.kind, "max abs difference to dense masking:", float((y_dense - y_sparse).abs().max()))
+    print("")
+
+    for seq_len in seq_lens:
+        x = torch.randn((seq_len, args.batch_size, args.d_model), device=device, requires_grad=True)
+
+        def loss():
+            attn.zero_grad()
+            return attn(x, is_causal=True)[0].sum()
+
+        for name, pattern in settings:
+            attn.pattern = pattern
+            try:
+                if(torch.cuda.is_available()):
+                    torch.cuda.reset_peak_memory_stats()
+                saved = saved_mb(loss)
+                took = timed(lambda: loss().backward(), args.n_trials)
+            except RuntimeError as e:
+                print("L =", seq_len, name + ": failed (" + str(e).split("\n")[0] + ")")
+                continue
+
+            memory = "saved for backward (MB): " + str(saved)
+            if(torch.cuda.is_available()):
+                memory = "peak memory (MB): " + str(torch.cuda.max_memory_allocated() / 2**20)
+
+            print("L =", seq_len, name + ":", "train step (s):", took, "", memory)
+
+        print("")
+
+    attn.pattern = None
+    print(SEPERATOR)
+
+# benchmark_linear_attention
+def benchmark_linear_attention(args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Scaling of one quadratic SelfAttentionRPR layer versus LinearAttention (elu and favor feature
+    maps) over -seq_lens: training step time and memory (peak on gpu, saved for backward on cpu),
+    then the time of one cached decoding step after L frames and the size of the decoding state
+    (key / value cache versus linear attention state).
+    ----------
+    """
+
+    device = get_device()
+    seq_lens = [int(l) for l in args.seq_lens.split(",")]
+    head_dim = args.d_model // args.num_heads
+
+    settings = [("rpr", SelfAttentionRPR(args.d_model, args.num_heads, dropout=0.0, er_len=max(seq_lens)))]
+    for feature_map in FEATURE_MAPS:
+        settings.append(("linear " + feature_map, LinearAttention(args.d_model, args.num_heads, feature_map=feature_map)))
+
+    print(SEPERATOR)
+    for seq_len in seq_lens:
+        x = torch.randn((seq_len, args.batch_size, args.d_model), device=device, requires_grad=True)
+        mask = torch.triu(torch.full((seq_len, seq_len), float("-inf"), device=device), diagonal=1)
+        frame = torch.randn((1, args.batch_size, args.d_model), device=device)
+
+        for name, attn in settings:
+            attn.to(device).train()
+
+            def loss():
+                attn.zero_grad()
+                return attn(x, attn_mask=mask)[0].sum()
+
+            try:
+                if(torch.cuda.is_available()):
+                    torch.cuda.reset_peak_memory_stats()
+                saved = saved_mb(loss)
+                took = timed(lambda: loss().backward(), args.n_trials)
+            except RuntimeError as e:
+                print("L =", seq_len, name + ": failed (" + str(e).split("\n")[0] + ")")
+                continue
+
+            memory = "saved for backward (MB): " + str(saved)
+            if(torch.cuda.is_available()):
+                memory = "peak memory (MB): " + str(torch.cuda.max_memory_allocated() / 2**20)
+
+            # One decoding step after seq_len frames
+            attn.eval()
+            with torch.set_grad_enabled(False):
+                if(isinstance(attn, LinearAttention)):
+                    cache = LinearAttentionCache(1, args.batch_size, args.num_heads, attn.n_features, head_dim, device=device)
+                    attn.step(x.detach(), cache, 0)
+                    cache.advance(seq_len)
+                    step = lambda: attn.step(frame, cache, 0)
+                    state_mb = (cache.states.numel() + cache.norms.numel()) * cache.states.element_size() / 2**20
+                else:
+                    cache = AttentionCache(1, args.batch_size, args.num_heads, head_dim, seq_len + 1, device=device)
+                    multi_head_attention_cached_rpr(x.detach(), attn, cache, 0)
+                    cache.advance(seq_len)
+                    step = lambda: multi_head_attention_cached_rpr(frame, attn, cache, 0)
+                    state_mb = 2 * args.batch_size * args.num_heads * seq_len * head_dim * cache.keys.element_size() / 2**20
+
+                # Steps never advance the cache, so every trial sees seq_len frames of context
+                step_time = timed(step, args.n_trials)
+
+            print("L =", seq_len, name + ":", "train step (s):", took, "", memory)
+            print("    decode step (s):", step_time, " decoding state (MB):", state_mb)
+
+        print("")
+
+    print(SEPERATOR)
+
+# benchmark_segment_memory
+def benchmark_segment_memory(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Cost of segment recurrence: training step time and memory of a seq_len segment with 0, 1, 2
+    and 4 segments of memory, against plain training on a window as long as memory plus segment
+    ----------
+    """
+
+    assert args.rpr, "segment_memory needs --rpr"
+
+    seq_len = args.seq_len
+    model.train()
+
+    print(SEPERATOR)
+    for n_mem in (0, 1, 2, 4):
+        mem_len = n_mem * seq_len
+        x = random_frames(args.batch_size, seq_len * (n_mem + 1) + 1)
+        segment, tgt = x[:, -seq_len - 1:-1], x[:, -seq_len:]
+
+        # Memory from the earlier segments, built without gradients like in training
+        memory = None
+        with torch.set_grad_enabled(False):
+            for i in range(n_mem):
+                _, memory = model.forward_segment(x[:, i * seq_len:(i + 1) * seq_len], memory, mem_len=mem_len)
+
+        def segment_loss():
+            model.zero_grad()
+            y, _ = model.forward_segment(segment, memory, mem_len=max(mem_len, seq_len))
+            return F.binary_cross_entropy_with_logits(y, tgt)
+
+        saved = saved_mb(segment_loss)
+        took = timed(lambda: segment_loss().backward(), args.n_trials)
+        print("Memory", mem_len, "frames: train step (s):", took, " saved for backward (MB):", saved)
+
+        if(n_mem > 0):
+            window = x[:, :-1]
+            full_took, _ = train_step_stats(model, window, x[:, 1:], args.n_trials)
+            full_saved = saved_activation_mb(model, window, x[:, 1:])
+            print("    full window of", window.shape[1], "frames: train step (s):", full_took, " saved for backward (MB):", full_saved)
+
+    model.eval()
+    print(SEPERATOR)
+
+# benchmark_chunked_ffn
+def benchmark_chunked_ffn(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Memory / time trade-off of chunked feedforward (ff_chunk_size) and the fused chunked output
+    head and loss (chunked_head_loss) over -chunk_sizes, separately and together: training step
+    time, activations saved for backward, peak memory (gpu only) and the loss difference to the
+    unchunked model
+    ----------
+    """
+
+    assert args.rpr, "chunked_ffn needs --rpr"
+
+    x = random_frames(args.batch_size, args.seq_len + 1)
+    inputs, tgt = x[:, :-1], x[:, 1:]
+    layers = model.transformer.encoder.layers
+
+    def set_ff_chunk_size(chunk_size):
+        for layer in layers:
+            layer.ff_chunk_size = chunk_size
+
+    def make_loss(head_chunk_size):
+        def loss():
+            model.zero_grad()
+            if(head_chunk_size is None):
+                return F.binary_cross_entropy_with_logits(model(inputs), tgt)
+            return chunked_head_loss(model.forward_hidden(inputs), model.Wout, tgt, head_chunk_size)
+        return loss
+
+    settings = [("Unchunked", None, None)]
+    for chunk_size in [int(c) for c in args.chunk_sizes.split(",")]:
+        settings.append(("FFN chunk " + str(chunk_size), chunk_size, None))
+        settings.append(("Head chunk " + str(chunk_size), None, chunk_size))
+        settings.append(("Both chunk " + str(chunk_size), chunk_size, chunk_size))
+
+    # No dropout so losses are comparable
+    model.eval()
+    with torch.set_grad_enabled(False):
+        reference = float(make_loss(None)())
+
+    model.train()
+    print(SEPERATOR)
+    for name, ff_chunk_size, head_chunk_size in settings:
+        set_ff_chunk_size(ff_chunk_size)
+        loss = make_loss(head_chunk_size)
+
+        model.eval()
+        with torch.set_grad_enabled(False):
+            loss_diff = abs(float(loss()) - reference)
+        model.train()
+
+        if(torch.cuda.is_available()):
+            torch.cuda.reset_peak_memory_stats()
+        saved = saved_mb(loss)
+        took = timed(lambda: loss().backward(), args.n_trials)
+
+        peak = "n/a on cpu"
+        if(torch.cuda.is_available()):
+            peak = torch.cuda.max_memory_allocated() / 2**20
+
+        print(name + ":")
+        print("    saved for backward (MB):", saved, " peak memory (MB):", peak)
+        print("    train step (s):", took, " abs loss difference:", loss_diff)
+
+    set_ff_chunk_size(None)
+    model.eval()
+    print(SEPERATOR)
+
+# one_hot_smooth_ce
+def one_hot_smooth_ce(input, target, label_smoothing, ignore_index=-100):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Reference label smoothed cross entropy as SmoothCrossEntropyLoss computed it before being
+    fused: a full one-hot and smoothed target distribution of the logits' size
+    ----------
+    """
+
+    vocab_size = input.shape[-1]
+    mask = (target == ignore_index).unsqueeze(-1)
+    q = F.one_hot(target.long().masked_fill(mask.squeeze(-1), 0), vocab_size).type(input.dtype)
+    q_prime = (1.0 - label_smoothing) * q + label_smoothing / vocab_size
+    q_prime = q_prime.masked_fill(mask, 0)
+
+    ce = -torch.sum(q_prime * (input - input.logsumexp(dim=-1, keepdim=True)), dim=-1)
+    return ce.sum() / (~mask).sum()
+
+# naive_smooth_bce
+def naive_smooth_bce(input, target, label_smoothing, ignore_index=-100):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Reference label smoothed, pad masked binary cross entropy built from separate elementwise
+    steps
+    ----------
+    """
+
+    valid = target != ignore_index
+    smoothed = torch.where(valid, target, torch.zeros_like(target)) * (1.0 - label_smoothing) + 0.5 * label_smoothing
+    bce = F.binary_cross_entropy_with_logits(input, smoothed, reduction="none")
+    return (bce * valid.type(input.dtype)).sum() / valid.sum()
+
+# benchmark_loss
+def benchmark_loss(args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Fused label smoothed losses against their reference formulations: SmoothCrossEntropyLoss
+    versus the one-hot version over the event vocabulary, and SmoothBCEWithLogitsLoss versus a
+    naive smoothed, masked BCE over piano-roll logits (with the last quarter of each sequence
+    padded). Reports forward + backward time, activations saved for backward, peak memory (gpu
+    only) and the largest difference in loss and gradient.
+    ----------
+    """
+
+    smoothing = args.ce_smoothing
+    n_rows = args.batch_size * args.seq_len
+    vocab_size = TOKEN_PAD + 1
+
+    ce_input = torch.randn((n_rows, vocab_size), device=get_device())
+    ce_target = torch.randint(0, vocab_size, (n_rows,), device=get_device())
+    ce_target[-(n_rows // 4):] = TOKEN_PAD
+
+    bce_input = torch.randn((args.batch_size, args.seq_len, 84, 5), device=get_device())
+    bce_target = random_frames(args.batch_size, args.seq_len)
+    bce_target[:, -(args.seq_len // 4):] = -100
+
+    fused_ce = SmoothCrossEntropyLoss(smoothing, vocab_size, ignore_index=TOKEN_PAD)
+    fused_bce = SmoothBCEWithLogitsLoss(smoothing)
+
+    cases = [
+        ("Cross entropy", ce_input, [
+            ("one-hot", lambda x: one_hot_smooth_ce(x, ce_target, smoothing, TOKEN_PAD)),
+            ("fused", lambda x: fused_ce(x, ce_target)),
+        ]),
+        ("Piano-roll BCE", bce_input, [
+            ("naive", lambda x: naive_smooth_bce(x, bce_target, smoothing)),
+            ("fused", lambda x: fused_bce(x, bce_target)),
+        ]),
+    ]
+
+    print(SEPERATOR)
+    for case, logits, losses in cases:
+        print(case + ":")
+
+        reference = None
+        for name, loss_func in losses:
+            x = logits.clone().requires_grad_()
+
+            def step():
+                x.grad = None
+                return loss_func(x)
+
+            if(torch.cuda.is_available()):
+                torch.cuda.reset_peak_memory_stats()
+            saved = saved_mb(step)
+            value = float(step())
+            took = timed(lambda: step().backward(), args.n_trials)
+            grad = x.grad.clone()
+
+            peak = "n/a on cpu"
+            if(torch.cuda.is_available()):
+                peak = torch.cuda.max_memory_allocated() / 2**20
+
+            print("    " + name + ":")
+            print("        forward + backward (s):", took)
+            print("        saved for backward (MB):", saved, " peak memory (MB):", peak)
+
+            if(reference is None):
+                reference = (value, grad)
+            else:
+                print("        abs loss difference:", abs(value - reference[0]))
+                print("        max abs grad difference:", float((grad - reference[1]).abs().max()))
+
+    print(SEPERATOR)
+
+# benchmark_bf16
+def benchmark_bf16(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Regression check of bf16 training. Trains copies of the same model for -n_steps on the same
+    batches in fp32, bf16 autocast and bf16 with fp32 master weights, without dropout so the runs
+    are comparable. Reports train step time and activations saved for backward, and checks that
+    each bf16 loss curve stays within -loss_tolerance (relative) of the fp32 one. Also reports
+    the logit difference of bf16 inference.
+    ----------
+    """
+
+    initial = copy.deepcopy(model.state_dict())
+    batches = [random_frames(args.batch_size, args.seq_len + 1) for _ in range(min(args.n_steps, 8))]
+
+    settings = [
+        ("fp32", "fp32", False),
+        ("bf16 autocast", "bf16", False),
+        ("bf16 + master weights", "bf16", True),
+    ]
+
+    print(SEPERATOR)
+    reference = None
+    for name, precision, use_master in settings:
+        run = copy.deepcopy(model)
+        run.load_state_dict(initial)
+        run.eval()
+
+        master_weights = None
+        if(precision == "bf16"):
+            keep_norms_fp32(run)
+            if(use_master):
+                master_weights = MasterWeights(run)
+
+        params = run.parameters() if master_weights is None else master_weights.params()
+        opt = torch.optim.Adam(params, lr=1e-4, betas=(ADAM_BETA_1, ADAM_BETA_2), eps=ADAM_EPSILON)
+
+        def loss_on(batch):
+            with autocast(precision, batch.device):
+                y = run(batch[:, :-1])
+            return F.binary_cross_entropy_with_logits(y.type(TORCH_FLOAT), batch[:, 1:])
+
+        saved = saved_mb(lambda: loss_on(batches[0]))
+        run.zero_grad()
+
+        curve = []
+        total = 0.0
+        for step in range(args.n_steps):
+            batch = batches[step % len(batches)]
+            time_before = time.time()
+
+            opt.zero_grad()
+            out = loss_on(batch)
+            out.backward()
+            if(master_weights is not None):
+                master_weights.copy_grads()
+            opt.step()
+            if(master_weights is not None):
+                master_weights.copy_weights()
+
+            total += time.time() - time_before
+            curve.append(float(out))
+
+        print(name + ":")
+        print("    train step (s):", total / args.n_steps, " saved for backward (MB):", saved)
+        print("    loss first / last:", curve[0], "/", curve[-1])
+
+        if(reference is None):
+            reference = curve
+        else:
+            rel_diff = max(abs(c - r) / abs(r) for c, r in zip(curve, reference))
+            print("    max relative loss difference:", rel_diff, " PASS" if rel_diff <= args.loss_tolerance else " FAIL")
+
+    # Inference on the untrained model
+    model.eval()
+    with torch.set_grad_enabled(False):
+        x = batches[0][:, :-1]
+        y_fp32 = model(x)
+
+        run = keep_norms_fp32(copy.deepcopy(model))
+        with autocast("bf16", x.device):
+            y_bf16 = run(x).type(TORCH_FLOAT)
+
+        took_fp32 = timed(lambda: model(x), args.n_trials)
+        with autocast("bf16", x.device):
+            took_bf16 = timed(lambda: run(x), args.n_trials)
+
+    print("Inference:")
+    print("    fp32 forward (s):", took_fp32, " bf16 forward (s):", took_bf16)
+    print("    max abs logit difference:", float((y_fp32 - y_bf16).abs().max()))
+    print(SEPERATOR)
+
+# NpzWindows
+class NpzWindows(Dataset):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Baseline for benchmark_mmap_dataset: the windows of LpdMmapDataset (across pieces) read from
+    the npz itself, which every process decompresses and densifies in full on first access
+    ----------
+    """
+
+    def __init__(self, npz_path, seq_len, n_frames):
+        self.npz_path   = npz_path
+        self.seq_len    = seq_len
+        self.starts     = np.arange(0, n_frames - seq_len, seq_len)
+        self._frames    = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        if(self._frames is None):
+            with np.load(self.npz_path) as npz:
+                shape = tuple(int(s) for s in npz["shape"])
+                frames = np.zeros(shape, dtype=np.uint8)
+                frames[tuple(npz["nonzero"])] = 1
+            self._frames = frames.reshape(-1, 84, 5)
+
+        start = self.starts[idx]
+        window = self._frames[start:start + self.seq_len + 1]
+        return torch.from_numpy(window[:-1]), torch.from_numpy(window[1:])
+
+# anon_rss_mb
+def anon_rss_mb():
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Private (anonymous) resident memory of this process in MB, the part each DataLoader worker
+    adds on its own. None where /proc is not available.
+    ----------
+    """
+
+    if(not os.path.isfile("/proc/self/status")):
+        return None
+
+    with open("/proc/self/status", "r") as i_stream:
+        for line in i_stream:
+            if(line.startswith("RssAnon:")):
+                return int(line.split()[1]) / 2**10
+
+    return None
+
+# write_random_npz
+def write_random_npz(npz_path, shape, seed, density=0.01):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Writes a random binary array of shape (n_phrases, 4, 48, 84, 5) in the sparse LPD-5 npz format
+    of download_data.sh ("shape" and "nonzero")
+    ----------
+    """
+
+    np.random.seed(seed)
+    n_cells = int(np.prod(shape))
+    flat = np.unique(np.random.randint(0, n_cells, int(n_cells * density)))
+    np.savez_compressed(npz_path, shape=np.array(shape), nonzero=np.array(np.unravel_index(flat, shape)))
+
+# benchmark_mmap_dataset
+def benchmark_mmap_dataset(args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Reading LPD-5 phrases from the npz versus the memory-mapped format (LpdMmapDataset), on
+    -n_phrases random phrases in the npz format of download_data.sh. Reports the one-time
+    conversion, the private memory one process adds by reading (multiplied by the number of
+    workers), random access time per window and the time to the first batch and through an
+    epoch for each of -worker_counts. Also checks that both give the same windows.
+    ----------
+    """
+
+    shape = (args.n_phrases, 4, FRAMES_PER_BAR, N_PITCHES, N_TRACKS)
+    worker_counts = [int(n) for n in args.worker_counts.split(",")]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        npz_path = os.path.join(tmp_dir, "phrases.npz")
+        mmap_dir = os.path.join(tmp_dir, "mmap")
+
+        write_random_npz(npz_path, shape, args.seed)
+
+        time_before = time.time()
+        convert_lpd_npz(npz_path, mmap_dir, val_p=0.0, test_p=0.0)
+        convert_took = time.time() - time_before
+
+        datasets = [
+            ("npz", NpzWindows(npz_path, args.seq_len, args.n_phrases * 4 * FRAMES_PER_BAR)),
+            ("mmap", LpdMmapDataset(mmap_dir, "train", args.seq_len)),
+        ]
+
+        print(SEPERATOR)
+        print("Conversion (s):", convert_took)
+        print("npz size (MB):", os.path.getsize(npz_path) / 2**20,
+              " frames size (MB):", os.path.getsize(os.path.join(mmap_dir, "frames.npy")) / 2**20)
+
+        for name, dataset in datasets:
+            rss_before = anon_rss_mb()
+            time_before = time.time()
+            dataset[0]
+            first_took = time.time() - time_before
+            rss_after = anon_rss_mb()
+
+            order = np.random.permutation(len(dataset))
+            took = timed(lambda: [dataset[int(i)] for i in order], 1) / len(dataset)
+
+            print(name + ":")
+            print("    first access (s):", first_took, " random access per window (s):", took)
+            if(rss_before is not None):
+                print("    private memory per process (MB):", rss_after - rss_before)
+
+            for n_workers in worker_counts:
+                # Each process loads or maps the frames on its own
+                dataset._frames = None
+                loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=n_workers, shuffle=True)
+
+                time_before = time.time()
+                batches = iter(loader)
+                next(batches)
+                first_batch = time.time() - time_before
+                for _ in batches:
+                    pass
+                epoch = time.time() - time_before
+
+                print("    workers", n_workers, "first batch (s):", first_batch, " epoch (s):", epoch)
+
+        same = all(torch.equal(datasets[0][1][i][0], datasets[1][1][i][0]) for i in range(len(datasets[1][1])))
+        print("Same windows:", same)
+
+    print(SEPERATOR)
+
+# benchmark_bitpack
+def benchmark_bitpack(args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Bit-packed frames (pack_frames / unpack_frames) against dense frames: bytes per frame, pack
+    and unpack time on the cpu and the device, and the time to collate a batch and get it to the
+    device as float frames. Checks the round trip, and that a packed conversion of random
+    phrases (convert_lpd_npz) gives the same frames as the dense one.
+    ----------
+    """
+
+    device = get_device()
+    frames = random_frames(args.batch_size, args.seq_len + 1).cpu()
+    packed = pack_frames(frames.numpy())
+    packed_t = torch.from_numpy(packed)
+
+    print(SEPERATOR)
+    print("Bytes per frame: float", N_PITCHES * N_TRACKS * 4, " uint8", N_PITCHES * N_TRACKS, " packed", PACKED_FRAME_BYTES)
+    print("Pack (s):", timed(lambda: pack_frames(frames.numpy()), args.n_trials))
+    print("Unpack on cpu (s):", timed(lambda: unpack_frames(packed_t), args.n_trials))
+    print("Unpack on", str(device), "(s):", timed(lambda: unpack_frames(packed_t.to(device)), args.n_trials))
+    print("Round trip exact:", torch.equal(unpack_frames(packed_t), frames))
+
+    # Batches as a DataLoader would build them from per sequence items
+    dense_items = list(frames)
+    packed_items = list(packed_t)
+    print("Collate and move, float (s):", timed(lambda: to_frames(default_collate(dense_items), device), args.n_trials))
+    print("Collate and move, packed (s):", timed(lambda: to_frames(default_collate(packed_items), device), args.n_trials))
+    pair_items = [(p[:-1], p[1:]) for p in packed_items]
+    print("unpack_collate of (input, target) pairs (s):", timed(lambda: unpack_collate(pair_items), args.n_trials))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        npz_path = os.path.join(tmp_dir, "phrases.npz")
+        write_random_npz(npz_path, (args.n_phrases, 4, FRAMES_PER_BAR, N_PITCHES, N_TRACKS), args.seed)
+
+        convert_lpd_npz(npz_path, os.path.join(tmp_dir, "dense"), val_p=0.0, test_p=0.0)
+        convert_lpd_npz(npz_path, os.path.join(tmp_dir, "packed"), val_p=0.0, test_p=0.0, packed=True)
+
+        dense = np.load(os.path.join(tmp_dir, "dense", "frames.npy"), mmap_mode="r")
+        packed = np.load(os.path.join(tmp_dir, "packed", "frames.npy"), mmap_mode="r")
+        print("Frames file (MB): dense", dense.nbytes / 2**20, " packed", packed.nbytes / 2**20)
+        print("Packed conversion matches:", np.array_equal(pack_frames(dense), packed))
+
+    print(SEPERATOR)
+
+# benchmark_sparse_embedding
+def benchmark_sparse_embedding(model, args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Sparse active-note input (MusicTransformer.embed on frames_to_active frames) against dense
+    frames with the same weights: bytes per frame, embedding forward + backward time, full forward
+    logit difference and cached decoding step time. Also checks the frames_to_active /
+    active_to_frames round trip.
+    ----------
+    """
+
+    frames = random_frames(args.batch_size, args.seq_len)
+    active = frames_to_active(frames)
+
+    print(SEPERATOR)
+    print("Bytes per frame: dense float", N_PITCHES * N_TRACKS * 4, " sparse int16", active.shape[-1] * active.element_size(),
+          "(" + str(active.shape[-1]) + " active notes max)")
+    print("Round trip exact:", torch.equal(active_to_frames(active), frames))
+
+    model.eval()
+    with torch.set_grad_enabled(False):
+        diff_embed = float((model.embed(frames) - model.embed(active)).abs().max())
+        diff_logits = float((model(frames) - model(active)).abs().max())
+
+    print("Max abs embedding difference:", diff_embed)
+    print("Max abs logit difference:", diff_logits)
+
+    inputs = [("dense", frames), ("sparse", active)]
+
+    for name, x in inputs:
+        def embed_step():
+            model.zero_grad()
+            model.embed(x).sum().backward()
+
+        took = timed(embed_step, args.n_trials)
+
+        with torch.set_grad_enabled(False):
+            def decode():
+                cache = model.init_cache(args.batch_size, args.seq_len)
+                model.forward_step(x[:, :args.n_primer], cache)
+                for i in range(args.n_primer, args.seq_len):
+                    model.forward_step(x[:, i:i+1], cache)
+
+            decode_took = timed(decode, 1) / (args.seq_len - args.n_primer)
+
+        print(name + ":")
+        print("    embedding forward + backward (s):", took)
+        print("    cached decoding step (s):", decode_took)
+
+    print(SEPERATOR)
+
+# main
+def main():
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Entry point. Runs the benchmark or numerical check given by the mode argument
+    ----------
+    """
+
+    args = parse_benchmark_args()
+    print_benchmark_args(args)
+
+    if(args.force_cpu):
+        use_cuda(False)
+        print("WARNING: Forced CPU usage, expect model to perform slower")
+        print("")
+
+    torch.manual_seed(args.seed)
+    model = build_model(args)
+
+    if(args.mode == "kv_cache"):
+        benchmark_kv_cache(model, args)
+    elif(args.mode == "batch_generate"):
+        benchmark_batch_generate(model, args)
+    elif(args.mode == "sampler"):
+        benchmark_sampler(args)
+    elif(args.mode == "beam_search"):
+        benchmark_beam_search(model, args)
+    elif(args.mode == "long_form"):
+        benchmark_long_form(model, args)
+    elif(args.mode == "stream"):
+        benchmark_stream(model, args)
+    elif(args.mode == "quantize"):
+        benchmark_quantize(model, args)
+    elif(args.mode == "export"):
+        benchmark_export(model, args)
+    elif(args.mode == "speculative"):
+        benchmark_speculative(model, args)
+    elif(args.mode == "rpr_attention"):
+        benchmark_rpr_attention(model, args)
+    elif(args.mode == "self_attention"):
+        benchmark_self_attention(args)
+    elif(args.mode == "masks"):
+        benchmark_masks(model, args)
+    elif(args.mode == "checkpoint"):
+        benchmark_checkpoint(model, args)
+    elif(args.mode == "sparse_attention"):
+        benchmark_sparse_attention(args)
+    elif(args.mode == "linear_attention"):
+        benchmark_linear_attention(args)
+    elif(args.mode == "segment_memory"):
+        benchmark_segment_memory(model, args)
+    elif(args.mode == "chunked_ffn"):
+        benchmark_chunked_ffn(model, args)
+    elif(args.mode == "loss"):
+        benchmark_loss(args)
+    elif(args.mode == "bf16"):
+        benchmark_bf16(model, args)
+    elif(args.mode == "mmap_dataset"):
+        benchmark_mmap_dataset(args)
+    elif(args.mode == "bitpack"):
+        benchmark_bitpack(args)
+    elif(args.mode == "sparse_embedding"):
+        benchmark_sparse_embedding(model, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import os
+import json
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
+
+from utilities.constants import *
+from utilities.piano_roll import unpack_frames, frames_to_active
+
+LPD_FRAMES_FILE     = "frames.npy"
+LPD_OFFSETS_FILE    = "offsets.npy"
+LPD_INDEX_FILE      = "index.json"
+
+# Nonzero indices scattered into the frames at once during conversion
+CONVERT_CHUNK       = 2**22
+
+# LpdMmapDataset
+class LpdMmapDataset(Dataset):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Piano-roll windows of a dataset converted by convert_lpd_npz, read straight from the
+    memory-mapped frames. An item is the input frames (seq_len, 84, 5) and the next frame targets
+    (seq_len, 84, 5), both zero-copy uint8 views of one window of seq_len + 1 frames (cast to float
+    after batching, see train_epoch). If the dataset was converted with packed, frames are
+    bit-packed (seq_len, 53) instead, unpacked on the device by train_epoch or in the workers
+    with unpack_collate.
+
+    Only the paths and the window starts are held in memory. The frames are mapped on first
+    access in each process and never pickled, so DataLoader workers start at once, share the
+    page cache instead of holding their own copy, and the dataset may be larger than RAM.
+
+    LPD-5 phrases are 4 bars, shorter than most max_sequence, so by default windows run across
+    consecutive pieces of the split. With across_pieces False they stay inside one piece (pieces
+    shorter than seq_len + 1 frames give none). Windows start every stride frames (default
+    seq_len).
+    ----------
+    """
+
+    def __init__(self, root, split, seq_len, stride=None, across_pieces=True):
+        self.frames_path    = os.path.join(root, LPD_FRAMES_FILE)
+        self.seq_len        = seq_len
+        self.stride         = seq_len if stride is None else stride
+        self._frames        = None
+
+        with open(os.path.join(root, LPD_INDEX_FILE), "r") as i_stream:
+            index = json.load(i_stream)
+
+        first, end  = index["splits"][split]
+        self.packed = index.get("packed", False)
+
+        offsets = np.load(os.path.join(root, LPD_OFFSETS_FILE))[first:end + 1]
+
+        if(across_pieces):
+            ranges = [(offsets[0], offsets[-1])]
+        else:
+            ranges = zip(offsets[:-1], offsets[1:])
+
+        window = seq_len + 1
+        starts = [np.arange(start, end - window + 1, self.stride, dtype=np.int64) for start, end in ranges]
+        self.starts = np.concatenate(starts) if len(starts) > 0 else np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        if(self._frames is None):
+            # Copy-on-write mapping: writable views for torch.from_numpy, the file is never changed
+            self._frames = np.load(self.frames_path, mmap_mode="c")
+
+        start = self.starts[idx]
+        window = self._frames[start:start + self.seq_len + 1]
+
+        return torch.from_numpy(window[:-1]), torch.from_numpy(window[1:])
+
+    def __getstate__(self):
+        # Workers map the frames themselves, a pickled memmap would be a full copy
+        state = self.__dict__.copy()
+        state["_frames"] = None
+        return state
+
+# unpack_collate
+def unpack_collate(batch):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    DataLoader collate_fn for bit-packed LpdMmapDatasets that unpacks the batch to TORCH_FLOAT in
+    the workers, for when the device should not do it. Dense frames are passed on as they are.
+    ----------
+    """
+
+    x, tgt = default_collate(batch)
+    if(x.shape[-1] != PACKED_FRAME_BYTES):
+        return x, tgt
+
+    return unpack_frames(x), unpack_frames(tgt)
+
+# active_collate
+def active_collate(batch):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    DataLoader collate_fn for LpdMmapDatasets (packed or not) that turns the batch into sparse
+    active-note frames (see frames_to_active) in the workers. Inputs go to the model's sparse
+    embedding as is, targets are made dense again on the device (see to_frames).
+    ----------
+    """
+
+    x, tgt = default_collate(batch)
+    if(x.shape[-1] == PACKED_FRAME_BYTES):
+        x, tgt = unpack_frames(x, torch.uint8), unpack_frames(tgt, torch.uint8)
+
+    return frames_to_active(x), frames_to_active(tgt)
+
+# create_lpd_mmap_datasets
+def create_lpd_mmap_datasets(root, seq_len, stride=None, across_pieces=True):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Creates train, val and test LpdMmapDatasets from a folder written by convert_lpd_npz
+    ----------
+    """
+
+    return tuple(LpdMmapDataset(root, split, seq_len, stride, across_pieces) for split in ("train", "val", "test"))
+
+# convert_lpd_npz
+def convert_lpd_npz(npz_path, output_dir, val_p=0.1, test_p=0.1, packed=False):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    One-time conversion of an LPD-5 npz (as downloaded by download_data.sh) to the memory-mapped
+    format read by LpdMmapDataset. The npz holds a binary array in sparse form: "shape"
+    (n_pieces, ..., 84, 5), here (n_phrases, 4 bars, 48 steps, 84, 5), and "nonzero", the indices
+    of its set cells.
+
+    Writes to output_dir:
+        frames.npy:     Uncompressed uint8 frames (n_frames, 84, 5) of every piece, one after
+                        another, or with packed, bit-packed frames (n_frames, 53) as written by
+                        pack_frames. Filled chunk by chunk straight into the file, the dense
+                        array is never held in memory.
+        offsets.npy:    int64 (n_pieces + 1,) first frame of every piece, then n_frames.
+        index.json:     Pieces [first, end) of the train, val and test splits. The last val_p and
+                        test_p of the pieces (contiguous, so windows across pieces stay inside
+                        one split) are val and test.
+    Returns the number of pieces in each split.
+    ----------
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    with np.load(npz_path) as npz:
+        shape = tuple(int(s) for s in npz["shape"])
+        nonzero = npz["nonzero"]
+
+    assert shape[-2:] == (N_PITCHES, N_TRACKS), "Expected frames of " + str(N_PITCHES) + " pitches and " + str(N_TRACKS) + " tracks"
+
+    n_pieces = shape[0]
+    frames_per_piece = int(np.prod(shape[1:-2]))
+    n_frames = n_pieces * frames_per_piece
+
+    frame_shape = (PACKED_FRAME_BYTES,) if packed else (N_PITCHES, N_TRACKS)
+    frames = np.lib.format.open_memmap(os.path.join(output_dir, LPD_FRAMES_FILE), mode="w+", dtype=np.uint8,
+                                       shape=(n_frames,) + frame_shape)
+
+    for start in range(0, nonzero.shape[1], CONVERT_CHUNK):
+        idx = nonzero[:, start:start + CONVERT_CHUNK]
+        frame = np.ravel_multi_index(tuple(idx[:-2]), shape[:-2])
+
+        if(packed):
+            # Same bit order as pack_frames
+            cell = idx[-2] * N_TRACKS + idx[-1]
+            mask = np.right_shift(0x80, cell % 8).astype(np.uint8)
+            np.bitwise_or.at(frames, (frame, cell // 8), mask)
+        else:
+            frames[frame, idx[-2], idx[-1]] = 1
+
+    frames.flush()
+    del frames
+
+    offsets = np.arange(n_pieces + 1, dtype=np.int64) * frames_per_piece
+    np.save(os.path.join(output_dir, LPD_OFFSETS_FILE), offsets)
+
+    n_test = int(n_pieces * test_p)
+    n_val = int(n_pieces * val_p)
+    n_train = n_pieces - n_val - n_test
+
+    splits = {
+        "train": [0, n_train],
+        "val": [n_train, n_train + n_val],
+        "test": [n_train + n_val, n_pieces],
+    }
+
+    with open(os.path.join(output_dir, LPD_INDEX_FILE), "w") as o_stream:
+        json.dump({"n_frames": n_frames, "frames_per_piece": frames_per_piece, "packed": packed, "splits": splits}, o_stream)
+
+    return {split: end - first for split, (first, end) in splits.items()}
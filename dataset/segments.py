@@ -0,0 +1,149 @@
+import os
+import json
+import random
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+
+from utilities.constants import *
+from dataset.lpd_mmap import LPD_FRAMES_FILE, LPD_OFFSETS_FILE, LPD_INDEX_FILE
+
+# SegmentDataset
+class SegmentDataset(Dataset):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Consecutive segments of whole pieces for training with segment recurrence
+    (MusicTransformer.forward_segment). Pieces are those of one split of a dataset converted by
+    convert_lpd_npz (preprocess_lpd.py), in the order of its offsets index, read straight from the
+    memory-mapped frames like LpdMmapDataset (mapped on first access in each process, never
+    pickled).
+
+    Indexed by (piece, start) pairs as produced by SegmentSampler. An item is the input frames
+    (seq_len, 84, 5), the next frame targets (seq_len, 84, 5), as stored (uint8, or bit-packed
+    (seq_len, 53)), and whether the segment starts its piece (the model's memory must then be
+    reset). LPD-5 pieces are 4 bar phrases, so seq_len must be below their length to give any
+    segment.
+    ----------
+    """
+
+    def __init__(self, root, split, seq_len):
+        self.frames_path    = os.path.join(root, LPD_FRAMES_FILE)
+        self.seq_len        = seq_len
+        self._frames        = None
+
+        with open(os.path.join(root, LPD_INDEX_FILE), "r") as i_stream:
+            index = json.load(i_stream)
+
+        first, end  = index["splits"][split]
+        self.packed = index.get("packed", False)
+
+        offsets = np.load(os.path.join(root, LPD_OFFSETS_FILE))[first:end + 1]
+        self.starts = offsets[:-1]
+        self.ends   = offsets[1:]
+
+    # lengths
+    def lengths(self):
+        return (self.ends - self.starts).tolist()
+
+    def __len__(self):
+        return sum(n_segments(length, self.seq_len) for length in self.lengths())
+
+    def __getitem__(self, idx):
+        if(self._frames is None):
+            # Copy-on-write mapping: writable views for torch.from_numpy, the file is never changed
+            self._frames = np.load(self.frames_path, mmap_mode="c")
+
+        piece, start = idx
+        first = self.starts[piece] + start
+        window = self._frames[first:first + self.seq_len + 1]
+
+        return torch.from_numpy(window[:-1]), torch.from_numpy(window[1:]), start == 0
+
+    def __getstate__(self):
+        # Workers map the frames themselves
+        state = self.__dict__.copy()
+        state["_frames"] = None
+        return state
+
+# SegmentSampler
+class SegmentSampler(Sampler):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Batch sampler (DataLoader batch_sampler) that feeds every piece through one batch slot
+    segment by segment, in order, so the memory a slot carries always comes from the previous
+    segment of the same piece.
+
+    Each epoch pieces are shuffled, then dealt longest first (pieces with as many segments keep
+    their shuffled order) to the batch_size slots, always to the slot with the fewest segments.
+    Batch i holds segment i of every slot's stream. The epoch ends with the shortest stream, so
+    the leftover segments of longer ones are skipped. Dealing longest first keeps that to at most
+    the segments of the last piece dealt to the longest stream, one of the shorter pieces, instead
+    of up to a long piece per slot. Pieces shorter than seq_len + 1 frames, and the incomplete
+    last segment of each piece, are dropped.
+    ----------
+    """
+
+    def __init__(self, lengths, batch_size, seq_len, shuffle=True, seed=0):
+        self.lengths    = lengths
+        self.batch_size = batch_size
+        self.seq_len    = seq_len
+        self.shuffle    = shuffle
+        self.seed       = seed
+        self.epoch      = 0
+
+        assert sum(n_segments(length, seq_len) > 0 for length in lengths) >= batch_size, "Need at least batch_size pieces of seq_len + 1 frames"
+
+    # set_epoch
+    def set_epoch(self, epoch):
+        # Changes the shuffle order, call once per epoch before iterating
+        self.epoch = epoch
+
+    def _streams(self):
+        counts = [n_segments(length, self.seq_len) for length in self.lengths]
+
+        order = list(range(len(self.lengths)))
+        if(self.shuffle):
+            random.Random(self.seed + self.epoch).shuffle(order)
+
+        # Longest first (LPT), the sort is stable so equal counts stay shuffled
+        order.sort(key=lambda piece: -counts[piece])
+
+        streams = [[] for _ in range(self.batch_size)]
+        for piece in order:
+            if(counts[piece] == 0):
+                break
+
+            slot = min(range(self.batch_size), key=lambda s: len(streams[s]))
+            streams[slot].extend((piece, i * self.seq_len) for i in range(counts[piece]))
+
+        return streams
+
+    def __iter__(self):
+        streams = self._streams()
+        for i in range(min(len(stream) for stream in streams)):
+            yield [stream[i] for stream in streams]
+
+    def __len__(self):
+        return min(len(stream) for stream in self._streams())
+
+# n_segments
+def n_segments(length, seq_len):
+    # Complete segments of seq_len inputs (plus one target frame) in a piece of length frames
+    return max(0, (length - 1) // seq_len)
+
+# create_segment_datasets
+def create_segment_datasets(root, seq_len):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Creates train, val and test SegmentDatasets from a folder written by convert_lpd_npz (the
+    --mmap_dataset format)
+    ----------
+    """
+
+    return tuple(SegmentDataset(root, split, seq_len) for split in ("train", "val", "test"))
@@ -0,0 +1,173 @@
+import os
+import json
+import random
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from utilities.constants import *
+
+TOKEN_COLUMNS       = ["notes", "durations", "chords"]
+SHARD_FILE          = "tokens_{:04d}.npy"
+SHARD_OFFSETS_FILE  = "offsets.npy"
+SHARD_INDEX_FILE    = "index.json"
+VOCAB_FILE          = "vocab.pickle"
+
+# Tokens per shard before a new one is started
+SHARD_TOKENS        = 2**24
+
+# Largest token index a shard holds, the vocab size itself is kept free for padding
+MAX_TOKEN_INDEX     = np.iinfo(np.int16).max - 1
+
+# TokenShardWriter
+class TokenShardWriter:
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Writes integer encoded pieces (notes, durations and chords columns) of one split to
+    output_dir as columnar int16 shards:
+        tokens_NNNN.npy:    int16 (3, n_tokens), the notes, durations and chords of the pieces
+                            of the shard one after another, each column contiguous. A new shard
+                            starts past SHARD_TOKENS tokens, pieces never straddle two.
+        offsets.npy:        int64 (n_pieces, 3) shard, first token and length of every piece.
+        index.json:         Piece names, the shard count and the pad index of every column (its
+                            vocab size, given to close).
+    Pieces are kept in memory only until their shard is written. Indices above MAX_TOKEN_INDEX
+    fail in add, before anything is cast.
+    ----------
+    """
+
+    def __init__(self, output_dir, shard_tokens=SHARD_TOKENS):
+        self.output_dir     = output_dir
+        self.shard_tokens   = shard_tokens
+
+        self.names          = []
+        self.offsets        = []
+        self.n_shards       = 0
+
+        self._pending       = []
+        self._pending_len   = 0
+
+        os.makedirs(output_dir, exist_ok=True)
+
+    # add
+    def add(self, name, columns):
+        # columns is the (3, length) integer encoded notes, durations and chords of one piece
+        columns = np.asarray(columns, dtype=np.int64)
+        assert columns.shape[0] == len(TOKEN_COLUMNS), "Expected " + str(len(TOKEN_COLUMNS)) + " token columns"
+        if(columns.size > 0 and (columns.min() < 0 or columns.max() > MAX_TOKEN_INDEX)):
+            raise ValueError("Token index of " + str(name) + " out of int16 shard range [0, " + str(MAX_TOKEN_INDEX) + "]")
+        columns = columns.astype(np.int16)
+
+        if(self._pending_len > 0 and self._pending_len + columns.shape[1] > self.shard_tokens):
+            self._flush()
+
+        self.names.append(name)
+        self.offsets.append((self.n_shards, self._pending_len, columns.shape[1]))
+        self._pending.append(columns)
+        self._pending_len += columns.shape[1]
+
+    # close
+    def close(self, vocab_sizes):
+        # Writes the last shard and the index. vocab_sizes (one per column) become the pad indices.
+        if(self._pending_len > 0):
+            self._flush()
+
+        offsets = np.array(self.offsets, dtype=np.int64).reshape(-1, 3)
+        np.save(os.path.join(self.output_dir, SHARD_OFFSETS_FILE), offsets)
+
+        with open(os.path.join(self.output_dir, SHARD_INDEX_FILE), "w") as o_stream:
+            json.dump({"columns": TOKEN_COLUMNS, "n_shards": self.n_shards, "pad": [int(v) for v in vocab_sizes],
+                       "names": self.names}, o_stream)
+
+    def _flush(self):
+        shard = np.concatenate(self._pending, axis=1)
+        np.save(os.path.join(self.output_dir, SHARD_FILE.format(self.n_shards)), shard)
+
+        self.n_shards += 1
+        self._pending = []
+        self._pending_len = 0
+
+# TokenShardDataset
+class TokenShardDataset(Dataset):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Pieces of one split written by TokenShardWriter, read straight from the memory-mapped shards
+    (mapped on first access in each process, never pickled). An item is a (max_seq, 3) input of
+    notes, durations and chords and the next token targets, as TORCH_LABEL_TYPE.
+
+    A piece of max_seq + 1 tokens or more gives a window of max_seq + 1 tokens (random start with
+    random_seq, else the first), a shorter one is padded. The pad of each column is its vocab
+    size (from index.json), outside the vocab, so embeddings need vocab size + 1 rows and losses
+    can ignore it.
+    ----------
+    """
+
+    def __init__(self, split_dir, max_seq, random_seq=True):
+        self.split_dir      = split_dir
+        self.max_seq        = max_seq
+        self.random_seq     = random_seq
+        self._shards        = None
+
+        self.offsets = np.load(os.path.join(split_dir, SHARD_OFFSETS_FILE))
+
+        with open(os.path.join(split_dir, SHARD_INDEX_FILE), "r") as i_stream:
+            index = json.load(i_stream)
+
+        self.n_shards   = index["n_shards"]
+        self.pad        = torch.tensor(index["pad"], dtype=TORCH_LABEL_TYPE)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        if(self._shards is None):
+            self._shards = [np.load(os.path.join(self.split_dir, SHARD_FILE.format(i)), mmap_mode="r") for i in range(self.n_shards)]
+
+        shard, first, length = (int(v) for v in self.offsets[idx])
+        full_seq = self.max_seq + 1
+
+        x   = self.pad.repeat(self.max_seq, 1)
+        tgt = self.pad.repeat(self.max_seq, 1)
+
+        if(length == 0):
+            return x, tgt
+
+        if(length < full_seq):
+            data = torch.from_numpy(np.array(self._shards[shard][:, first:first + length].T)).type(TORCH_LABEL_TYPE)
+            x[:length] = data
+            tgt[:length - 1] = data[1:]
+            return x, tgt
+
+        start = random.randint(0, length - full_seq) if self.random_seq else 0
+
+        data = self._shards[shard][:, first + start:first + start + full_seq]
+        data = torch.from_numpy(np.array(data.T)).type(TORCH_LABEL_TYPE)
+
+        return data[:self.max_seq], data[1:]
+
+    def __getstate__(self):
+        # Workers map the shards themselves
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+# create_token_datasets
+def create_token_datasets(dataset_root, max_seq, random_seq=True):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Creates train, val and test TokenShardDatasets from the split folders of dataset_root, as
+    written by preprocess_midi.py. Only the train set gets random windows.
+    ----------
+    """
+
+    train = TokenShardDataset(os.path.join(dataset_root, "train"), max_seq, random_seq)
+    val = TokenShardDataset(os.path.join(dataset_root, "val"), max_seq, False)
+    test = TokenShardDataset(os.path.join(dataset_root, "test"), max_seq, False)
+
+    return train, val, test
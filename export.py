@@ -0,0 +1,79 @@
+import torch
+
+from model.music_transformer import MusicTransformer
+from model.export import export_model
+
+from utilities.constants import *
+from utilities.device import get_device, use_cuda
+from utilities.argument_funcs import parse_export_args, print_export_args
+
+# check_export
+def check_export(model, scripted, n_primer, n_steps):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Runs a random primer then n_steps single frame steps through both the eager cached path
+    (forward_step) and the scripted module. Returns the max absolute logit difference.
+    ----------
+    """
+
+    x = (torch.rand((1, n_primer + n_steps, 84, 5), device=get_device()) < 0.05).type(TORCH_FLOAT)
+
+    with torch.set_grad_enabled(False):
+        cache = model.init_cache(1, n_primer + n_steps)
+        keys, values = scripted.init_state(1, n_primer + n_steps)
+
+        max_diff = float((model.forward_step(x[:, :n_primer], cache) - scripted(x[:, :n_primer], keys, values, 0)).abs().max())
+        for i in range(n_primer, n_primer + n_steps):
+            y_eager = model.forward_step(x[:, i:i+1], cache)
+            y_script = scripted(x[:, i:i+1], keys, values, i)
+            max_diff = max(max_diff, float((y_eager - y_script).abs().max()))
+
+    return max_diff
+
+# main
+def main():
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Entry point. Exports a model specified by command line arguments as a TorchScript file and
+    checks it against the eager model
+    ----------
+    """
+
+    args = parse_export_args()
+    print_export_args(args)
+
+    if(args.force_cpu):
+        use_cuda(False)
+        print("WARNING: Forced CPU usage, expect model to perform slower")
+        print("")
+
+    model = MusicTransformer(n_layers=args.n_layers, num_heads=args.num_heads,
+                d_model=args.d_model, dim_feedforward=args.dim_feedforward,
+                max_sequence=args.max_sequence, rpr=args.rpr).to(get_device())
+
+    if(args.model_weights is not None):
+        model.load_state_dict(torch.load(args.model_weights, map_location=get_device()))
+
+    model.eval()
+
+    export_model(model, args.output_file)
+    print("Saved TorchScript model to", args.output_file)
+
+    loaded = torch.jit.load(args.output_file, map_location=get_device())
+    max_diff = check_export(model, loaded, args.n_primer, args.n_steps)
+
+    print(SEPERATOR)
+    print("Max abs logit difference (eager vs exported):", max_diff)
+    print("")
+    print("Usage without this repo:")
+    print("    model = torch.jit.load(\"" + args.output_file + "\")")
+    print("    frames = model.generate(primer, num_frames, temperature)")
+    print(SEPERATOR)
+
+
+if __name__ == "__main__":
+    main()
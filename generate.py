@@ -3,10 +3,17 @@ import torch.nn as nn
 import os
 import random
 
-from third_party.midi_processor.processor import decode_midi, encode_midi
+from third_party.midi_processor.processor import encode_midi
 
-from utilities.argument_funcs import parse_generate_args, print_generate_args
+from utilities.argument_funcs import parse_generate_args, print_generate_args, parse_per_track
+from utilities.precision import autocast, keep_norms_fp32
+from utilities.piano_roll import MidiStreamWriter, frames_to_midi
 from model.music_transformer import MusicTransformer
+from model.sparse_attention import AttentionPattern
+from model.sampling import PianoRollSampler
+from model.quantization import quantize_dynamic_int8
+from model.speculative import speculative_generate
+from model.beam_search import beam_search
 from dataset.e_piano import create_epiano_datasets, compute_epiano_accuracy, process_midi
 from torch.utils.data import DataLoader
 from torch.optim import Adam
@@ -27,7 +34,7 @@ def main():
     args = parse_generate_args()
     print_generate_args(args)
 
-    if(args.force_cpu):
+    if(args.force_cpu or args.quantize):
         use_cuda(False)
         print("WARNING: Forced CPU usage, expect model to perform slower")
         print("")
@@ -37,56 +44,172 @@ def main():
     # Grabbing dataset if needed
     _, _, dataset = create_epiano_datasets(args.midi_root, args.num_prime, random_seq=False)
 
-    # Can be None, an integer index to dataset, or a file path
+    # Can be None, integer indices to dataset, or file paths (comma separated)
     if(args.primer_file is None):
-        f = str(random.randrange(len(dataset)))
+        primer_files = [str(random.randrange(len(dataset)))]
     else:
-        f = args.primer_file
+        primer_files = args.primer_file.split(",")
 
-    if(f.isdigit()):
-        idx = int(f)
-        primer, _  = dataset[idx]
-        primer = primer.to(get_device())
-
-        print("Using primer index:", idx, "(", dataset.data_files[idx], ")")
-
-    else:
-        raw_mid = encode_midi(f)
-        if(len(raw_mid) == 0):
-            print("Error: No midi messages in primer file:", f)
+    primers = []
+    for f in primer_files:
+        primer = load_primer(f, dataset, args.num_prime)
+        if(primer is None):
             return
+        primers.append(primer)
 
-        primer, _  = process_midi(raw_mid, args.num_prime, random_seq=False)
-        primer = torch.tensor(primer, dtype=TORCH_LABEL_TYPE, device=get_device())
-
-        print("Using primer file:", f)
+    attn_pattern = None
+    if(args.attn_pattern is not None):
+        attn_pattern = AttentionPattern(args.attn_pattern, args.pattern_block, args.pattern_window, args.pattern_dilation)
 
     model = MusicTransformer(n_layers=args.n_layers, num_heads=args.num_heads,
                 d_model=args.d_model, dim_feedforward=args.dim_feedforward,
-                max_sequence=args.max_sequence, rpr=args.rpr).to(get_device())
+                max_sequence=args.max_sequence, rpr=args.rpr, attn_pattern=attn_pattern,
+                attention=args.attention, feature_map=args.feature_map).to(get_device())
+
+    model.load_state_dict(torch.load(args.model_weights, map_location=get_device()))
+    model.eval()
+
+    if(args.quantize):
+        print("Quantizing model to int8")
+        model = quantize_dynamic_int8(model)
 
-    model.load_state_dict(torch.load(args.model_weights))
+    sampler = PianoRollSampler(temperature=args.temperature, thresholds=parse_per_track(args.thresholds, float),
+                               top_k=args.top_k_notes, max_polyphony=parse_per_track(args.max_polyphony, int),
+                               greedy=args.greedy)
 
-    # Saving primer first
-    f_path = os.path.join(args.output_dir, "primer.mid")
-    decode_midi(primer[:args.num_prime].cpu().numpy(), file_path=f_path)
+    # Saving primers first
+    for i, primer in enumerate(primers):
+        f_path = os.path.join(args.output_dir, "primer_" + str(i) + ".mid")
+        frames_to_midi(primer[:args.num_prime], file_path=f_path)
+
+    if(args.precision == "bf16"):
+        assert not args.quantize, "bf16 and int8 quantization can't be combined"
+        keep_norms_fp32(model)
 
     # GENERATION
     model.eval()
-    with torch.set_grad_enabled(False):
+    with torch.set_grad_enabled(False), autocast(args.precision, get_device()):
         if(args.beam > 0):
             print("BEAM:", args.beam)
-            beam_seq = model.generate(primer[:args.num_prime], args.target_seq_length, beam=args.beam)
+            batch_primers = [primer[:args.num_prime] for primer in primers]
+
+            for b in range(0, len(batch_primers), args.batch_size):
+                results = beam_search(model, batch_primers[b:b+args.batch_size], args.target_seq_length, args.beam,
+                                      length_penalty=args.length_penalty, end_silence=args.end_silence)
 
-            f_path = os.path.join(args.output_dir, "beam.mid")
-            decode_midi(beam_seq[0].cpu().numpy(), file_path=f_path)
+                for j, (beam_seq, score) in enumerate(results):
+                    print("Beam", b + j, "score:", score)
+                    f_path = os.path.join(args.output_dir, "beam_" + str(b + j) + ".mid")
+                    frames_to_midi(beam_seq, file_path=f_path)
         else:
             print("RAND DIST")
-            rand_seq = model.generate(primer[:args.num_prime], args.target_seq_length, beam=0)
+            if(args.window is not None or args.target_seq_length > args.max_sequence):
+                generate_long_form(model, primers, args, sampler)
+                return
+
+            if(args.draft_weights is not None):
+                generate_speculative(model, primers, args, sampler)
+                return
+
+            # Every primer is repeated num_samples times, then generated in batches
+            batch_primers = [primer[:args.num_prime] for primer in primers for _ in range(args.num_samples)]
+
+            for b in range(0, len(batch_primers), args.batch_size):
+                rand_seqs = model.generate_batch(batch_primers[b:b+args.batch_size], args.target_seq_length,
+                                                 end_silence=args.end_silence, sampler=sampler)
 
-            f_path = os.path.join(args.output_dir, "rand.mid")
-            decode_midi(rand_seq[0].cpu().numpy(), file_path=f_path)
+                for j, rand_seq in enumerate(rand_seqs):
+                    i = b + j
+                    f_name = "rand_" + str(i // args.num_samples) + "_" + str(i % args.num_samples) + ".mid"
+                    f_path = os.path.join(args.output_dir, f_name)
+                    frames_to_midi(rand_seq, file_path=f_path)
+
+# generate_long_form
+def generate_long_form(model, primers, args, sampler):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Sliding window generation for pieces longer than max_sequence (see MusicTransformer.generate_long)
+    ----------
+    """
+
+    for i, primer in enumerate(primers):
+        primer = primer[:args.num_prime]
+        for j in range(args.num_samples):
+            n_frames = args.target_seq_length - len(primer)
+
+            # Frames go straight into the midi writer as they are sampled
+            writer = MidiStreamWriter()
+            writer.write(primer)
+            for k, frame in enumerate(model.generate_long(primer, n_frames, window=args.window, sampler=sampler)):
+                writer.write(frame.unsqueeze(0))
+                if((k+1) % 50 == 0):
+                    print(k+1, "/", n_frames)
+
+            f_path = os.path.join(args.output_dir, "rand_" + str(i) + "_" + str(j) + ".mid")
+            writer.close(f_path)
+
+# generate_speculative
+def generate_speculative(model, primers, args, sampler):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Speculative decoding with a small draft model (see speculative.py). Same output distribution
+    as plain sampling.
+    ----------
+    """
+
+    draft_model = MusicTransformer(n_layers=args.draft_n_layers, num_heads=args.draft_num_heads,
+                d_model=args.draft_d_model, dim_feedforward=args.draft_dim_feedforward,
+                max_sequence=args.max_sequence, rpr=args.draft_rpr).to(get_device())
+
+    draft_model.load_state_dict(torch.load(args.draft_weights, map_location=get_device()))
+    draft_model.eval()
+    if(args.precision == "bf16"):
+        keep_norms_fp32(draft_model)
+
+    for i, primer in enumerate(primers):
+        primer = primer[:args.num_prime]
+        for j in range(args.num_samples):
+            rand_seq, stats = speculative_generate(model, draft_model, primer, args.target_seq_length,
+                                                   n_draft=args.n_draft, sampler=sampler)
+
+            print("Accepted", stats["accepted"], "/", stats["proposed"], "draft frames in", stats["rounds"], "model passes")
+
+            f_path = os.path.join(args.output_dir, "rand_" + str(i) + "_" + str(j) + ".mid")
+            frames_to_midi(rand_seq, file_path=f_path)
+
+# load_primer
+def load_primer(f, dataset, num_prime):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Loads a primer from an integer index to the dataset or a midi file path. Returns None on error.
+    ----------
+    """
+
+    if(f.isdigit()):
+        idx = int(f)
+        primer, _  = dataset[idx]
+        primer = primer.to(get_device())
+
+        print("Using primer index:", idx, "(", dataset.data_files[idx], ")")
+
+    else:
+        raw_mid = encode_midi(f)
+        if(len(raw_mid) == 0):
+            print("Error: No midi messages in primer file:", f)
+            return None
+
+        primer, _  = process_midi(raw_mid, num_prime, random_seq=False)
+        primer = torch.tensor(primer, dtype=TORCH_LABEL_TYPE, device=get_device())
+
+        print("Using primer file:", f)
 
+    return primer
 
 
 
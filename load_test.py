@@ -0,0 +1,149 @@
+import asyncio
+import json
+import random
+import time
+import numpy as np
+
+from utilities.argument_funcs import parse_load_test_args, print_load_test_args
+from utilities.constants import *
+
+# open_connection
+async def open_connection(args):
+    if(args.socket is not None):
+        return await asyncio.open_unix_connection(args.socket)
+    return await asyncio.open_connection(args.host, args.port)
+
+# read_response
+async def read_response(reader, on_line=None):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Reads an HTTP response. Chunked bodies are split into lines as chunks arrive and on_line is
+    called with each one. Returns the status code and the full body.
+    ----------
+    """
+
+    status = int((await reader.readline()).decode("latin-1").split(" ")[1])
+
+    headers = {}
+    while(True):
+        line = (await reader.readline()).decode("latin-1").strip()
+        if(line == ""):
+            break
+        key, _, value = line.partition(":")
+        headers[key.strip().lower()] = value.strip()
+
+    if(headers.get("transfer-encoding") != "chunked"):
+        return status, await reader.readexactly(int(headers.get("content-length", 0)))
+
+    body = b""
+    while(True):
+        size = int((await reader.readline()).strip(), 16)
+        chunk = (await reader.readexactly(size + 2))[:size]
+        if(size == 0):
+            break
+
+        body += chunk
+        if(on_line is not None):
+            on_line(chunk)
+
+    return status, body
+
+# request
+async def request(args, method, path, payload=None, on_line=None):
+    reader, writer = await open_connection(args)
+
+    data = b"" if payload is None else json.dumps(payload).encode("utf-8")
+    head = "%s %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n"
+    writer.write((head % (method, path, args.host, len(data))).encode("latin-1") + data)
+    await writer.drain()
+
+    try:
+        return await read_response(reader, on_line)
+    finally:
+        writer.close()
+
+# generation_client
+async def generation_client(args, rng, results):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Sends one generation request with a random primer and length and records its latency and time
+    to the first streamed frames
+    ----------
+    """
+
+    primer = [[[rng.randrange(N_PITCHES), rng.randrange(N_TRACKS)] for _ in range(rng.randrange(4))]
+              for _ in range(args.primer_len)]
+    num_frames = rng.randint(args.min_frames, args.max_frames)
+
+    first = []
+    time_before = time.time()
+    on_line = lambda line: first.append(time.time()) if len(first) == 0 else None
+
+    status, body = await request(args, "POST", "/generate", {"num_frames": num_frames, "primer": primer}, on_line)
+    time_after = time.time()
+
+    last = json.loads(body.decode("utf-8").strip().split("\n")[-1])
+    ok = (status == 200 and "error" not in last)
+    results.append({
+        "ok": ok,
+        "num_frames": num_frames,
+        "latency": time_after - time_before,
+        "ttft": (first[0] - time_before) if first else None
+    })
+
+# run
+async def run(args):
+    rng = random.Random(args.seed)
+    results = []
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def limited():
+        async with slots:
+            await generation_client(args, rng, results)
+
+    time_before = time.time()
+    await asyncio.gather(*[limited() for _ in range(args.n_requests)])
+    took = time.time() - time_before
+
+    ok = [r for r in results if r["ok"]]
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    frames = sum(r["num_frames"] for r in ok)
+
+    print(SEPERATOR)
+    print("Requests:", len(results), "ok:", len(ok), "in", took, "s")
+    print("Throughput:", len(ok) / took, "requests / s,", frames / took, "frames / s")
+    if(len(ok) > 0):
+        print("Latency p50 / p90 / p99 (s):", *[float(np.percentile(latencies, p)) for p in (50, 90, 99)])
+        print("Time to first frames p50 / p90 / p99 (s):", *[float(np.percentile(ttfts, p)) for p in (50, 90, 99)])
+    print("")
+
+    _, body = await request(args, "GET", "/metrics")
+    print("Server metrics:")
+    for key, value in json.loads(body.decode("utf-8")).items():
+        print("   ", key + ":", value)
+    print(SEPERATOR)
+
+# main
+def main():
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Entry point. Sends synthetic concurrent generation requests to a running server.py and reports
+    client side latency next to the server metrics
+    ----------
+    """
+
+    args = parse_load_test_args()
+    print_load_test_args(args)
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import itertools
+import torch
+import torch.nn.functional as F
+
+from utilities.constants import *
+from utilities.device import get_device
+
+# Candidate frames per beam come from flipping subsets of at most this many of the least certain cells
+BEAM_MAX_FLIPS = 10
+
+# beam_search
+def beam_search(model, primers, target_seq_length=1024, beam_size=4, length_penalty=0.0, end_silence=None,
+                check_interval=16):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Batched beam search over piano-roll frames for a list of primers (each (primer_len, 84, 5),
+    lengths may differ). Returns a list of (sequence, score) with the best sequence for each primer
+    (primer included) and its length normalized log-likelihood.
+
+    A frame's log-likelihood is the sum over its independent Bernoulli cells. The most likely frame
+    sounds every cell with a positive logit and flipping a cell costs |logit|, so the beam_size best
+    frames of a beam are found exactly by enumerating flips of its beam_size - 1 least certain cells
+    (capped at BEAM_MAX_FLIPS).
+
+    Cumulative scores are kept in a (batch, beam) tensor and the attention cache is reordered in place
+    when beams are pruned. A hypothesis finishes at target_seq_length frames, or after end_silence
+    empty frames if given. Finished hypotheses are compared by score / ((5 + gen_len) / 6) ** length_penalty
+    (https://arxiv.org/abs/1609.08144). All selection is on device, only the early stopping check
+    every check_interval steps syncs with the host.
+    ----------
+    """
+
+    assert (not model.training), "Cannot generate while in training mode"
+    assert target_seq_length <= model.max_seq, "target_seq_length must not exceed max_sequence"
+    assert min(len(p) for p in primers) < target_seq_length, "Nothing to generate, primers reach target_seq_length"
+
+    device      = get_device()
+    n_batch     = len(primers)
+    n_beam      = beam_size
+    n_rows      = n_batch * n_beam
+    n_cells     = N_PITCHES * N_TRACKS
+    lengths     = torch.tensor([len(p) for p in primers], dtype=TORCH_LABEL_TYPE, device=device)
+    max_primer  = max(len(p) for p in primers)
+    max_steps   = target_seq_length - min(len(p) for p in primers)
+
+    print("Beam search over", n_batch, "primers with beam", n_beam, "and max length:", target_seq_length)
+
+    with torch.set_grad_enabled(False):
+        # Primers are prefilled once then copied to every beam
+        cache, y = model.prefill(primers, max_primer + max_steps)
+
+        expand = torch.arange(n_batch, device=device).repeat_interleave(n_beam)
+        cache.select(expand)
+        y = y.index_select(0, expand)
+
+        # Only the first beam is live at the start so the first step gives distinct hypotheses
+        scores = torch.full((n_batch, n_beam), float("-inf"), device=device)
+        scores[:, 0] = 0.0
+
+        n_flips = min(n_beam - 1, BEAM_MAX_FLIPS)
+        subsets = torch.tensor(list(itertools.product([False, True], repeat=n_flips)), dtype=torch.bool, device=device)
+        subsets = subsets.view(2 ** n_flips, n_flips)
+
+        beam_base   = (torch.arange(n_batch, device=device) * n_beam).unsqueeze(1)
+        gen_needed  = (target_seq_length - lengths).unsqueeze(1)
+        silence     = torch.zeros((n_batch, n_beam), dtype=TORCH_LABEL_TYPE, device=device)
+
+        best_score  = torch.full((n_batch,), float("-inf"), device=device)
+        best_step   = torch.zeros(n_batch, dtype=TORCH_LABEL_TYPE, device=device)
+        best_beam   = torch.zeros(n_batch, dtype=TORCH_LABEL_TYPE, device=device)
+
+        frame_hist  = []
+        parent_hist = []
+
+        for step in range(max_steps):
+            logits = y.reshape(n_rows, n_cells).float()
+
+            # Most likely frame of every beam and the cost of flipping each of its cells
+            best_frame  = logits > 0
+            best_logp   = F.logsigmoid(logits.abs()).sum(dim=-1)
+            cheap_cost, cheap_idx = logits.abs().topk(n_flips, dim=-1, largest=False)
+
+            cand_cost, cand_subset = torch.matmul(cheap_cost, subsets.type(cheap_cost.dtype).t()).topk(n_beam, dim=-1, largest=False)
+
+            cand_scores = scores.view(n_rows, 1) + best_logp.unsqueeze(1) - cand_cost
+            scores, flat_i = cand_scores.view(n_batch, n_beam * n_beam).topk(n_beam, dim=-1)
+
+            parent  = flat_i // n_beam
+            rows    = (beam_base + parent).view(-1)
+            cand    = flat_i.view(-1) % n_beam
+
+            # Build the chosen frames by flipping cells of the parent's most likely frame
+            flips   = subsets[cand_subset[rows, cand]]
+            cells   = cheap_idx[rows]
+            frames  = best_frame[rows]
+            frames.scatter_(1, cells, frames.gather(1, cells) ^ flips)
+
+            frame_hist.append(frames.view(n_batch, n_beam, n_cells))
+            parent_hist.append(parent)
+
+            # Finished hypotheses
+            gen_len = step + 1
+            silence = silence.gather(1, parent)
+            finished = (gen_len >= gen_needed).expand(n_batch, n_beam)
+            if(end_silence is not None):
+                silence = torch.where(frames.view(n_batch, n_beam, n_cells).any(dim=-1), torch.zeros_like(silence), silence + 1)
+                finished = finished | (silence >= end_silence)
+
+            normalized = scores / (((5.0 + gen_len) / 6.0) ** length_penalty)
+            normalized = normalized.masked_fill(~finished, float("-inf"))
+            step_best, step_beam = normalized.max(dim=-1)
+
+            improved    = step_best > best_score
+            best_score  = torch.where(improved, step_best, best_score)
+            best_step   = torch.where(improved, torch.full_like(best_step, step), best_step)
+            best_beam   = torch.where(improved, step_beam, best_beam)
+
+            scores = scores.masked_fill(finished, float("-inf"))
+
+            if(step + 1 == max_steps):
+                break
+            if((step + 1) % check_interval == 0 and bool(torch.isinf(scores).all())):
+                break
+
+            cache.reorder(rows)
+            y = model.forward_step(frames.view(n_rows, 1, N_PITCHES, N_TRACKS).type(TORCH_FLOAT), cache)[:, -1]
+
+    # Follow the back pointers from each primer's best finished hypothesis
+    last_step = int(best_step.max())
+    gen = torch.zeros((n_batch, last_step + 1, n_cells), dtype=torch.bool, device=device)
+    beam = best_beam.clone()
+    batch_idx = torch.arange(n_batch, device=device)
+    for step in range(last_step, -1, -1):
+        active = step <= best_step
+        gen[:, step] = frame_hist[step][batch_idx, beam]
+        beam = torch.where(active, parent_hist[step][batch_idx, beam], beam)
+
+    results = []
+    best_step = best_step.tolist()
+    best_score = best_score.tolist()
+    for i, primer in enumerate(primers):
+        gen_i = gen[i, :best_step[i] + 1].view(-1, N_PITCHES, N_TRACKS).type(TORCH_FLOAT)
+        sequence = torch.cat([primer.type(TORCH_FLOAT).to(device), gen_i], dim=0)
+        results.append((sequence, best_score[i]))
+
+    return results
@@ -0,0 +1,470 @@
+import torch
+
+from utilities.constants import *
+
+# AttentionCache
+class AttentionCache:
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Per-layer key/value cache used for incremental decoding.
+
+    Keys and values are kept in preallocated buffers of shape
+    (n_layers, batch_size, num_heads, max_len, head_dim) so adding a frame is an in-place write
+    instead of a concatenation. Every layer writes its new keys and values with update(), then the
+    model calls advance() once the whole stack has seen the new frames.
+
+    Rows of different lengths are left padded. offsets holds the number of padding frames at the
+    start of each row, which are masked out as keys and shift the row's absolute positions.
+    ----------
+    """
+
+    def __init__(self, n_layers, batch_size, num_heads, head_dim, max_len, device=None, dtype=TORCH_FLOAT, offsets=None):
+        self.n_layers   = n_layers
+        self.num_heads  = num_heads
+        self.head_dim   = head_dim
+        self.max_len    = max_len
+
+        shape = (n_layers, batch_size, num_heads, max_len, head_dim)
+        self.keys   = torch.zeros(shape, dtype=dtype, device=device)
+        self.values = torch.zeros(shape, dtype=dtype, device=device)
+
+        # Number of frames already written to every layer
+        self.length = 0
+
+        # Left padding per row. max_offset is a host-side bound so unpadded caches skip masking.
+        if(offsets is None):
+            self.offsets    = None
+            self.max_offset = 0
+        else:
+            self.offsets    = offsets.to(device=device, dtype=TORCH_LABEL_TYPE)
+            self.max_offset = int(self.offsets.max())
+
+    # batch_size
+    @property
+    def batch_size(self):
+        return self.keys.shape[1]
+
+    # position
+    @property
+    def position(self):
+        # Absolute position of the next frame (before any per-row padding offset)
+        return self.length
+
+    # prepare
+    def prepare(self, new_len):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Called by the model before new_len frames go through the layers. Nothing to do here, see
+        RollingAttentionCache.
+        ----------
+        """
+
+        return
+
+    # update
+    def update(self, layer_idx, k, v):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Writes the new keys and values (batch_size, num_heads, new_len, head_dim) for a layer and
+        returns views of all keys and values seen so far, including the new ones
+        ----------
+        """
+
+        start   = self.length
+        end     = start + k.shape[2]
+        assert end <= self.max_len, "AttentionCache is full, increase max_len"
+
+        self.keys[layer_idx, :, :, start:end]   = k
+        self.values[layer_idx, :, :, start:end] = v
+
+        return self.keys[layer_idx, :, :, :end], self.values[layer_idx, :, :, :end]
+
+    # advance
+    def advance(self, n_frames):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Marks n_frames new frames as written for every layer
+        ----------
+        """
+
+        self.length += n_frames
+
+    # truncate
+    def truncate(self, length):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Forgets every frame from length onwards, they are overwritten by the next update. Used by
+        speculative decoding to roll back rejected frames.
+        ----------
+        """
+
+        assert length <= self.length, "Can only truncate to a shorter length"
+        self.length = length
+
+    # positions
+    def positions(self, new_len):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Absolute positions (new_len, batch_size) of the next new_len frames of each row, or None
+        when no row is padded (positions are then simply length onwards)
+        ----------
+        """
+
+        if(self.offsets is None):
+            return None
+
+        slots = torch.arange(self.length, self.length + new_len, device=self.keys.device)
+        return (slots.unsqueeze(1) - self.offsets.unsqueeze(0)).clamp_(min=0)
+
+    # attention_mask
+    def attention_mask(self, new_len):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Additive mask for new_len queries attending to the cached keys plus themselves. Has shape
+        (new_len, length + new_len), or (batch_size, 1, new_len, length + new_len) when rows are
+        padded. Padding queries may attend to themselves so their softmax stays finite. Returns None
+        when nothing needs masking.
+        ----------
+        """
+
+        has_padding = self.max_offset > 0
+        if(new_len == 1 and not has_padding):
+            return None
+
+        total   = self.length + new_len
+        q_pos   = torch.arange(self.length, total, device=self.keys.device).unsqueeze(1)
+        k_pos   = torch.arange(total, device=self.keys.device).unsqueeze(0)
+
+        masked = k_pos > q_pos
+        if(has_padding):
+            padded = k_pos.unsqueeze(0) < self.offsets.view(-1, 1, 1)
+            masked = masked.unsqueeze(0) | (padded & (k_pos != q_pos).unsqueeze(0))
+            masked = masked.unsqueeze(1)
+
+        mask = torch.zeros(masked.shape, dtype=self.keys.dtype, device=self.keys.device)
+        mask.masked_fill_(masked, float("-inf"))
+
+        return mask
+
+    # reorder
+    def reorder(self, rows):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Reorders the cached keys and values in place so row i takes the state of row rows[i]. Used
+        by beam search when beams are pruned. Only the frames written so far are copied and rows
+        are expected to share their padding offset with the row they replace.
+        ----------
+        """
+
+        end = self.length
+        self.keys[:, :, :, :end]    = self.keys[:, :, :, :end].index_select(1, rows)
+        self.values[:, :, :, :end]  = self.values[:, :, :, :end].index_select(1, rows)
+
+    # select
+    def select(self, rows):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Keeps only the given batch rows (a 1D index tensor), in the given order. Used to compact away
+        finished rows. Leading frames that are padding for every remaining row are dropped.
+        ----------
+        """
+
+        self.keys   = self.keys.index_select(1, rows)
+        self.values = self.values.index_select(1, rows)
+
+        if(self.offsets is not None):
+            self.offsets = self.offsets.index_select(0, rows)
+
+            trim = min(int(self.offsets.min()), self.length)
+            if(trim > 0):
+                self.keys       = self.keys[:, :, :, trim:]
+                self.values     = self.values[:, :, :, trim:]
+                self.max_len    -= trim
+                self.length     -= trim
+                self.offsets    = self.offsets - trim
+
+            self.max_offset = int(self.offsets.max())
+
+    # merge
+    def merge(self, other, max_len):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Returns a new AttentionCache holding up to max_len frames with the rows of this cache followed
+        by the rows of other. Rows are right aligned so they all continue at the same slot, and the
+        shorter cache gets extra left padding. Used to add requests to a running batch.
+        ----------
+        """
+
+        length  = max(self.length, other.length)
+        shift_a = length - self.length
+        shift_b = length - other.length
+
+        device  = self.keys.device
+        offsets = torch.cat([_row_offsets(self, device) + shift_a, _row_offsets(other, device) + shift_b])
+
+        merged = AttentionCache(self.n_layers, offsets.shape[0], self.num_heads, self.head_dim, max_len,
+                                device=self.keys.device, dtype=self.keys.dtype, offsets=offsets)
+
+        n_a = self.batch_size
+        merged.keys[:, :n_a, :, shift_a:length]     = self.keys[:, :, :, :self.length]
+        merged.values[:, :n_a, :, shift_a:length]   = self.values[:, :, :, :self.length]
+        merged.keys[:, n_a:, :, shift_b:length]     = other.keys[:, :, :, :other.length]
+        merged.values[:, n_a:, :, shift_b:length]   = other.values[:, :, :, :other.length]
+        merged.length = length
+
+        return merged
+
+def _row_offsets(cache, device):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Left padding per row of cache as a tensor (zeros on device for an unpadded cache)
+    ----------
+    """
+
+    if(cache.offsets is None):
+        return torch.zeros(cache.batch_size, dtype=TORCH_LABEL_TYPE, device=device)
+
+    return cache.offsets
+
+# RollingAttentionCache
+class RollingAttentionCache(AttentionCache):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Fixed window attention cache for generating past max_sequence. Every frame attends to itself and
+    the window - 1 frames before it, so memory stays constant however long the piece gets.
+
+    Frames live in a buffer of 2 * window. When it fills up, the last window - 1 frames are moved
+    back to the front, so each frame is moved at most once (O(1) amortized eviction) and the kept
+    frames stay contiguous and in order. Relative positions inside the window are therefore the
+    same as for the plain cache. position keeps counting absolute frames for the positional encoding.
+    ----------
+    """
+
+    def __init__(self, n_layers, batch_size, num_heads, head_dim, window, device=None, dtype=TORCH_FLOAT):
+        super(RollingAttentionCache, self).__init__(n_layers, batch_size, num_heads, head_dim, 2 * window,
+                                                    device=device, dtype=dtype)
+
+        self.window = window
+        self.frames = 0
+
+    # position
+    @property
+    def position(self):
+        return self.frames
+
+    # prepare
+    def prepare(self, new_len):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Evicts frames that fell out of the window if the buffer can't hold new_len more frames
+        ----------
+        """
+
+        assert new_len <= self.window, "Can only add up to window frames at a time"
+
+        if(self.length + new_len > self.max_len):
+            keep = self.window - 1
+            src = self.length - keep
+
+            self.keys[:, :, :, :keep]   = self.keys[:, :, :, src:self.length].clone()
+            self.values[:, :, :, :keep] = self.values[:, :, :, src:self.length].clone()
+            self.length = keep
+
+    # update
+    def update(self, layer_idx, k, v):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Writes the new keys and values for a layer and returns the keys and values any of the new
+        frames can see
+        ----------
+        """
+
+        start   = self.length
+        end     = start + k.shape[2]
+        first   = max(0, start - self.window + 1)
+
+        self.keys[layer_idx, :, :, start:end]   = k
+        self.values[layer_idx, :, :, start:end] = v
+
+        return self.keys[layer_idx, :, :, first:end], self.values[layer_idx, :, :, first:end]
+
+    # advance
+    def advance(self, n_frames):
+        self.length += n_frames
+        self.frames += n_frames
+
+    # attention_mask
+    def attention_mask(self, new_len):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Additive mask for new_len queries that are causal and can't see further back than the window.
+        Returns None for a single query since update() already returns just its window.
+        ----------
+        """
+
+        if(new_len == 1):
+            return None
+
+        first   = max(0, self.length - self.window + 1)
+        total   = self.length + new_len
+        q_pos   = torch.arange(self.length, total, device=self.keys.device).unsqueeze(1)
+        k_pos   = torch.arange(first, total, device=self.keys.device).unsqueeze(0)
+
+        masked = (k_pos > q_pos) | (k_pos <= q_pos - self.window)
+
+        mask = torch.zeros(masked.shape, dtype=self.keys.dtype, device=self.keys.device)
+        mask.masked_fill_(masked, float("-inf"))
+
+        return mask
+
+    # select
+    def select(self, rows):
+        self.keys   = self.keys.index_select(1, rows)
+        self.values = self.values.index_select(1, rows)
+
+# LinearAttentionCache
+class LinearAttentionCache:
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Decoding state of a stack of LinearAttention layers. Per layer it holds the running sums of
+    phi(k) v^T (n_features, head_dim) and phi(k) (n_features) for every row and head, so memory
+    and the cost of a step stay constant however many frames came before. Same interface as
+    AttentionCache (positions, advance, reorder, select, merge) so the generation code works
+    with either.
+
+    Rows of different lengths are left padded. offsets holds the number of padding frames at the
+    start of each row, which are kept out of the state and shift the row's absolute positions.
+    The sums can't forget frames, so truncate() only works forwards.
+    ----------
+    """
+
+    def __init__(self, n_layers, batch_size, num_heads, n_features, head_dim, device=None, dtype=TORCH_FLOAT, offsets=None):
+        self.n_layers   = n_layers
+        self.num_heads  = num_heads
+        self.n_features = n_features
+        self.head_dim   = head_dim
+
+        self.states = torch.zeros((n_layers, batch_size, num_heads, n_features, head_dim), dtype=dtype, device=device)
+        self.norms  = torch.zeros((n_layers, batch_size, num_heads, n_features), dtype=dtype, device=device)
+
+        # Number of frames already added to every layer
+        self.length = 0
+
+        if(offsets is None):
+            self.offsets    = None
+            self.max_offset = 0
+        else:
+            self.offsets    = offsets.to(device=device, dtype=TORCH_LABEL_TYPE)
+            self.max_offset = int(self.offsets.max())
+
+    # batch_size
+    @property
+    def batch_size(self):
+        return self.states.shape[1]
+
+    # position
+    @property
+    def position(self):
+        return self.length
+
+    # prepare
+    def prepare(self, new_len):
+        return
+
+    # state
+    def state(self, layer_idx):
+        return self.states[layer_idx], self.norms[layer_idx]
+
+    # update
+    def update(self, layer_idx, state, norm):
+        self.states[layer_idx]  = state
+        self.norms[layer_idx]   = norm
+
+    # advance
+    def advance(self, n_frames):
+        self.length += n_frames
+
+    # truncate
+    def truncate(self, length):
+        assert length == self.length, "LinearAttentionCache can't roll back frames"
+
+    # positions
+    def positions(self, new_len):
+        # Same as AttentionCache.positions
+        if(self.offsets is None):
+            return None
+
+        slots = torch.arange(self.length, self.length + new_len, device=self.states.device)
+        return (slots.unsqueeze(1) - self.offsets.unsqueeze(0)).clamp_(min=0)
+
+    # reorder
+    def reorder(self, rows):
+        self.states = self.states.index_select(1, rows)
+        self.norms  = self.norms.index_select(1, rows)
+
+    # select
+    def select(self, rows):
+        self.reorder(rows)
+
+        if(self.offsets is not None):
+            self.offsets    = self.offsets.index_select(0, rows)
+            self.max_offset = int(self.offsets.max())
+
+    # merge
+    def merge(self, other, max_len=None):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Returns a new LinearAttentionCache with the rows of this cache followed by the rows of other,
+        continuing at the same slot like AttentionCache.merge. max_len is unused, the state does
+        not grow.
+        ----------
+        """
+
+        length  = max(self.length, other.length)
+        device  = self.states.device
+        offsets = torch.cat([_row_offsets(self, device) + length - self.length,
+                             _row_offsets(other, device) + length - other.length])
+
+        merged = LinearAttentionCache(self.n_layers, offsets.shape[0], self.num_heads, self.n_features, self.head_dim,
+                                      device=self.states.device, dtype=self.states.dtype, offsets=offsets)
+
+        merged.states   = torch.cat([self.states, other.states], dim=1)
+        merged.norms    = torch.cat([self.norms, other.norms], dim=1)
+        merged.length   = length
+
+        return merged
+
@@ -0,0 +1,218 @@
+import copy
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from typing import Tuple
+
+from utilities.constants import *
+
+from .rpr import _relative_logits
+
+# ExportedEncoderLayer
+class ExportedEncoderLayer(nn.Module):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    TorchScript friendly copy of one post-norm encoder layer (RPR or Pytorch's) for cached decoding.
+    Same math as encoder_layer_step, with the packed in_proj as an nn.Linear, no Optional
+    arguments and no data dependent Python checks.
+    ----------
+    """
+
+    def __init__(self, layer):
+        super(ExportedEncoderLayer, self).__init__()
+
+        attn = layer.self_attn
+        self.num_heads  = attn.num_heads
+        self.head_dim   = attn.embed_dim // attn.num_heads
+        self.scaling    = float(self.head_dim) ** -0.5
+
+        self.in_proj = nn.Linear(attn.embed_dim, 3 * attn.embed_dim)
+        self.in_proj.weight.data.copy_(attn.in_proj_weight.data)
+        self.in_proj.bias.data.copy_(attn.in_proj_bias.data)
+
+        self.out_proj = nn.Linear(attn.embed_dim, attn.embed_dim)
+        self.out_proj.load_state_dict(attn.out_proj.state_dict())
+
+        self.linear1    = copy.deepcopy(layer.linear1)
+        self.linear2    = copy.deepcopy(layer.linear2)
+        self.norm1      = copy.deepcopy(layer.norm1)
+        self.norm2      = copy.deepcopy(layer.norm2)
+        self.gelu       = getattr(layer, "activation", F.relu) is F.gelu
+
+        er = getattr(attn, "Er", None)
+        self.rpr = er is not None
+        if(self.rpr):
+            self.register_buffer("Er", er.detach().clone())
+        else:
+            self.register_buffer("Er", torch.zeros((1, self.head_dim)))
+
+    def forward(self, x, keys, values, start, attn_mask):
+        # type: (Tensor, Tensor, Tensor, int, Tensor) -> Tensor
+
+        tgt_len, bsz, embed_dim = x.size()
+        end = start + tgt_len
+
+        q, k, v = self.in_proj(x).chunk(3, dim=-1)
+        q = q * self.scaling
+
+        # (batch_size, num_heads, new_len, head_dim)
+        q = q.contiguous().view(tgt_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+        k = k.contiguous().view(tgt_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+        v = v.contiguous().view(tgt_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+
+        keys[:, :, start:end] = k
+        values[:, :, start:end] = v
+        k = keys[:, :, :end]
+        v = values[:, :, :end]
+
+        weights = torch.matmul(q, k.transpose(-2, -1)) + attn_mask
+        if(self.rpr):
+            weights = weights + _relative_logits(q, self.Er, end)
+
+        attn = torch.matmul(F.softmax(weights, dim=-1), v)
+        attn = self.out_proj(attn.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim))
+
+        x = self.norm1(x + attn)
+        if(self.gelu):
+            ff = self.linear2(F.gelu(self.linear1(x)))
+        else:
+            ff = self.linear2(F.relu(self.linear1(x)))
+
+        return self.norm2(x + ff)
+
+# ExportedMusicTransformer
+class ExportedMusicTransformer(nn.Module):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Inference only copy of a MusicTransformer (RPR or not) that compiles with torch.jit.script.
+    Saved with export_model, the file is self-contained: torch.jit.load gives a module that needs
+    none of this repo's code.
+
+    forward(x, keys, values, start) is one cached decoding step. x holds the new frames
+    (batch_size, new_len, 84, 5) that follow start frames already in the key / value buffers
+    (from init_state), which are updated in place. Returns the predictions (batch_size, new_len,
+    84, 5). generate() runs the whole sampling loop inside the compiled graph.
+
+    Frame sizes are constant attributes, TorchScript can't read module level Python ints.
+    ----------
+    """
+
+    __constants__ = ["n_pitches", "n_tracks", "n_cells"]
+
+    def __init__(self, model):
+        super(ExportedMusicTransformer, self).__init__()
+
+        self.n_layers   = model.nlayers
+        self.num_heads  = model.nhead
+        self.d_model    = model.d_model
+        self.max_seq    = model.max_seq
+
+        self.n_pitches  = N_PITCHES
+        self.n_tracks   = N_TRACKS
+        self.n_cells    = N_PITCHES * N_TRACKS
+
+        encoder = model.transformer.encoder
+        self.embedding  = copy.deepcopy(model.embedding)
+        self.layers     = nn.ModuleList([ExportedEncoderLayer(layer) for layer in encoder.layers])
+        self.norm       = copy.deepcopy(encoder.norm)
+        self.Wout       = copy.deepcopy(model.Wout)
+
+        self.register_buffer("pe", model.positional_encoding.pe[:, 0, :].detach().clone())
+
+    @torch.jit.export
+    def init_state(self, batch_size, max_len):
+        # type: (int, int) -> Tuple[Tensor, Tensor]
+        shape = [self.n_layers, batch_size, self.num_heads, max_len, self.d_model // self.num_heads]
+        keys = torch.zeros(shape, dtype=self.pe.dtype, device=self.pe.device)
+        values = torch.zeros(shape, dtype=self.pe.dtype, device=self.pe.device)
+        return keys, values
+
+    @torch.jit.export
+    def positional_encoding(self, start, length):
+        # type: (int, int) -> Tensor
+        if(start + length <= self.pe.shape[0]):
+            return self.pe[start:start + length]
+
+        # Past max_sequence, same sinusoids as PositionalEncoding.encode
+        position = torch.arange(start, start + length, device=self.pe.device).float().unsqueeze(1)
+        div_term = torch.exp(torch.arange(0, self.d_model, 2, device=self.pe.device).float() * (-math.log(10000.0) / self.d_model))
+
+        pe = torch.zeros((length, self.d_model), device=self.pe.device)
+        pe[:, 0::2] = torch.sin(position * div_term)
+        pe[:, 1::2] = torch.cos(position * div_term)
+        return pe
+
+    def forward(self, x, keys, values, start):
+        # type: (Tensor, Tensor, Tensor, int) -> Tensor
+
+        bsz = x.shape[0]
+        tgt_len = x.shape[1]
+        end = start + tgt_len
+
+        h = self.embedding(x.reshape(bsz, tgt_len, self.n_cells)).permute(1, 0, 2)
+        h = h + self.positional_encoding(start, tgt_len).unsqueeze(1)
+
+        q_pos = torch.arange(start, end, device=x.device).unsqueeze(1)
+        k_pos = torch.arange(end, device=x.device).unsqueeze(0)
+        attn_mask = torch.zeros((tgt_len, end), dtype=h.dtype, device=x.device)
+        attn_mask = attn_mask.masked_fill(k_pos > q_pos, float("-inf"))
+
+        i = 0
+        for layer in self.layers:
+            h = layer(h, keys[i], values[i], start, attn_mask)
+            i += 1
+
+        h = self.norm(h).permute(1, 0, 2)
+        y = self.Wout(h)
+
+        return y.view(bsz, tgt_len, self.n_pitches, self.n_tracks)
+
+    @torch.jit.export
+    def generate(self, primer, num_frames, temperature):
+        # type: (Tensor, int, float) -> Tensor
+        # Samples num_frames Bernoulli frames after primer (primer_len, 84, 5) and returns them
+        keys, values = self.init_state(1, primer.shape[0] + num_frames)
+
+        y = self.forward(primer.unsqueeze(0), keys, values, 0)[:, -1]
+        start = primer.shape[0]
+
+        frames = torch.zeros((num_frames, self.n_pitches, self.n_tracks), dtype=y.dtype, device=y.device)
+        for i in range(num_frames):
+            probs = torch.sigmoid(y / temperature)
+            frame = (torch.rand_like(probs) < probs).to(y.dtype)
+            frames[i] = frame[0]
+
+            if(i + 1 < num_frames):
+                y = self.forward(frame.unsqueeze(1), keys, values, start)[:, -1]
+                start += 1
+
+        return frames
+
+# export_model
+def export_model(model, file_path=None):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Compiles a MusicTransformer (in eval mode) to TorchScript and saves it to file_path if given.
+    Returns the scripted module. Load it with torch.jit.load.
+    ----------
+    """
+
+    assert (not model.training), "Can only export a model in eval mode"
+    assert (not model.quantized), "Export the fp32 model"
+    assert model.attention == "full", "Only softmax attention models can be exported"
+    assert all(getattr(layer.self_attn, "pattern", None) is None for layer in model.transformer.encoder.layers), "Attention patterns can't be exported"
+
+    exported = ExportedMusicTransformer(model).eval()
+    scripted = torch.jit.script(exported)
+
+    if(file_path is not None):
+        scripted.save(file_path)
+
+    return scripted
@@ -0,0 +1,238 @@
+import math
+import torch
+import torch.nn.functional as F
+from torch.nn import Module
+from torch.nn.modules.linear import Linear
+from torch.nn.modules.dropout import Dropout
+from torch.nn.modules.normalization import LayerNorm
+from torch.nn.init import xavier_uniform_, constant_
+from torch.utils.checkpoint import checkpoint
+
+from utilities.constants import *
+
+from .rpr import chunked_feedforward
+
+# Guards the normalizer of queries that see no keys (left padding)
+LINEAR_ATTENTION_EPS = 1e-6
+
+# TransformerEncoderLayerLinear
+class TransformerEncoderLayerLinear(Module):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Post-norm encoder layer with LinearAttention in place of softmax attention. Same submodules as
+    TransformerEncoderLayerRPR, so it stacks in TransformerEncoderRPR and runs through
+    encoder_layer_step for cached decoding.
+    ----------
+    """
+
+    def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1, feature_map="elu"):
+        super(TransformerEncoderLayerLinear, self).__init__()
+        self.checkpoint_attn = False
+        self.ff_chunk_size = None
+        self.self_attn = LinearAttention(d_model, nhead, feature_map=feature_map)
+        # Implementation of Feedforward model
+        self.linear1 = Linear(d_model, dim_feedforward)
+        self.dropout = Dropout(dropout)
+        self.linear2 = Linear(dim_feedforward, d_model)
+
+        self.norm1 = LayerNorm(d_model)
+        self.norm2 = LayerNorm(d_model)
+        self.dropout1 = Dropout(dropout)
+        self.dropout2 = Dropout(dropout)
+
+    def forward(self, src, src_mask=None, src_key_padding_mask=None, is_causal=False):
+        if(self.checkpoint_attn and self.training and torch.is_grad_enabled()):
+            src2 = checkpoint(self._attention_block, src, src_mask, src_key_padding_mask, is_causal, use_reentrant=False)
+        else:
+            src2 = self._attention_block(src, src_mask, src_key_padding_mask, is_causal)
+        src = src + src2
+        src = self.norm1(src)
+        src2 = chunked_feedforward(self, src, self.ff_chunk_size)
+        src = src + self.dropout2(src2)
+        src = self.norm2(src)
+        return src
+
+    def _attention_block(self, src, src_mask, src_key_padding_mask, is_causal=False):
+        src2 = self.self_attn(src, attn_mask=src_mask, key_padding_mask=src_key_padding_mask, is_causal=is_causal)[0]
+        return self.dropout1(src2)
+
+# LinearAttention
+class LinearAttention(Module):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Kernelized linear attention (https://arxiv.org/abs/2006.16236). softmax(q k^T) is replaced by
+    phi(q) phi(k)^T with a positive feature map phi:
+        elu:    elu(x) + 1
+        favor:  Positive random features exp(w x - |x|^2 / 2) (https://arxiv.org/abs/2009.14794),
+                an unbiased estimate of the softmax kernel. n_features fixed random projections.
+
+    Causal attention is a prefix sum over phi(k) v^T, computed chunk_size frames at a time: O(L)
+    time and memory in training, and in decoding a (features, head_dim) state per head that
+    step() updates in O(1) per frame, whatever the length (see LinearAttentionCache).
+
+    attn_mask is taken to be the causal mask (the only mask MusicTransformer uses), as is
+    is_causal, no attn_mask gives bidirectional attention. There are no attention weights to
+    drop out, so there is no dropout argument: TransformerEncoderLayerLinear applies its dropout
+    to the attention output.
+    ----------
+    """
+
+    def __init__(self, embed_dim, num_heads, feature_map="elu", n_features=None, chunk_size=64):
+        super(LinearAttention, self).__init__()
+        assert feature_map in FEATURE_MAPS, "Unknown feature map " + str(feature_map)
+
+        self.embed_dim      = embed_dim
+        self.num_heads      = num_heads
+        self.head_dim       = embed_dim // num_heads
+        self.feature_map    = feature_map
+        self.chunk_size     = chunk_size
+        assert self.head_dim * num_heads == self.embed_dim, "embed_dim must be divisible by num_heads"
+
+        self.in_proj    = Linear(embed_dim, 3 * embed_dim)
+        self.out_proj   = Linear(embed_dim, embed_dim)
+
+        xavier_uniform_(self.in_proj.weight)
+        constant_(self.in_proj.bias, 0.)
+        constant_(self.out_proj.bias, 0.)
+
+        if(feature_map == "favor"):
+            if(n_features is None):
+                n_features = 2 * self.head_dim
+            self.register_buffer("omega", _orthogonal_gaussian(n_features, self.head_dim))
+            self.n_features = n_features
+        else:
+            self.omega = None
+            self.n_features = self.head_dim
+
+    def forward(self, query, key=None, value=None, key_padding_mask=None, need_weights=False, attn_mask=None, is_causal=False):
+        # key and value are accepted for MultiheadAttention compatibility, query is always used
+
+        tgt_len, bsz, embed_dim = query.size()
+        q_f, k_f, v = self._project(query)
+
+        if key_padding_mask is not None:
+            k_f = k_f.masked_fill(key_padding_mask.view(bsz, 1, tgt_len, 1), 0.0)
+
+        if attn_mask is not None or is_causal:
+            attn_output, _, _ = causal_linear_attention(q_f, k_f, v, chunk_size=self.chunk_size)
+        else:
+            kv = torch.matmul(k_f.transpose(-2, -1), v)
+            num = torch.matmul(q_f, kv)
+            den = torch.matmul(q_f, k_f.sum(dim=2).unsqueeze(-1))
+            attn_output = num.type(TORCH_FLOAT) / (den.type(TORCH_FLOAT) + LINEAR_ATTENTION_EPS)
+
+        attn_output = attn_output.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)
+        return self.out_proj(attn_output), None
+
+    # step
+    def step(self, query, cache, layer_idx):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Causal attention for the new frames in query (new_len, batch_size, embed_dim) continuing
+        from the state held in cache (a LinearAttentionCache), which is updated. Left padding of
+        the cache's rows is kept out of the state.
+        ----------
+        """
+
+        tgt_len, bsz, embed_dim = query.size()
+        q_f, k_f, v = self._project(query)
+
+        if(cache.offsets is not None):
+            slots = torch.arange(cache.length, cache.length + tgt_len, device=query.device)
+            padded = slots.unsqueeze(0) < cache.offsets.unsqueeze(1)
+            k_f = k_f.masked_fill(padded.view(bsz, 1, tgt_len, 1), 0.0)
+
+        state, norm = cache.state(layer_idx)
+        attn_output, state, norm = causal_linear_attention(q_f, k_f, v, state, norm, self.chunk_size)
+        cache.update(layer_idx, state, norm)
+
+        attn_output = attn_output.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)
+        return self.out_proj(attn_output)
+
+    def _project(self, query):
+        # Feature mapped queries and keys (batch_size, num_heads, seq_len, n_features) and values
+        tgt_len, bsz, embed_dim = query.size()
+
+        q, k, v = self.in_proj(query).chunk(3, dim=-1)
+
+        q = q.contiguous().view(tgt_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+        k = k.contiguous().view(tgt_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+        v = v.contiguous().view(tgt_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+
+        return self._features(q), self._features(k), v
+
+    def _features(self, x):
+        if(self.omega is None):
+            return F.elu(x) + 1.0
+
+        # Softmax kernel exp(q k / sqrt(d)): scale both sides by d^-1/4
+        x = x * (float(self.head_dim) ** -0.25)
+        proj = torch.matmul(x, self.omega.transpose(0, 1))
+        sq_norm = 0.5 * (x * x).sum(dim=-1, keepdim=True)
+        return torch.exp(proj - sq_norm) / math.sqrt(self.n_features)
+
+# causal_linear_attention
+def causal_linear_attention(q_f, k_f, v, state=None, norm=None, chunk_size=64):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Causal linear attention of feature mapped queries and keys q_f, k_f
+    (batch_size, num_heads, seq_len, n_features) over values v (batch_size, num_heads, seq_len,
+    head_dim), continuing from state (sum of phi(k) v^T, (batch_size, num_heads, n_features,
+    head_dim)) and norm (sum of phi(k), (batch_size, num_heads, n_features)) if given.
+
+    Within a chunk the causal part is a small (chunk_size, chunk_size) product, earlier chunks
+    come from the running state, so nothing O(seq_len^2) or O(seq_len * n_features * head_dim)
+    is ever held. Returns the output and the final state and norm.
+
+    The state, norm and normalization stay in TORCH_FLOAT under bf16 autocast, only the products
+    run in bf16.
+    ----------
+    """
+
+    bsz, num_heads, seq_len, n_features = q_f.shape
+
+    if(state is None):
+        state = torch.zeros((bsz, num_heads, n_features, v.shape[-1]), dtype=TORCH_FLOAT, device=q_f.device)
+        norm = torch.zeros((bsz, num_heads, n_features), dtype=TORCH_FLOAT, device=q_f.device)
+
+    outputs = []
+    for start in range(0, seq_len, chunk_size):
+        end = min(start + chunk_size, seq_len)
+        q_c, k_c, v_c = q_f[:, :, start:end], k_f[:, :, start:end], v[:, :, start:end]
+
+        scores = torch.matmul(q_c, k_c.transpose(-2, -1)).tril()
+
+        num = torch.matmul(q_c, state) + torch.matmul(scores, v_c)
+        den = torch.matmul(q_c, norm.unsqueeze(-1)) + scores.sum(dim=-1, keepdim=True)
+        outputs.append(num.type(TORCH_FLOAT) / (den.type(TORCH_FLOAT) + LINEAR_ATTENTION_EPS))
+
+        state = state + torch.matmul(k_c.transpose(-2, -1), v_c)
+        norm = norm + k_c.sum(dim=2)
+
+    return torch.cat(outputs, dim=2), state, norm
+
+def _orthogonal_gaussian(n_features, dim):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    (n_features, dim) random projection with orthogonal rows in blocks of dim, scaled to the
+    norms of gaussian rows. Lowers the variance of the random feature estimate.
+    ----------
+    """
+
+    blocks = []
+    for _ in range(0, n_features, dim):
+        q, _ = torch.linalg.qr(torch.randn((dim, dim)))
+        blocks.append(q.transpose(0, 1))
+
+    omega = torch.cat(blocks, dim=0)[:n_features]
+    return omega * torch.randn((n_features, dim)).norm(dim=1, keepdim=True)
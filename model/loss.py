@@ -2,6 +2,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.modules.loss import _Loss
+from torch.utils.checkpoint import checkpoint
+
+from utilities.constants import *
 
 # Borrowed from https://github.com/jason9693/MusicTransformer-pytorch/blob/5f183374833ff6b7e17f3a24e3594dedd93a5fe5/custom/criterion.py#L28
 class SmoothCrossEntropyLoss(_Loss):
@@ -26,16 +29,23 @@ class SmoothCrossEntropyLoss(_Loss):
             target: [B * T]
         Returns:
             cross entropy: [1]
+
+        Fused: with q' = (1 - e) * one_hot + e / V, the cross entropy is
+        (1 - e) * (lse - input[target]) + e * (lse - mean(input)), so only a gather and a
+        logsumexp are needed and no [B * T, V] temporaries are made.
         """
-        mask = (target == self.ignore_index).unsqueeze(-1)
-        q = F.one_hot(target.long(), self.vocab_sizes).type(torch.float32)
-        u = 1.0 / self.vocab_sizes
-        q_prime = (1.0 - self.label_smoothing) * q + self.label_smoothing * u
-        q_prime = q_prime.masked_fill(mask, 0)
+        valid = target != self.ignore_index
+        index = target.long().masked_fill(~valid, 0).unsqueeze(-1)
+
+        lse = input.logsumexp(dim=-1)
+        nll = lse - input.gather(-1, index).squeeze(-1)
+        uniform = lse - input.mean(dim=-1)
+
+        ce = (1.0 - self.label_smoothing) * nll + self.label_smoothing * uniform
+        ce = ce.masked_fill(~valid, 0.0)
 
-        ce = self.cross_entropy_with_logits(q_prime, input)
         if self.reduction == 'mean':
-            lengths = torch.sum(target != self.ignore_index)
+            lengths = torch.sum(valid)
             return ce.sum() / lengths
         elif self.reduction == 'sum':
             return ce.sum()
@@ -44,3 +54,96 @@ class SmoothCrossEntropyLoss(_Loss):
 
     def cross_entropy_with_logits(self, p, q):
         return -torch.sum(p * (q - q.logsumexp(dim=-1, keepdim=True)), dim=-1)
+
+# SmoothBCEWithLogitsLoss
+class SmoothBCEWithLogitsLoss(_Loss):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Label smoothed, pad masked binary cross entropy for the piano-roll head. Every cell target t
+    becomes t * (1 - label_smoothing) + label_smoothing / 2. Target cells equal to ignore_index
+    (padding frames) don't count, the mean is over the remaining cells.
+
+    The smoothed target is built in place in a single target sized buffer and the padding goes in
+    as the weight of binary_cross_entropy_with_logits, so no other logits sized temporaries are
+    made. forward takes an optional reduction override, which lets chunked_head_loss sum chunks
+    with it.
+    ----------
+    """
+
+    __constants__ = ['label_smoothing', 'ignore_index', 'reduction']
+
+    def __init__(self, label_smoothing=0.0, ignore_index=-100, reduction='mean'):
+        assert 0.0 <= label_smoothing <= 1.0
+        super().__init__(reduction=reduction)
+
+        self.label_smoothing = label_smoothing
+        self.ignore_index = ignore_index
+
+    def forward(self, input, target, reduction=None):
+        return smooth_bce_with_logits(input, target, self.label_smoothing, self.ignore_index,
+                                      self.reduction if reduction is None else reduction)
+
+# smooth_bce_with_logits
+def smooth_bce_with_logits(input, target, label_smoothing=0.0, ignore_index=-100, reduction="mean"):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Functional SmoothBCEWithLogitsLoss. reduction is "mean" (over non padding cells) or "sum".
+    ----------
+    """
+
+    valid = target != ignore_index
+    smoothed = target.type(input.dtype).masked_fill(~valid, 0.0).mul_(1.0 - label_smoothing).add_(0.5 * label_smoothing)
+
+    total = F.binary_cross_entropy_with_logits(input, smoothed, weight=valid.type(input.dtype), reduction="sum")
+
+    if(reduction == "mean"):
+        return total / valid.sum()
+    elif(reduction == "sum"):
+        return total
+    else:
+        raise NotImplementedError
+
+# chunked_head_loss
+def chunked_head_loss(hidden, head, target, chunk_size, loss_func=None, ignore_index=None):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Fused output head and loss. hidden (batch_size, seq_len, d_model) goes through head (the
+    model's Wout) and loss_func chunk_size positions at a time, so the (batch_size, seq_len, 84, 5)
+    logits never exist at once. In training each chunk is checkpointed: backward recomputes one
+    chunk's logits at a time instead of keeping them all.
+
+    loss_func(logits, target, reduction="sum") gives the summed loss of a chunk (default binary
+    cross entropy with logits). Returns the mean over all target cells, same as the unchunked
+    loss with reduction "mean". With ignore_index, cells equal to it are left out of the mean
+    (pair with SmoothBCEWithLogitsLoss).
+    ----------
+    """
+
+    if(loss_func is None):
+        loss_func = F.binary_cross_entropy_with_logits
+
+    def chunk_loss(h, t):
+        logits = head(h).view(t.shape).type(TORCH_FLOAT)
+        return loss_func(logits, t, reduction="sum")
+
+    use_checkpoint = torch.is_grad_enabled() and hidden.requires_grad
+
+    total = 0.0
+    for start in range(0, hidden.shape[1], chunk_size):
+        h = hidden[:, start:start + chunk_size]
+        t = target[:, start:start + chunk_size]
+        if(use_checkpoint):
+            total = total + checkpoint(chunk_loss, h, t, use_reentrant=False)
+        else:
+            total = total + chunk_loss(h, t)
+
+    if(ignore_index is None):
+        return total / target.numel()
+
+    return total / (target != ignore_index).sum()
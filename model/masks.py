@@ -0,0 +1,92 @@
+import torch
+
+from utilities.constants import *
+
+# MaskRegistry
+class MaskRegistry:
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Causal masks and relative distance indices shared by every layer of a model.
+
+    Each is built once per device as a (len, len) table and handed out as views, so a forward
+    pass allocates no O(L^2) masks:
+        causal_mask:    Additive mask, -inf where a key is after its query.
+        distances:      Query / key distance as int32, clamped at 0 for future keys. Used as the
+                        gather index of _relative_logits, replacing the skew.
+    Both depend only on the absolute query and key positions, so the tables for every length
+    are slices of the largest one.
+
+    Only square (full attention) requests up to max_len grow a table, to the length asked for.
+    Other requests are served from the table if it covers them, else built at their own
+    (len_q, len_k) size and not kept: blockwise and cached decoding calls, and anything longer
+    than max_len, never pin an O(L^2) table.
+
+    stats counts the views served and the bytes that would have been allocated without the
+    registry.
+    ----------
+    """
+
+    def __init__(self, max_len):
+        self.max_len    = max_len
+        self._causal    = {}
+        self._distances = {}
+        self.reset_stats()
+
+    # reset_stats
+    def reset_stats(self):
+        self.stats = {"views": 0, "bytes_saved": 0}
+
+    # causal_mask
+    def causal_mask(self, len_q, len_k, device):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Additive causal mask (len_q, len_k) for the last len_q queries of a length len_k sequence
+        ----------
+        """
+
+        return self._get(self._causal, len_q, len_k, device, _build_causal)
+
+    # distances
+    def distances(self, len_q, len_k, device):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Distances (len_q, len_k) between the last len_q queries of a length len_k sequence and every
+        key, clamped at 0 for keys after the query
+        ----------
+        """
+
+        return self._get(self._distances, len_q, len_k, device, _build_distances)
+
+    def _get(self, tables, len_q, len_k, device, build):
+        key = str(device)
+        table = tables.get(key)
+
+        if(table is None or table.shape[0] < len_k):
+            if(len_q != len_k or len_k > self.max_len):
+                return build(len_q, len_k, device)
+
+            table = build(len_k, len_k, device)
+            tables[key] = table
+
+        self.stats["views"] += 1
+        self.stats["bytes_saved"] += len_q * len_k * table.element_size()
+        return table[len_k - len_q:len_k, :len_k]
+
+def _build_causal(len_q, len_k, device):
+    mask = torch.zeros((len_q, len_k), dtype=TORCH_FLOAT, device=device)
+    return mask.masked_fill_(_build_distances(len_q, len_k, device, clamp=False) < 0, float("-inf"))
+
+def _build_distances(len_q, len_k, device, clamp=True):
+    # Distances of the last len_q queries of a length len_k sequence
+    q_pos = torch.arange(len_k - len_q, len_k, dtype=torch.int32, device=device)
+    k_pos = torch.arange(len_k, dtype=torch.int32, device=device)
+    distances = q_pos.unsqueeze(1) - k_pos.unsqueeze(0)
+    if(clamp):
+        distances.clamp_(min=0)
+    return distances
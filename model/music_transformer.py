@@ -1,13 +1,19 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn.modules.normalization import LayerNorm
-import random
 
 from utilities.constants import *
 from utilities.device import get_device
+from utilities.piano_roll import is_active
 
 from .positional_encoding import PositionalEncoding
-from .rpr import TransformerEncoderRPR, TransformerEncoderLayerRPR
+from .masks import MaskRegistry
+from .rpr import TransformerEncoderRPR, TransformerEncoderLayerRPR, encoder_layer_step
+from .cache import AttentionCache, RollingAttentionCache, LinearAttentionCache
+from .linear_attention import TransformerEncoderLayerLinear
+from .sampling import PianoRollSampler
+from .beam_search import beam_search
 
 
 # MusicTransformer
@@ -24,12 +30,25 @@ class MusicTransformer(nn.Module):
     make a decoder-only transformer architecture
 
     For RPR support, there is modified Pytorch 1.2.0 code in rpr.py. Modified source will be
-    kept up to date with Pytorch revisions only as necessary.
+    kept up to date with Pytorch revisions only as necessary. attn_block_size switches RPR
+    attention to the memory efficient blockwise version (see blockwise_attention_rpr).
+    checkpoint and checkpoint_every set activation checkpointing of the RPR encoder in training
+    (see TransformerEncoderRPR.set_checkpoint). attn_pattern (an AttentionPattern) makes RPR
+    attention block-sparse, in training and generation alike.
+
+    attention="linear" swaps every encoder layer for TransformerEncoderLayerLinear (kernelized
+    linear attention with the given feature_map, no RPR). Training is then O(L) and generation
+    keeps a constant size state (LinearAttentionCache), so it is not bound to max_sequence.
+
+    ff_chunk_size runs the feedforward of custom (RPR or linear) layers in sequence chunks (see
+    chunked_feedforward). With forward_hidden and chunked_head_loss the output head is chunked too.
     ----------
     """
 
     def __init__(self, n_layers=6, num_heads=8, d_model=512, dim_feedforward=1024,
-                 dropout=0.1, max_sequence=2048, rpr=False):
+                 dropout=0.1, max_sequence=2048, rpr=False, attn_block_size=None,
+                 checkpoint=None, checkpoint_every=1, attn_pattern=None, attention="full", feature_map="elu",
+                 ff_chunk_size=None):
         super(MusicTransformer, self).__init__()
 
         self.dummy      = DummyDecoder()
@@ -41,6 +60,10 @@ class MusicTransformer(nn.Module):
         self.dropout    = dropout
         self.max_seq    = max_sequence
         self.rpr        = rpr
+        self.attention  = attention
+
+        # Set by quantize_dynamic_int8, attention then always goes through the cached path
+        self.quantized  = False
 
         # Input embedding
         # self.embedding = nn.Embedding(VOCAB_SIZE, self.d_model)
@@ -49,8 +72,24 @@ class MusicTransformer(nn.Module):
         # Positional encoding
         self.positional_encoding = PositionalEncoding(self.d_model, self.dropout, self.max_seq)
 
+        assert attention in ATTENTION_TYPES, "Unknown attention " + str(attention)
+        assert not (self.rpr and attention == "linear"), "Linear attention has no RPR"
+        assert self.rpr or attention == "linear" or checkpoint is None, "Activation checkpointing needs rpr or linear attention"
+        assert self.rpr or attn_pattern is None, "Attention patterns need rpr"
+        assert self.rpr or attention == "linear" or ff_chunk_size is None, "Chunked feedforward needs rpr or linear attention"
+
         # Base transformer
-        if(not self.rpr):
+        if(attention == "linear"):
+            encoder_norm = LayerNorm(self.d_model)
+            encoder_layer = TransformerEncoderLayerLinear(self.d_model, self.nhead, self.d_ff, self.dropout, feature_map=feature_map)
+            encoder = TransformerEncoderRPR(encoder_layer, self.nlayers, encoder_norm,
+                                            checkpoint=checkpoint, checkpoint_every=checkpoint_every)
+            self.transformer = nn.Transformer(
+                d_model=self.d_model, nhead=self.nhead, num_encoder_layers=self.nlayers,
+                num_decoder_layers=0, dropout=self.dropout, # activation=self.ff_activ,
+                dim_feedforward=self.d_ff, custom_decoder=self.dummy, custom_encoder=encoder
+            )
+        elif(not self.rpr):
             # To make a decoder-only transformer we need to use masked encoder layers
             # Dummy decoder to essentially just return the encoder output
             self.transformer = nn.Transformer(
@@ -61,8 +100,10 @@ class MusicTransformer(nn.Module):
         # RPR Transformer
         else:
             encoder_norm = LayerNorm(self.d_model)
-            encoder_layer = TransformerEncoderLayerRPR(self.d_model, self.nhead, self.d_ff, self.dropout, er_len=self.max_seq)
-            encoder = TransformerEncoderRPR(encoder_layer, self.nlayers, encoder_norm)
+            encoder_layer = TransformerEncoderLayerRPR(self.d_model, self.nhead, self.d_ff, self.dropout, er_len=self.max_seq,
+                                                       block_size=attn_block_size)
+            encoder = TransformerEncoderRPR(encoder_layer, self.nlayers, encoder_norm,
+                                            checkpoint=checkpoint, checkpoint_every=checkpoint_every)
             self.transformer = nn.Transformer(
                 d_model=self.d_model, nhead=self.nhead, num_encoder_layers=self.nlayers,
                 num_decoder_layers=0, dropout=self.dropout, # activation=self.ff_activ,
@@ -73,6 +114,20 @@ class MusicTransformer(nn.Module):
         self.Wout       = nn.Linear(self.d_model, 84 * 5)
         self.softmax    = nn.Softmax(dim=-1)
 
+        # Linear, blockwise and block-sparse attention are causal by construction and take a flag
+        # instead of an (L, L) mask
+        self.causal_flag = (attention == "linear" or attn_pattern is not None or attn_block_size is not None)
+        self.attn_pattern = attn_pattern
+
+        # Causal masks and relative distances shared by every layer and every call
+        self.masks = MaskRegistry(self.max_seq)
+        for layer in self.transformer.encoder.layers:
+            if(hasattr(layer, "ff_chunk_size")):
+                layer.ff_chunk_size = ff_chunk_size
+            if(hasattr(layer.self_attn, "masks")):
+                layer.self_attn.masks = self.masks
+                layer.self_attn.pattern = attn_pattern
+
     # forward
     def forward(self, x, mask=True):
         """
@@ -85,13 +140,38 @@ class MusicTransformer(nn.Module):
         ----------
         """
 
-        if(mask is True):
-            mask = self.transformer.generate_square_subsequent_mask(x.shape[1]).to(get_device())
+        if(self.quantized):
+            assert mask is True, "Quantized models only support masked forward"
+            return self.forward_step(x, self.init_cache(x.shape[0], x.shape[1]))
+
+        x_out = self.forward_hidden(x, mask)
+
+        y = self.Wout(x_out)
+        # y = self.softmax(y)
+        y = y.view(y.shape[0], y.shape[1], 84, 5)
+
+        # They are trained to predict the next note in sequence (we don't need the last one)
+        return y
+
+    # forward_hidden
+    def forward_hidden(self, x, mask=True):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Final hidden states (batch_size, seq_len, d_model) of forward(), before the output head
+        Wout. Used with chunked_head_loss to train without materializing the full logits. Like
+        forward(), takes dense or sparse active-note frames (see embed).
+        ----------
+        """
+
+        is_causal = (mask is True and self.causal_flag)
+        if(mask is True and not is_causal):
+            mask = self.masks.causal_mask(x.shape[1], x.shape[1], x.device)
         else:
             mask = None
 
-        x = x.view(x.shape[0], x.shape[1], -1)
-        x = self.embedding(x)
+        x = self.embed(x)
 
         # Input shape is (max_seq, batch_size, d_model)
         x = x.permute(1,0,2)
@@ -100,81 +180,405 @@ class MusicTransformer(nn.Module):
 
         # Since there are no true decoder layers, the tgt is unused
         # Pytorch wants src and tgt to have some equal dims however
-        x_out = self.transformer(src=x, tgt=x, src_mask=mask)
+        if(is_causal):
+            # Straight to the encoder, older nn.Transformer does not pass the flag on. The dummy
+            # decoder would only return its output.
+            x_out = self.transformer.encoder(x, is_causal=True)
+        else:
+            x_out = self.transformer(src=x, tgt=x, src_mask=mask)
 
         # Back to (batch_size, max_seq, d_model)
-        x_out = x_out.permute(1,0,2)
+        return x_out.permute(1,0,2)
+
+    # embed
+    def embed(self, x):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Input embedding (batch_size, seq_len, d_model) of frames x, either dense (batch_size,
+        seq_len, 84, 5) or sparse active-note frames (batch_size, seq_len, max_active) of cell
+        indices padded with ACTIVE_PAD (see frames_to_active).
+
+        Sparse frames skip the dense product: the embedding is an EmbeddingBag sum of the weight
+        columns of the active cells plus the bias, the same as the Linear layer on the dense
+        frame, with the same weights. Pads get a weight of 0 in the sum.
+        ----------
+        """
+
+        if(not is_active(x)):
+            return self.embedding(x.view(x.shape[0], x.shape[1], -1))
+
+        assert (not self.quantized), "Quantized models only take dense frames"
+
+        active = x.reshape(-1, x.shape[-1]).type(TORCH_LABEL_TYPE)
+        valid = active != ACTIVE_PAD
 
+        weight = self.embedding.weight.t().contiguous()
+        h = F.embedding_bag(active.masked_fill(~valid, 0), weight, mode="sum",
+                            per_sample_weights=valid.type(weight.dtype))
+
+        return (h + self.embedding.bias).view(x.shape[0], x.shape[1], -1)
+
+    # forward_segment
+    def forward_segment(self, x, memory=None, reset=None, mem_len=None):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Masked forward of one segment x (batch_size, seq_len, 84, 5) with Transformer-XL style
+        recurrence (RPR only, see TransformerEncoderRPR.forward_memory). memory is what the
+        previous call returned for the previous segments of the same pieces (None to start).
+        reset (batch_size) is True for rows starting a new piece, their memory is ignored. Keeps
+        mem_len (default seq_len) frames of memory.
+
+        Positional encoding is per segment, context across segments comes from the relative
+        positions. Returns the predictions and the new memory.
+        ----------
+        """
+
+        assert self.rpr, "Segment recurrence needs rpr"
+        assert self.attn_pattern is None, "Segment recurrence does not support attention patterns, attention over memory is dense"
+
+        seq_len = x.shape[1]
+
+        memory_padding = None
+        total = seq_len
+        if(memory is not None):
+            layer_memory, memory_padding = memory
+            if(reset is not None):
+                memory_padding = memory_padding | reset.to(memory_padding.device).view(-1, 1)
+            memory = layer_memory
+            total += memory_padding.shape[1]
+
+        mask = self.masks.causal_mask(seq_len, total, x.device)
+
+        x = self.embed(x)
+        x = x.permute(1,0,2)
+        x = self.positional_encoding(x)
+
+        x_out, new_memory = self.transformer.encoder.forward_memory(x, mask, memory, memory_padding, mem_len)
+
+        x_out = x_out.permute(1,0,2)
         y = self.Wout(x_out)
-        # y = self.softmax(y)
         y = y.view(y.shape[0], y.shape[1], 84, 5)
 
-        del mask
+        return y, new_memory
+
+    # _float_param
+    def _float_param(self):
+        # Gives the device and dtype for new tensors. Linear weights may be quantized, norms never are.
+        return self.transformer.encoder.norm.weight
+
+    # init_cache
+    def init_cache(self, batch_size=1, max_len=None, offsets=None):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Creates an empty AttentionCache sized for this model, used with forward_step. offsets gives
+        the amount of left padding per row for batches of different length sequences. Linear
+        attention models get a LinearAttentionCache instead (max_len is then unused).
+        ----------
+        """
+
+        if(max_len is None):
+            max_len = self.max_seq
+
+        param = self._float_param()
+        if(self.attention == "linear"):
+            attn = self.transformer.encoder.layers[0].self_attn
+            return LinearAttentionCache(self.nlayers, batch_size, self.nhead, attn.n_features, self.d_model // self.nhead,
+                                        device=param.device, dtype=param.dtype, offsets=offsets)
+
+        return AttentionCache(self.nlayers, batch_size, self.nhead, self.d_model // self.nhead, max_len,
+                              device=param.device, dtype=param.dtype, offsets=offsets)
+
+    # prefill
+    def prefill(self, primers, max_len):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Runs a list of primers (each (primer_len, 84, 5), lengths may differ) through the model as one
+        left padded batch. Returns the new AttentionCache (holding up to max_len frames per row) and
+        the predictions (batch_size, 84, 5) for the frame after each primer.
+        ----------
+        """
+
+        device      = self._float_param().device
+        lengths     = torch.tensor([len(p) for p in primers], dtype=TORCH_LABEL_TYPE, device=device)
+        max_primer  = max(len(p) for p in primers)
+
+        padded = torch.zeros((len(primers), max_primer, 84, 5), dtype=TORCH_FLOAT, device=device)
+        for i, primer in enumerate(primers):
+            padded[i, max_primer - len(primer):] = primer.type(TORCH_FLOAT).to(device)
+
+        cache = self.init_cache(len(primers), max_len, offsets=max_primer - lengths)
+        y = self.forward_step(padded, cache)[:, -1]
+
+        return cache, y
+
+    # forward_step
+    def forward_step(self, x, cache):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Incremental forward pass. Takes only the new frames x (batch_size, new_len, 84, 5) that follow
+        the frames already held in cache and returns their predictions. Keys and values for the new
+        frames are added to cache, so each new frame costs O(L) rather than re-encoding the whole
+        sequence. Gives the same output as forward() on the full sequence (inference only). x may
+        also be sparse active-note frames (see embed).
+        ----------
+        """
+
+        assert (not self.training), "forward_step is for inference only"
+
+        cache.prepare(x.shape[1])
+
+        x = self.embed(x)
+
+        # Input shape is (new_len, batch_size, d_model)
+        x = x.permute(1,0,2)
+
+        x = self.positional_encoding(x, start=cache.position, positions=cache.positions(x.shape[0]))
+
+        encoder = self.transformer.encoder
+        for i, layer in enumerate(encoder.layers):
+            x = encoder_layer_step(layer, x, cache, i)
+
+        if(encoder.norm is not None):
+            x = encoder.norm(x)
+
+        cache.advance(x.shape[0])
+
+        # Back to (batch_size, new_len, d_model)
+        x_out = x.permute(1,0,2)
+
+        y = self.Wout(x_out)
+        y = y.view(y.shape[0], y.shape[1], 84, 5)
 
-        # They are trained to predict the next note in sequence (we don't need the last one)
         return y
 
     # generate
-    def generate(self, primer=None, target_seq_length=1024, beam=0, beam_chance=1.0):
+    def generate(self, primer=None, target_seq_length=1024, beam=0, use_cache=True, sampler=None, length_penalty=0.0):
         """
         ----------
         Author: Damon Gwinn
         ----------
-        Generates midi given a primer sample. Music can be generated using a probability distribution over
-        the softmax probabilities (recommended) or by using a beam search.
+        Generates midi given a primer sample. Music can be generated by sampling every frame from
+        the output note probabilities with sampler (a PianoRollSampler, recommended) or by using a
+        beam search (see beam_search.py).
+
+        With use_cache, keys and values of previous frames are cached so each new frame only runs
+        the new position through the model (see forward_step and generate_stream to get frames as
+        they are sampled).
         ----------
         """
 
         assert (not self.training), "Cannot generate while in training mode"
 
-        print("Generating sequence of max length:", target_seq_length)
+        if(beam > 0):
+            gen_seq, _ = beam_search(self, [primer], target_seq_length, beam, length_penalty=length_penalty)[0]
+            return gen_seq.unsqueeze(0)
 
-        gen_seq = torch.full((1,target_seq_length), TOKEN_PAD, dtype=TORCH_LABEL_TYPE, device=get_device())
+        if(sampler is None):
+            sampler = PianoRollSampler()
 
         num_primer = len(primer)
-        gen_seq[..., :num_primer] = primer.type(TORCH_LABEL_TYPE).to(get_device())
+        primer = primer.type(TORCH_FLOAT).to(get_device())
+
+        if(use_cache):
+            chunks = [primer] + list(self.generate_stream(primer, target_seq_length, chunk_size=64, sampler=sampler))
+            return torch.cat(chunks, dim=0).unsqueeze(0)
+
+        print("Generating sequence of max length:", target_seq_length)
 
+        gen_seq = torch.zeros((1, target_seq_length, 84, 5), dtype=TORCH_FLOAT, device=get_device())
+        gen_seq[:, :num_primer] = primer
 
-        # print("primer:",primer)
-        # print(gen_seq)
         cur_i = num_primer
         while(cur_i < target_seq_length):
-            # gen_seq_batch     = gen_seq.clone()
-            y = self.softmax(self.forward(gen_seq[..., :cur_i]))[..., :TOKEN_END]
-            token_probs = y[:, cur_i-1, :]
+            y = self.forward(gen_seq[:, :cur_i])[:, cur_i-1]
+            gen_seq[:, cur_i] = sampler(y)
+
+            cur_i += 1
+            if(cur_i % 50 == 0):
+                print(cur_i, "/", target_seq_length)
+
+        return gen_seq[:, :cur_i]
+
+    # generate_stream
+    @torch.no_grad()
+    def generate_stream(self, primer, target_seq_length=1024, chunk_size=1, sampler=None):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Streaming generation with cached decoding. Yields the new frames after primer
+        (primer_len, 84, 5) in chunks (n_frames, 84, 5) of up to chunk_size frames as soon as they
+        are sampled, until the sequence is target_seq_length frames long. Frames stay on the
+        model's device; pair with MidiStreamWriter to turn them into midi as they arrive.
+        ----------
+        """
+
+        assert (not self.training), "Cannot generate while in training mode"
+        assert target_seq_length <= self.max_seq or self.attention == "linear", "target_seq_length must not exceed max_sequence"
+
+        if(sampler is None):
+            sampler = PianoRollSampler()
+
+        device      = self._float_param().device
+        num_primer  = len(primer)
+        num_frames  = target_seq_length - num_primer
+
+        cache = self.init_cache(1, target_seq_length)
+        y = self.forward_step(primer.type(TORCH_FLOAT).to(device).unsqueeze(0), cache)[:, -1]
+
+        chunk = torch.zeros((chunk_size, 84, 5), dtype=TORCH_FLOAT, device=device)
+        n_chunk = 0
+        for i in range(num_frames):
+            frame = sampler(y)
+            chunk[n_chunk] = frame[0]
+            n_chunk += 1
+
+            if(n_chunk == chunk_size or i + 1 == num_frames):
+                yield chunk[:n_chunk].clone()
+                n_chunk = 0
+
+            if(i + 1 < num_frames):
+                y = self.forward_step(frame.unsqueeze(1), cache)[:, -1]
+
+    # generate_long
+    @torch.no_grad()
+    def generate_long(self, primer, num_frames, window=None, sampler=None):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Long-form generation past max_sequence. Yields num_frames new frames (84, 5) one at a time as
+        they are sampled, continuing primer (primer_len, 84, 5).
+
+        Attention is limited to a fixed window of frames (default max_sequence) held in a
+        RollingAttentionCache, so each frame costs the same and memory stays constant regardless of
+        length. Relative positions stay within the window; the absolute positional encoding is
+        extended past max_sequence. Linear attention models need no window, their state already has
+        a constant size, so they attend to the whole piece.
+        ----------
+        """
 
-            if(beam == 0):
-                beam_ran = 2.0
-            else:
-                beam_ran = random.uniform(0,1)
+        assert (not self.training), "Cannot generate while in training mode"
+
+        if(window is None):
+            window = self.max_seq
+        assert window <= self.max_seq, "window must not exceed max_sequence"
+
+        if(sampler is None):
+            sampler = PianoRollSampler()
+
+        param = self._float_param()
+        if(self.attention == "linear"):
+            cache = self.init_cache(1)
+        else:
+            cache = RollingAttentionCache(self.nlayers, 1, self.nhead, self.d_model // self.nhead, window,
+                                          device=param.device, dtype=param.dtype)
 
-            if(beam_ran <= beam_chance):
-                token_probs = token_probs.flatten()
-                top_res, top_i = torch.topk(token_probs, beam)
+        primer = primer.type(TORCH_FLOAT).to(param.device).unsqueeze(0)
 
-                beam_rows = top_i // VOCAB_SIZE
-                beam_cols = top_i % VOCAB_SIZE
+        # Primers longer than the window go in window sized chunks
+        for start in range(0, primer.shape[1], window):
+            y = self.forward_step(primer[:, start:start+window], cache)
 
-                gen_seq = gen_seq[beam_rows, :]
-                gen_seq[..., cur_i] = beam_cols
+        for i in range(num_frames):
+            frame = sampler(y[:, -1])
+            yield frame[0]
 
-            else:
-                distrib = torch.distributions.categorical.Categorical(probs=token_probs)
-                next_token = distrib.sample()
-                # print("next token:",next_token)
-                gen_seq[:, cur_i] = next_token
+            if(i + 1 < num_frames):
+                y = self.forward_step(frame.unsqueeze(1), cache)
+
+    # generate_batch
+    def generate_batch(self, primers, target_seq_length=1024, end_silence=None, compact_interval=16, sampler=None):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Generates continuations for a list of primers (each (primer_len, 84, 5), lengths may differ)
+        as a single batch using cached decoding. Primers are left padded and the padding is masked.
 
+        Frames are drawn with sampler (default PianoRollSampler()). A row finishes once it is
+        target_seq_length frames long, or after end_silence consecutive empty frames if given.
+        Finished rows are compacted out of the batch every compact_interval steps so they stop
+        costing compute (the check is the only host sync in the loop).
 
-                # Let the transformer decide to end if it wants to
-                if(next_token == TOKEN_END):
-                    print("Model called end of sequence at:", cur_i, "/", target_seq_length)
+        Returns a list with one generated sequence (seq_len, 84, 5) per primer, primer included.
+        ----------
+        """
+
+        assert (not self.training), "Cannot generate while in training mode"
+        assert target_seq_length <= self.max_seq, "target_seq_length must not exceed max_sequence"
+
+        if(sampler is None):
+            sampler = PianoRollSampler()
+
+        device      = get_device()
+        n_rows      = len(primers)
+        lengths     = torch.tensor([len(p) for p in primers], dtype=TORCH_LABEL_TYPE, device=device)
+        max_primer  = max(len(p) for p in primers)
+        min_primer  = min(len(p) for p in primers)
+        max_steps   = target_seq_length - min_primer
+
+        print("Generating", n_rows, "sequences of max length:", target_seq_length)
+
+        # Rows write past their end until the next compaction, so leave room for it
+        out_len = max(target_seq_length, max_primer) + compact_interval
+        out = torch.zeros((n_rows, out_len, 84, 5), dtype=TORCH_FLOAT, device=device)
+        for i, primer in enumerate(primers):
+            out[i, :len(primer)] = primer.type(TORCH_FLOAT).to(device)
+
+        cache, y = self.prefill(primers, max_primer + max_steps + compact_interval)
+
+        active      = torch.arange(n_rows, device=device)
+        positions   = lengths.clone()
+        done        = positions >= target_seq_length
+        silence     = torch.zeros(n_rows, dtype=TORCH_LABEL_TYPE, device=device)
+
+        step = 0
+        while(step < max_steps):
+            frames = sampler(y)
+            out[active, positions] = frames
+
+            positions = positions + 1
+            finished = positions >= target_seq_length
+            if(end_silence is not None):
+                silence = torch.where(frames.flatten(1).any(dim=-1), torch.zeros_like(silence), silence + 1)
+                finished = finished | (silence >= end_silence)
+
+            # Rows that finished earlier keep their recorded length
+            lengths[active] = torch.where(done, lengths[active], positions)
+            done = done | finished
+
+            step += 1
+            if(step % 50 == 0):
+                print(step, "/", max_steps)
+
+            if(step % compact_interval == 0 or step == max_steps):
+                keep = (~done).nonzero().squeeze(1)
+                if(keep.numel() == 0):
                     break
 
-            cur_i += 1
-            if(cur_i % 50 == 0):
-                print(cur_i, "/", target_seq_length)
+                if(keep.numel() < active.numel()):
+                    active      = active[keep]
+                    positions   = positions[keep]
+                    done        = done[keep]
+                    silence     = silence[keep]
+                    frames      = frames[keep]
+                    cache.select(keep)
 
-        return gen_seq[:, :cur_i]
+            y = self.forward_step(frames.unsqueeze(1), cache)[:, -1]
+
+        lengths = lengths.tolist()
+        return [out[i, :lengths[i]] for i in range(n_rows)]
 
 # Used as a dummy to nn.Transformer
 # DummyDecoder
@@ -10,14 +10,31 @@ class PositionalEncoding(nn.Module):
         super(PositionalEncoding, self).__init__()
         self.dropout = nn.Dropout(p=dropout)
 
-        pe = torch.zeros(max_len, d_model)
-        position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
-        div_term = torch.exp(torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model))
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
+        self.d_model = d_model
+
+        pe = self.encode(torch.arange(0, max_len))
         pe = pe.unsqueeze(0).transpose(0, 1)
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
-        x = x + self.pe[:x.size(0), :]
+    def encode(self, positions):
+        # Sinusoidal encodings (len, d_model) for any positions, including ones past max_len
+        position = positions.float().unsqueeze(1)
+        div_term = torch.exp(torch.arange(0, self.d_model, 2, device=positions.device).float() * (-math.log(10000.0) / self.d_model))
+
+        pe = torch.zeros(positions.shape[0], self.d_model, device=positions.device)
+        pe[:, 0::2] = torch.sin(position * div_term)
+        pe[:, 1::2] = torch.cos(position * div_term)
+        return pe
+
+    def forward(self, x, start=0, positions=None):
+        # positions (seq_len, batch_size) gives per-row positions, used for left padded batches
+        if(positions is None and start + x.size(0) > self.pe.size(0)):
+            # Long-form generation runs past the precomputed table
+            pe = self.encode(torch.arange(start, start + x.size(0), device=x.device))
+            x = x + pe.unsqueeze(1).type(x.dtype)
+        elif(positions is None):
+            x = x + self.pe[start:start + x.size(0), :]
+        else:
+            positions = positions.clamp(max=self.pe.size(0) - 1)
+            x = x + self.pe[positions, 0, :]
         return self.dropout(x)
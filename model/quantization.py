@@ -0,0 +1,56 @@
+import copy
+import torch
+import torch.nn as nn
+
+# quantize_dynamic_int8
+def quantize_dynamic_int8(model):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Returns an int8 dynamically quantized copy of a MusicTransformer for CPU inference. model is
+    left as is.
+
+    torch.quantization.quantize_dynamic only swaps nn.Linear modules. That catches the embedding,
+    the feedforward linear1 / linear2, Wout and the projections of SelfAttentionRPR, but not those
+    of Pytorch's MultiheadAttention: in_proj_weight is a bare Parameter fed to linear(), and
+    out_proj is a subclass of nn.Linear that is skipped on purpose. Both are first moved into plain
+    nn.Linear modules (in_proj / out_proj) so they get quantized too, and the fp32 in_proj weights
+    are dropped.
+
+    The quantized model runs attention through the cached path (see forward_step), which calls
+    these modules, so forward() and all generation methods keep working.
+    ----------
+    """
+
+    assert (not model.training), "Can only quantize a model in eval mode"
+    assert all(p.device.type == "cpu" for p in model.parameters()), "Dynamic int8 quantization runs on the cpu only"
+
+    model = copy.deepcopy(model)
+
+    for layer in model.transformer.encoder.layers:
+        attn = layer.self_attn
+
+        # SelfAttentionRPR already has plain in_proj / out_proj modules
+        if(getattr(attn, "in_proj", None) is not None):
+            continue
+
+        has_bias = attn.in_proj_bias is not None
+
+        in_proj = nn.Linear(attn.embed_dim, 3 * attn.embed_dim, bias=has_bias)
+        in_proj.weight = attn.in_proj_weight
+        if(has_bias):
+            in_proj.bias = attn.in_proj_bias
+
+        out_proj = nn.Linear(attn.embed_dim, attn.embed_dim, bias=attn.out_proj.bias is not None)
+        out_proj.load_state_dict(attn.out_proj.state_dict())
+
+        attn.in_proj = in_proj
+        attn.out_proj = out_proj
+        attn.in_proj_weight = None
+        attn.in_proj_bias = None
+
+    model = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    model.quantized = True
+
+    return model
@@ -11,33 +11,127 @@ from torch.nn.modules.normalization import LayerNorm
 from torch.nn.init import *
 
 from torch.nn.functional import linear, softmax, dropout
+from torch.utils.checkpoint import checkpoint
+from typing import Optional
+
+from utilities.constants import *
+
+from .sparse_attention import sparse_attention_rpr
 
 # TransformerEncoderRPR
 class TransformerEncoderRPR(Module):
     """
     ----------
     Author: Pytorch
+    Modified: Damon Gwinn
     ----------
     For Relative Position Representation support (https://arxiv.org/abs/1803.02155)
     https://pytorch.org/docs/1.2.0/_modules/torch/nn/modules/transformer.html#TransformerEncoder
 
-    No modification. Copied here to ensure continued compatibility with other edits.
+    Modification to add activation checkpointing (see set_checkpoint)
     ----------
     """
 
-    def __init__(self, encoder_layer, num_layers, norm=None):
+    def __init__(self, encoder_layer, num_layers, norm=None, checkpoint=None, checkpoint_every=1):
         super(TransformerEncoderRPR, self).__init__()
         self.layers = _get_clones(encoder_layer, num_layers)
         self.num_layers = num_layers
         self.norm = norm
+        self.set_checkpoint(checkpoint, checkpoint_every)
+
+    # set_checkpoint
+    def set_checkpoint(self, mode=None, every=1):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Sets the activation checkpointing mode used in training (None or one of CHECKPOINT_MODES):
+            None:           Every layer keeps its activations for backward.
+            "layers":       Every k-th layer (every=k, starting at the first) only keeps its input,
+                            and backward runs it again. every=1 checkpoints all layers.
+            "attention":    Only the self-attention block of each layer is recomputed. It holds
+                            the O(L^2) logits and weights, feedforward activations are kept.
+        Recomputation restores the RNG state of the forward, so dropout masks match and gradients
+        are the same as without checkpointing.
+        ----------
+        """
+
+        assert mode is None or mode in CHECKPOINT_MODES, "Unknown checkpoint mode " + str(mode)
+        assert every >= 1, "checkpoint every must be at least 1"
+
+        self.checkpoint = mode
+        self.checkpoint_every = every
+
+        for layer in self.layers:
+            layer.checkpoint_attn = (mode == "attention")
+
+    # forward_memory
+    def forward_memory(self, src, mask, memory=None, memory_padding=None, mem_len=None):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Transformer-XL style segment recurrence (https://arxiv.org/abs/1901.02860). src (seq_len,
+        batch_size, d_model) is the current segment, memory the list of per layer inputs
+        (mem_len, batch_size, d_model) kept from the previous segments of the same pieces and
+        memory_padding (batch_size, mem_len) True for memory frames to ignore. Every layer attends
+        to its memory plus the segment, mask (seq_len, mem_len + seq_len) is the causal mask.
+
+        Returns the output and the new (memory, memory_padding), the last mem_len (default
+        seq_len) inputs of every layer with gradients stopped. Extra cost is linear in mem_len.
+        ----------
+        """
+
+        seq_len, bsz = src.shape[:2]
+        if(mem_len is None):
+            mem_len = seq_len
+
+        padding = None
+        if(memory is not None):
+            current = torch.zeros((bsz, seq_len), dtype=torch.bool, device=src.device)
+            padding = torch.cat([memory_padding, current], dim=1)
+
+        use_checkpoint = (self.checkpoint == "layers") and self.training and torch.is_grad_enabled()
 
-    def forward(self, src, mask=None, src_key_padding_mask=None, **kwargs):
+        output = src
+        new_memory = []
+        for i in range(self.num_layers):
+            layer_memory = None if memory is None else memory[i]
+
+            if(layer_memory is None):
+                new_memory.append(output[-mem_len:].detach())
+            else:
+                new_memory.append(torch.cat([layer_memory, output])[-mem_len:].detach())
+
+            if(use_checkpoint and i % self.checkpoint_every == 0):
+                output = checkpoint(self.layers[i], output, mask, padding, False, layer_memory, use_reentrant=False)
+            else:
+                output = self.layers[i](output, src_mask=mask, src_key_padding_mask=padding, memory=layer_memory)
+
+        if self.norm:
+            output = self.norm(output)
+
+        if(padding is None):
+            new_padding = torch.zeros((bsz, seq_len), dtype=torch.bool, device=src.device)
+        else:
+            new_padding = padding
+        new_padding = new_padding[:, -mem_len:]
+
+        return output, (new_memory, new_padding)
+
+    def forward(self, src, mask=None, src_key_padding_mask=None, is_causal=False, **kwargs):
+        # is_causal asks layers that are causal by construction for causal attention without a mask
 
         output = src
+        use_checkpoint = (self.checkpoint == "layers") and self.training and torch.is_grad_enabled()
+        is_causal = bool(is_causal)
 
         for i in range(self.num_layers):
-            output = self.layers[i](output, src_mask=mask,
-                                    src_key_padding_mask=src_key_padding_mask)
+            if(use_checkpoint and i % self.checkpoint_every == 0):
+                output = checkpoint(self.layers[i], output, mask, src_key_padding_mask, is_causal, use_reentrant=False)
+            else:
+                output = self.layers[i](output, src_mask=mask,
+                                        src_key_padding_mask=src_key_padding_mask, is_causal=is_causal)
 
         if self.norm:
             output = self.norm(output)
@@ -54,13 +148,18 @@ class TransformerEncoderLayerRPR(Module):
     For Relative Position Representation support (https://arxiv.org/abs/1803.02155)
     https://pytorch.org/docs/1.2.0/_modules/torch/nn/modules/transformer.html#TransformerEncoderLayer
 
-    Modification to create and call custom MultiheadAttentionRPR
+    Modification to create and call custom SelfAttentionRPR, to optionally checkpoint the
+    self-attention block in training (checkpoint_attn, set by TransformerEncoderRPR), to pass
+    segment memory (see TransformerEncoderRPR.forward_memory) and to run the feedforward in
+    sequence chunks of ff_chunk_size (see chunked_feedforward)
     ----------
     """
 
-    def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1, er_len=None):
+    def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1, er_len=None, block_size=None):
         super(TransformerEncoderLayerRPR, self).__init__()
-        self.self_attn = MultiheadAttentionRPR(d_model, nhead, dropout=dropout, er_len=er_len)
+        self.checkpoint_attn = False
+        self.ff_chunk_size = None
+        self.self_attn = SelfAttentionRPR(d_model, nhead, dropout=dropout, er_len=er_len, block_size=block_size)
         # Implementation of Feedforward model
         self.linear1 = Linear(d_model, dim_feedforward)
         self.dropout = Dropout(dropout)
@@ -71,16 +170,188 @@ class TransformerEncoderLayerRPR(Module):
         self.dropout1 = Dropout(dropout)
         self.dropout2 = Dropout(dropout)
 
-    def forward(self, src, src_mask=None, src_key_padding_mask=None):
-        src2 = self.self_attn(src, src, src, attn_mask=src_mask,
-                              key_padding_mask=src_key_padding_mask)[0]
-        src = src + self.dropout1(src2)
+    def forward(self, src, src_mask=None, src_key_padding_mask=None, is_causal=False, memory=None):
+        if(self.checkpoint_attn and self.training and torch.is_grad_enabled()):
+            src2 = checkpoint(self._attention_block, src, src_mask, src_key_padding_mask, is_causal, memory, use_reentrant=False)
+        else:
+            src2 = self._attention_block(src, src_mask, src_key_padding_mask, is_causal, memory)
+        src = src + src2
         src = self.norm1(src)
-        src2 = self.linear2(self.dropout(F.relu(self.linear1(src))))
+        src2 = chunked_feedforward(self, src, self.ff_chunk_size)
         src = src + self.dropout2(src2)
         src = self.norm2(src)
         return src
 
+    def _attention_block(self, src, src_mask, src_key_padding_mask, is_causal=False, memory=None):
+        src2 = self.self_attn(src, attn_mask=src_mask, key_padding_mask=src_key_padding_mask, is_causal=is_causal,
+                              memory=memory)[0]
+        return self.dropout1(src2)
+
+# chunked_feedforward
+def chunked_feedforward(layer, src, chunk_size=None):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Position-wise feedforward linear2(dropout(relu(linear1(src)))) of an encoder layer for src
+    (seq_len, batch_size, d_model), chunk_size positions at a time when given.
+
+    The (seq_len, batch_size, dim_feedforward) intermediates are the largest activations of a
+    layer. In training each chunk is checkpointed, so backward keeps only the chunk inputs and
+    recomputes one chunk's intermediates at a time. Dropout masks are the same on recompute.
+    ----------
+    """
+
+    if(chunk_size is None or chunk_size >= src.shape[0]):
+        return _feedforward(layer, src)
+
+    use_checkpoint = layer.training and torch.is_grad_enabled()
+
+    outputs = []
+    for start in range(0, src.shape[0], chunk_size):
+        chunk = src[start:start + chunk_size]
+        if(use_checkpoint):
+            outputs.append(checkpoint(_feedforward, layer, chunk, use_reentrant=False))
+        else:
+            outputs.append(_feedforward(layer, chunk))
+
+    return torch.cat(outputs, dim=0)
+
+def _feedforward(layer, src):
+    return layer.linear2(layer.dropout(F.relu(layer.linear1(src))))
+
+# SelfAttentionRPR
+class SelfAttentionRPR(Module):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Lean self-attention with Relative Position Representations, used by TransformerEncoderLayerRPR.
+    Same math as MultiheadAttentionRPR on self-attention, minus what only matters for general
+    attention: q, k and v come from one fused in_proj Linear, there is no torch.equal probing of
+    query / key / value, no shape asserts, and head averaged weights are only computed when
+    need_weights is given. The relative term is gathered directly (see _relative_logits) instead
+    of skewed.
+
+    With block_size, causal attention goes through blockwise_attention_rpr, and with pattern (an
+    AttentionPattern, set by MusicTransformer) through block-sparse sparse_attention_rpr, which
+    takes precedence. attn_mask is taken to be the causal mask there, the only mask
+    MusicTransformer uses. is_causal asks for causal attention without any attn_mask, so those
+    paths never see an (L, L) mask (one is taken from masks if the dense path is needed after
+    all). masks is the model's MaskRegistry (set by MusicTransformer) that causal masks and
+    relative distance indices come from.
+
+    memory (mem_len, batch_size, embed_dim) holds hidden states of earlier frames to attend to as
+    extra keys and values before query (segment recurrence). attn_mask and key_padding_mask then
+    cover mem_len + seq_len keys, and relative distances count across the boundary.
+
+    Old MultiheadAttentionRPR state_dicts (in_proj_weight / in_proj_bias) load as is.
+    ----------
+    """
+
+    def __init__(self, embed_dim, num_heads, dropout=0., er_len=None, block_size=None):
+        super(SelfAttentionRPR, self).__init__()
+        self.embed_dim  = embed_dim
+        self.num_heads  = num_heads
+        self.dropout    = dropout
+        self.head_dim   = embed_dim // num_heads
+        self.scaling    = float(self.head_dim) ** -0.5
+        self.block_size = block_size
+        self.pattern    = None
+        self.masks      = None
+        assert self.head_dim * num_heads == self.embed_dim, "embed_dim must be divisible by num_heads"
+
+        self.in_proj    = Linear(embed_dim, 3 * embed_dim)
+        self.out_proj   = Linear(embed_dim, embed_dim)
+
+        if(er_len is not None):
+            self.Er = Parameter(torch.rand((er_len, self.head_dim), dtype=torch.float32))
+        else:
+            self.Er = None
+
+        xavier_uniform_(self.in_proj.weight)
+        constant_(self.in_proj.bias, 0.)
+        constant_(self.out_proj.bias, 0.)
+
+        self._register_load_state_dict_pre_hook(self._load_unfused_in_proj)
+
+    # in_proj_weight
+    @property
+    def in_proj_weight(self):
+        return self.in_proj.weight
+
+    # in_proj_bias
+    @property
+    def in_proj_bias(self):
+        return self.in_proj.bias
+
+    def _load_unfused_in_proj(self, state_dict, prefix, *args):
+        # Checkpoints from MultiheadAttentionRPR keep the packed projection as bare parameters
+        for old, new in (("in_proj_weight", "in_proj.weight"), ("in_proj_bias", "in_proj.bias")):
+            if(prefix + old in state_dict):
+                state_dict[prefix + new] = state_dict.pop(prefix + old)
+
+    def forward(self, query, key=None, value=None, key_padding_mask=None, need_weights=False, attn_mask=None, memory=None,
+                is_causal=False):
+        # key and value are accepted for MultiheadAttention compatibility, query is always used
+
+        causal = is_causal or attn_mask is not None
+        if(causal and key_padding_mask is None and memory is None and not need_weights):
+            if(self.pattern is not None):
+                return sparse_attention_rpr(query, self, self.pattern, training=self.training), None
+            if(self.block_size is not None):
+                return blockwise_attention_rpr(query, self, self.block_size, training=self.training), None
+
+        tgt_len, bsz, embed_dim = query.size()
+
+        q, k, v = self.in_proj(query).chunk(3, dim=-1)
+        q = q * self.scaling
+
+        if(memory is not None):
+            # Memory only needs keys and values
+            kv_weight = self.in_proj.weight[embed_dim:]
+            kv_bias = self.in_proj.bias[embed_dim:]
+            k_mem, v_mem = linear(memory, kv_weight, kv_bias).chunk(2, dim=-1)
+            k = torch.cat([k_mem, k])
+            v = torch.cat([v_mem, v])
+
+        src_len = k.shape[0]
+
+        if(is_causal and attn_mask is None):
+            if(self.masks is not None):
+                attn_mask = self.masks.causal_mask(tgt_len, src_len, query.device)
+            else:
+                attn_mask = torch.full((tgt_len, src_len), float("-inf"), device=query.device).triu_(src_len - tgt_len + 1)
+
+        # (batch_size, num_heads, seq_len, head_dim)
+        q = q.contiguous().view(tgt_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+        k = k.contiguous().view(src_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+        v = v.contiguous().view(src_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+
+        attn_output_weights = torch.matmul(q, k.transpose(-2, -1))
+
+        if(self.Er is not None):
+            distances = None if self.masks is None else self.masks.distances(tgt_len, src_len, q.device)
+            attn_output_weights += _relative_logits(q, self.Er, src_len, distances)
+
+        if attn_mask is not None:
+            attn_output_weights += attn_mask
+
+        if key_padding_mask is not None:
+            attn_output_weights = attn_output_weights.masked_fill(key_padding_mask.view(bsz, 1, 1, src_len), float("-inf"))
+
+        attn_output_weights = softmax(attn_output_weights, dim=-1, dtype=TORCH_FLOAT)
+        attn_output_weights = dropout(attn_output_weights, p=self.dropout, training=self.training)
+
+        attn_output = torch.matmul(attn_output_weights, v)
+        attn_output = attn_output.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)
+        attn_output = self.out_proj(attn_output)
+
+        if need_weights:
+            return attn_output, attn_output_weights.mean(dim=1)
+        else:
+            return attn_output, None
+
 # MultiheadAttentionRPR
 class MultiheadAttentionRPR(Module):
     """
@@ -415,7 +686,7 @@ def multi_head_attention_forward_rpr(query,                       # type: Tensor
         attn_output_weights = attn_output_weights.view(bsz * num_heads, tgt_len, src_len)
 
     attn_output_weights = softmax(
-        attn_output_weights, dim=-1)
+        attn_output_weights, dim=-1, dtype=TORCH_FLOAT)
 
     attn_output_weights = dropout(attn_output_weights, p=dropout_p, training=training)
 
@@ -462,3 +733,243 @@ def _skew(qe):
 
     srel = qe[:, 1:, :]
     return srel
+
+# blockwise_attention_rpr
+def blockwise_attention_rpr(query, self_attn, block_size, training=False):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Memory efficient causal self-attention with RPR for query (seq_len, batch_size, embed_dim).
+
+    Queries are processed block_size at a time against only the keys they can see, so the
+    attention logits, relative logits and weights never exist for more than one
+    (block_size, seq_len) block. The relative term of a block is gathered directly from
+    q_block @ Er (see _relative_logits) instead of skewing a full (seq_len, seq_len) tensor, and
+    causality comes from the block's key range plus a small mask on its diagonal part. In training
+    each block is checkpointed, so backward recomputes it instead of keeping every block alive.
+    ----------
+    """
+
+    tgt_len, bsz, embed_dim = query.size()
+    num_heads = self_attn.num_heads
+    head_dim = embed_dim // num_heads
+    scaling = float(head_dim) ** -0.5
+
+    q, k, v = _in_projection(query, self_attn).chunk(3, dim=-1)
+    q = q * scaling
+
+    # (batch_size, num_heads, seq_len, head_dim)
+    q = q.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+    k = k.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+    v = v.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+
+    rpr_mat = self_attn.Er
+    masks = getattr(self_attn, "masks", None)
+    dropout_p = self_attn.dropout if training else 0.0
+
+    outputs = []
+    for start in range(0, tgt_len, block_size):
+        end = min(start + block_size, tgt_len)
+        args = (q[:, :, start:end], k[:, :, :end], v[:, :, :end], rpr_mat, masks, dropout_p)
+
+        if(training and torch.is_grad_enabled()):
+            outputs.append(checkpoint(_attention_block, *args, use_reentrant=False))
+        else:
+            outputs.append(_attention_block(*args))
+
+    attn_output = torch.cat(outputs, dim=2)
+    attn_output = attn_output.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)
+    attn_output = self_attn.out_proj(attn_output)
+
+    return attn_output
+
+def _attention_block(q, k, v, rpr_mat, masks, dropout_p):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Causal attention of the last q.shape[-2] queries of a length k.shape[-2] sequence, with the
+    relative term from rpr_mat if given. Masks and distances come from masks (a MaskRegistry) if
+    given.
+    ----------
+    """
+
+    len_q = q.shape[-2]
+    len_k = k.shape[-2]
+
+    attn_output_weights = torch.matmul(q, k.transpose(-2, -1))
+
+    if(masks is not None):
+        if(rpr_mat is not None):
+            attn_output_weights += _relative_logits(q, rpr_mat, len_k, masks.distances(len_q, len_k, q.device))
+        attn_output_weights += masks.causal_mask(len_q, len_k, q.device)
+    else:
+        if(rpr_mat is not None):
+            attn_output_weights += _relative_logits(q, rpr_mat, len_k)
+
+        q_pos = torch.arange(len_k - len_q, len_k, device=q.device).unsqueeze(1)
+        k_pos = torch.arange(len_k, device=q.device).unsqueeze(0)
+        attn_output_weights = attn_output_weights.masked_fill(k_pos > q_pos, float("-inf"))
+
+    attn_output_weights = softmax(attn_output_weights, dim=-1, dtype=TORCH_FLOAT)
+    attn_output_weights = dropout(attn_output_weights, p=dropout_p, training=dropout_p > 0.0)
+
+    return torch.matmul(attn_output_weights, v)
+
+# encoder_layer_step
+def encoder_layer_step(layer, src, cache, layer_idx):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Runs an encoder layer on only the new frames src (new_len, batch_size, d_model), attending to
+    the keys and values held in cache. Works for both TransformerEncoderLayerRPR and Pytorch's
+    nn.TransformerEncoderLayer since they share submodule names. Attention modules with their own
+    step() (LinearAttention) keep their state in cache themselves. Inference only (no dropout).
+    ----------
+    """
+
+    if(hasattr(layer.self_attn, "step")):
+        src2 = layer.self_attn.step(src, cache, layer_idx)
+    else:
+        src2 = multi_head_attention_cached_rpr(src, layer.self_attn, cache, layer_idx)
+    src = layer.norm1(src + src2)
+
+    activation = getattr(layer, "activation", F.relu)
+    src2 = layer.linear2(activation(layer.linear1(src)))
+    src = layer.norm2(src + src2)
+
+    return src
+
+# multi_head_attention_cached_rpr
+def multi_head_attention_cached_rpr(query, self_attn, cache, layer_idx):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Incremental self-attention for the new frames in query (new_len, batch_size, embed_dim).
+
+    Keys and values for the new frames are appended to cache, so each query only costs a product
+    against the cached keys. When self_attn has an RPR matrix Er, the relative term is computed for
+    the new query rows only (see _relative_logits). An attention pattern of self_attn is applied
+    as a mask (see _pattern_mask).
+    ----------
+    """
+
+    tgt_len, bsz, embed_dim = query.size()
+    num_heads = self_attn.num_heads
+    head_dim = embed_dim // num_heads
+    scaling = float(head_dim) ** -0.5
+
+    q, k, v = _in_projection(query, self_attn).chunk(3, dim=-1)
+    q = q * scaling
+
+    # (batch_size, num_heads, new_len, head_dim)
+    q = q.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+    k = k.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+    v = v.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+
+    attn_mask = cache.attention_mask(tgt_len)
+    k, v = cache.update(layer_idx, k, v)
+
+    attn_output_weights = torch.matmul(q, k.transpose(-2, -1))
+
+    rpr_mat = getattr(self_attn, "Er", None)
+    if(rpr_mat is not None):
+        masks = getattr(self_attn, "masks", None)
+        distances = None if masks is None else masks.distances(tgt_len, k.shape[2], q.device)
+        attn_output_weights += _relative_logits(q, rpr_mat, k.shape[2], distances)
+
+    if attn_mask is not None:
+        attn_output_weights += attn_mask
+
+    pattern = getattr(self_attn, "pattern", None)
+    if(pattern is not None):
+        attn_output_weights = attn_output_weights.masked_fill(_pattern_mask(pattern, cache, tgt_len, num_heads), float("-inf"))
+
+    attn_output_weights = softmax(attn_output_weights, dim=-1, dtype=TORCH_FLOAT)
+
+    attn_output = torch.matmul(attn_output_weights, v)
+    attn_output = attn_output.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)
+    attn_output = self_attn.out_proj(attn_output)
+
+    return attn_output
+
+def _pattern_mask(pattern, cache, new_len, num_heads):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    True where the new_len new queries may not attend to a cached key under pattern. Shape
+    (num_heads, new_len, length) or (batch_size, num_heads, new_len, length) when rows are padded.
+    Decoding only attends to O(L) keys per frame, so masking is cheap here.
+    ----------
+    """
+
+    assert getattr(cache, "window", None) is None, "Attention patterns need a full AttentionCache"
+
+    total = cache.length + new_len
+    slots_q = torch.arange(cache.length, total, device=cache.keys.device)
+    slots_k = torch.arange(total, device=cache.keys.device)
+
+    if(cache.offsets is None):
+        return ~pattern.allowed(slots_q.unsqueeze(1), slots_k.unsqueeze(0), num_heads)
+
+    # Absolute positions of padded rows, (batch_size, new_len, 1) and (batch_size, 1, length)
+    offsets = cache.offsets.view(-1, 1, 1)
+    q_pos = slots_q.view(1, -1, 1) - offsets
+    k_pos = slots_k.view(1, 1, -1) - offsets
+
+    return ~pattern.allowed(q_pos, k_pos, num_heads).transpose(0, 1)
+
+def _in_projection(query, self_attn):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Packed q, k, v projection. Uses the in_proj module if the weights were moved into one (see
+    quantization.py), otherwise in_proj_weight directly.
+    ----------
+    """
+
+    in_proj = getattr(self_attn, "in_proj", None)
+    if(in_proj is not None):
+        return in_proj(query)
+
+    return linear(query, self_attn.in_proj_weight, self_attn.in_proj_bias)
+
+def _relative_logits(q, Er, len_k, distances=None):
+    # type: (Tensor, Tensor, int, Optional[Tensor]) -> Tensor
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Relative position logits for the last q.shape[-2] queries of a length len_k causal sequence.
+    Equivalent to the matching rows of _skew, but only the rows for the given queries are computed.
+
+    Distance d between a query and an earlier key uses Er[len_e - 1 - d], same as _skew. distances
+    (len_q, len_k) holds the distance of every query / key pair, clamped at 0 for later keys (see
+    MaskRegistry.distances), and is computed here if not given. Also compiled with TorchScript by
+    export.py.
+    ----------
+    """
+
+    len_q = q.shape[-2]
+    len_e = Er.shape[0]
+
+    # Row d embeds distance d
+    Er_d = Er.flip([0])[:len_k]
+    if(len_k > len_e):
+        # Keys further away than Er covers get a zero embedding
+        Er_d = F.pad(Er_d, (0, 0, 0, len_k - len_e))
+
+    qe = torch.matmul(q, Er_d.transpose(0, 1))
+
+    if(distances is None):
+        q_pos = torch.arange(len_k - len_q, len_k, device=q.device).unsqueeze(1)
+        k_pos = torch.arange(len_k, device=q.device).unsqueeze(0)
+        distances = (q_pos - k_pos).clamp(min=0)
+
+    # gather wants int64 indices, the registry keeps int32
+    return qe.gather(-1, distances.long().expand(qe.shape))
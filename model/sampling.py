@@ -0,0 +1,131 @@
+import torch
+
+from utilities.constants import *
+
+# PianoRollSampler
+class PianoRollSampler:
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Draws whole piano-roll frames from the (..., 84, 5) output logits in one batched call.
+
+    The model is trained with BCEWithLogitsLoss, so every pitch/track cell is an independent
+    Bernoulli with probability sigmoid(logit / temperature). On top of that:
+        thresholds:     Per-track (or single) probability floor. Cells below it never sound. With
+                        greedy, a cell sounds exactly when its probability reaches the threshold
+                        (default 0.5).
+        top_k:          Only the top_k most likely cells of a frame may sound.
+        max_polyphony:  Per-track (or single) limit on sounding notes. The most likely of the
+                        sampled notes are kept.
+
+    Everything is tensor ops, so a step needs no Python loops over cells and no host sync.
+    ----------
+    """
+
+    def __init__(self, temperature=1.0, thresholds=None, top_k=None, max_polyphony=None, greedy=False):
+        assert temperature > 0.0, "temperature must be positive"
+
+        self.temperature    = temperature
+        self.thresholds     = _per_track(thresholds)
+        self.top_k          = top_k
+        self.max_polyphony  = _per_track(max_polyphony)
+        self.greedy         = greedy
+
+    def __call__(self, logits):
+        return self.sample(logits)
+
+    # probabilities
+    def probabilities(self, logits):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Per-cell note probabilities (..., 84, 5) after temperature, thresholds and top_k
+        ----------
+        """
+
+        probs = torch.sigmoid(logits.float() / self.temperature)
+
+        if(self.thresholds is not None and not self.greedy):
+            floor = self.thresholds.to(probs.device)
+            probs = probs.masked_fill(probs < floor, 0.0)
+
+        if(self.top_k is not None):
+            # Keeps exactly the top_k cells, ties with the k-th are not let through
+            flat = probs.flatten(-2)
+            keep = torch.zeros_like(flat, dtype=torch.bool)
+            keep.scatter_(-1, flat.topk(self.top_k, dim=-1)[1], True)
+            probs = probs.masked_fill(~keep.view(probs.shape), 0.0)
+
+        return probs
+
+    # sample
+    def sample(self, logits):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Samples binary frames (..., 84, 5) as TORCH_FLOAT from the logits
+        ----------
+        """
+
+        probs = self.probabilities(logits)
+
+        if(self.greedy):
+            if(self.thresholds is None):
+                notes = probs >= 0.5
+            else:
+                notes = probs >= self.thresholds.to(probs.device)
+        else:
+            notes = torch.rand_like(probs) < probs
+
+        if(self.max_polyphony is not None):
+            notes = self._limit_polyphony(notes, probs)
+
+        return notes.type(TORCH_FLOAT)
+
+    # _limit_polyphony
+    def _limit_polyphony(self, notes, probs):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Keeps at most max_polyphony of the sampled notes per track, preferring the most likely ones
+        ----------
+        """
+
+        limits = self.max_polyphony.to(device=probs.device, dtype=TORCH_LABEL_TYPE)
+        k_max = min(int(self.max_polyphony.max()), probs.shape[-2])
+
+        # Rank sampled notes by probability along the pitch dim, unsampled cells rank last
+        scores = torch.where(notes, probs, torch.full_like(probs, -1.0))
+        top_i = scores.topk(k_max, dim=-2)[1]
+
+        rank = torch.arange(k_max, device=probs.device).unsqueeze(-1)
+        allowed = (rank < limits).expand(top_i.shape)
+
+        keep = torch.zeros_like(notes)
+        keep.scatter_(-2, top_i, allowed)
+
+        return notes & keep
+
+def _per_track(value):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Turns None, a single number, or one number per track into a tensor that broadcasts over the
+    track dim
+    ----------
+    """
+
+    if(value is None):
+        return None
+
+    value = torch.tensor(value, dtype=TORCH_FLOAT)
+    if(value.dim() == 0):
+        value = value.expand(N_TRACKS)
+
+    assert value.shape[0] == N_TRACKS, "Expected one value per track"
+    return value.clone()
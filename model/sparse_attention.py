@@ -0,0 +1,191 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+from utilities.constants import *
+
+# AttentionPattern
+class AttentionPattern:
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Block-sparse causal attention pattern. The sequence is cut into blocks of block_size frames
+    and a query block only attends to a few key blocks:
+        local:      The window blocks up to and including its own (a sliding window of about
+                    window * block_size frames).
+        dilated:    Half of the heads are local, the other half see window blocks spaced dilation
+                    apart (its own, then dilation blocks back, ...), covering dilation times the
+                    span at the same cost.
+        global:     Local, plus every bar boundary frame (every global_every frames) before the
+                    window. Those summary frames are visible to every later query.
+    Block boundaries are absolute positions, so the pattern is the same for a full forward
+    (sparse_attention_rpr) and cached decoding (allowed).
+    ----------
+    """
+
+    def __init__(self, kind, block_size=64, window=4, dilation=4, global_every=FRAMES_PER_BAR):
+        assert kind in ATTENTION_PATTERNS, "Unknown attention pattern " + str(kind)
+        assert window >= 1 and dilation >= 1, "window and dilation must be at least 1"
+
+        self.kind           = kind
+        self.block_size     = block_size
+        self.window         = window
+        self.dilation       = dilation
+        self.global_every   = global_every
+
+    # head_groups
+    def head_groups(self, num_heads):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        List of (first_head, end_head, dilation) for the heads sharing one set of key blocks
+        ----------
+        """
+
+        if(self.kind == "dilated" and num_heads > 1):
+            half = num_heads // 2
+            return [(0, half, 1), (half, num_heads, self.dilation)]
+
+        return [(0, num_heads, 1)]
+
+    # key_positions
+    def key_positions(self, q_block, dilation, seq_len, device):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Ascending positions of the keys query block q_block may attend to (causality inside its
+        own block is left to the caller)
+        ----------
+        """
+
+        bs = self.block_size
+        blocks = [q_block - i * dilation for i in range(self.window)]
+        blocks = [b for b in reversed(blocks) if b >= 0]
+
+        ranges = []
+        if(self.kind == "global"):
+            first = blocks[0] * bs
+            ranges.append(torch.arange(0, first, self.global_every, device=device))
+
+        for b in blocks:
+            ranges.append(torch.arange(b * bs, min((b + 1) * bs, seq_len), device=device))
+
+        return torch.cat(ranges)
+
+    # allowed
+    def allowed(self, q_pos, k_pos, num_heads):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Boolean mask (num_heads, ..., len_q, len_k) of the query / key pairs the pattern keeps, for
+        absolute positions q_pos (..., len_q, 1) and k_pos (..., 1, len_k). Includes causality.
+        ----------
+        """
+
+        q_block = torch.div(q_pos, self.block_size, rounding_mode="floor")
+        k_block = torch.div(k_pos, self.block_size, rounding_mode="floor")
+        delta = q_block - k_block
+
+        masks = []
+        for first, end, dilation in self.head_groups(num_heads):
+            keep = (k_pos <= q_pos) & (delta % dilation == 0) & (delta < dilation * self.window)
+            if(self.kind == "global"):
+                keep = keep | ((k_pos <= q_pos) & (k_pos % self.global_every == 0))
+            masks.extend([keep] * (end - first))
+
+        return torch.stack(masks)
+
+# sparse_attention_rpr
+def sparse_attention_rpr(query, self_attn, pattern, training=False):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Block-sparse causal self-attention with RPR for query (seq_len, batch_size, embed_dim) under
+    pattern (an AttentionPattern).
+
+    Each query block gathers only the keys of its pattern and attends to them densely, so masked
+    blocks are never computed: time and memory are O(seq_len * window * block_size) for local and
+    dilated patterns instead of O(seq_len^2). The relative term uses the true query / key distance
+    of every gathered pair (Er rows gathered by distance, same indexing as _relative_logits), so
+    Er trained with full attention carries over. In training each block is checkpointed like
+    blockwise_attention_rpr.
+    ----------
+    """
+
+    tgt_len, bsz, embed_dim = query.size()
+    num_heads = self_attn.num_heads
+    head_dim = embed_dim // num_heads
+    scaling = float(head_dim) ** -0.5
+
+    q, k, v = self_attn.in_proj(query).chunk(3, dim=-1)
+    q = q * scaling
+
+    # (batch_size, num_heads, seq_len, head_dim)
+    q = q.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+    k = k.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+    v = v.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+
+    # Row d embeds distance d
+    Er_d = None
+    if(self_attn.Er is not None):
+        Er_d = self_attn.Er.flip([0])
+        if(tgt_len > Er_d.shape[0]):
+            Er_d = F.pad(Er_d, (0, 0, 0, tgt_len - Er_d.shape[0]))
+
+    dropout_p = self_attn.dropout if training else 0.0
+    bs = pattern.block_size
+
+    groups = []
+    for first, end, dilation in pattern.head_groups(num_heads):
+        q_g, k_g, v_g = q[:, first:end], k[:, first:end], v[:, first:end]
+
+        outputs = []
+        for q_block, start in enumerate(range(0, tgt_len, bs)):
+            key_pos = pattern.key_positions(q_block, dilation, tgt_len, q.device)
+            args = (q_g[:, :, start:start + bs], k_g, v_g, key_pos, start, Er_d, dropout_p)
+
+            if(training and torch.is_grad_enabled()):
+                outputs.append(checkpoint(_sparse_block, *args, use_reentrant=False))
+            else:
+                outputs.append(_sparse_block(*args))
+
+        groups.append(torch.cat(outputs, dim=2))
+
+    attn_output = torch.cat(groups, dim=1)
+    attn_output = attn_output.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)
+    attn_output = self_attn.out_proj(attn_output)
+
+    return attn_output
+
+def _sparse_block(q, k, v, key_pos, start, Er_d, dropout_p):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Attention of the queries q starting at position start to the keys and values at key_pos
+    ----------
+    """
+
+    k = k.index_select(2, key_pos)
+    v = v.index_select(2, key_pos)
+
+    q_pos = torch.arange(start, start + q.shape[-2], device=q.device).unsqueeze(1)
+    distances = q_pos - key_pos.unsqueeze(0)
+
+    attn_output_weights = torch.matmul(q, k.transpose(-2, -1))
+
+    if(Er_d is not None):
+        # (len_q, n_keys, head_dim) relative embedding of every pair
+        er = Er_d[distances.clamp(min=0)]
+        attn_output_weights += torch.einsum("bhqd,qkd->bhqk", q, er)
+
+    attn_output_weights = attn_output_weights.masked_fill(distances < 0, float("-inf"))
+    attn_output_weights = F.softmax(attn_output_weights, dim=-1, dtype=TORCH_FLOAT)
+    attn_output_weights = F.dropout(attn_output_weights, p=dropout_p, training=dropout_p > 0)
+
+    return torch.matmul(attn_output_weights, v)
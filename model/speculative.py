@@ -0,0 +1,113 @@
+import torch
+
+from utilities.constants import *
+
+from .sampling import PianoRollSampler
+
+# speculative_generate
+@torch.no_grad()
+def speculative_generate(model, draft_model, primer, target_seq_length=1024, n_draft=4, sampler=None):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Speculative decoding (https://arxiv.org/abs/2211.17192) of a single primer (primer_len, 84, 5).
+    The small draft_model proposes n_draft frames one at a time, then model scores all of them in
+    one forward_step and keeps the longest accepted prefix. Returns the sequence (primer included)
+    and a dict with the number of proposed and accepted draft frames.
+
+    Acceptance rule: frames are products of independent Bernoulli cells, and the usual residual
+    distribution max(0, p - q) over whole frames can't be sampled. Instead every cell is verified
+    on its own. A drafted cell value x is kept with probability min(1, p(x) / q(x)) and flipped
+    otherwise, which gives exactly a Bernoulli(p) cell. Cells stay independent, so the verified
+    frame is an exact sample of model's frame distribution. A draft frame is accepted when none
+    of its cells flipped. At the first rejected frame the corrected frame is kept and drafting
+    restarts after it. When all frames are accepted, one extra frame is sampled from model's last
+    prediction. The output therefore has the same distribution as sampling model alone.
+
+    sampler (default PianoRollSampler()) gives both models' cell probabilities. max_polyphony and
+    greedy act on whole sampled frames, so they are not supported. Rejected drafts are rolled back
+    by truncating the caches, so both models need full attention (a linear attention state can't
+    be rolled back).
+    ----------
+    """
+
+    assert (not model.training) and (not draft_model.training), "Cannot generate while in training mode"
+    assert model.attention == "full" and draft_model.attention == "full", "Speculative decoding needs full attention in both models"
+    assert target_seq_length <= model.max_seq, "target_seq_length must not exceed max_sequence"
+    assert len(primer) > 0, "Primer must have at least one frame"
+
+    if(sampler is None):
+        sampler = PianoRollSampler()
+    assert sampler.max_polyphony is None and not sampler.greedy, "Speculative decoding needs independent Bernoulli cells"
+
+    device  = model._float_param().device
+    primer  = primer.type(TORCH_FLOAT).to(device)
+    max_len = target_seq_length + n_draft + 1
+
+    cache       = model.init_cache(1, max_len)
+    draft_cache = draft_model.init_cache(1, max_len)
+
+    # Both caches hold every frame but the last emitted one (pending)
+    if(len(primer) > 1):
+        model.forward_step(primer[:-1].unsqueeze(0), cache)
+        draft_model.forward_step(primer[:-1].unsqueeze(0), draft_cache)
+
+    out = torch.zeros((max_len, 84, 5), dtype=TORCH_FLOAT, device=device)
+    out[:len(primer)] = primer
+    n_out = len(primer)
+    pending = primer[-1:]
+
+    stats = {"proposed": 0, "accepted": 0, "rounds": 0}
+    while(n_out < target_seq_length):
+        n_prop = min(n_draft, target_seq_length - n_out)
+
+        # Draft proposals, with their cell probabilities q
+        drafts = []
+        q_probs = []
+        x = pending
+        for _ in range(n_prop):
+            q = sampler.probabilities(draft_model.forward_step(x.unsqueeze(0), draft_cache)[0, -1])
+            x = (torch.rand_like(q) < q).type(TORCH_FLOAT).unsqueeze(0)
+            drafts.append(x)
+            q_probs.append(q)
+
+        drafts = torch.cat(drafts, dim=0)
+        q_probs = torch.stack(q_probs)
+
+        # One model pass over pending plus all proposals gives p for every proposal and one extra
+        p_all = sampler.probabilities(model.forward_step(torch.cat([pending, drafts], dim=0).unsqueeze(0), cache)[0])
+        p_probs = p_all[:-1]
+
+        # Per cell verification
+        drafted_on  = drafts > 0
+        p_x         = torch.where(drafted_on, p_probs, 1.0 - p_probs)
+        q_x         = torch.where(drafted_on, q_probs, 1.0 - q_probs)
+        keep_cell   = torch.rand_like(p_x) * q_x < p_x
+        verified    = torch.where(keep_cell, drafts, 1.0 - drafts)
+
+        frame_ok = keep_cell.flatten(1).all(dim=-1)
+        n_ok = int(frame_ok.long().cumprod(dim=0).sum())
+
+        stats["proposed"] += n_prop
+        stats["accepted"] += n_ok
+        stats["rounds"] += 1
+
+        base = cache.length - n_prop - 1
+        if(n_ok < n_prop):
+            new_frames = verified[:n_ok + 1]
+            cache.truncate(base + 1 + n_ok)
+            draft_cache.truncate(base + 1 + n_ok)
+        else:
+            # The draft never saw its last proposal, the model's extra prediction gives a bonus frame
+            draft_model.forward_step(drafts[-1:].unsqueeze(0), draft_cache)
+            new_frames = drafts
+            if(n_out + n_prop < target_seq_length):
+                bonus = (torch.rand_like(p_all[-1]) < p_all[-1]).type(TORCH_FLOAT).unsqueeze(0)
+                new_frames = torch.cat([drafts, bonus], dim=0)
+
+        out[n_out:n_out + len(new_frames)] = new_frames
+        n_out += len(new_frames)
+        pending = new_frames[-1:]
+
+    return out[:n_out], stats
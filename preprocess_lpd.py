@@ -0,0 +1,48 @@
+import argparse
+
+from dataset.lpd_mmap import convert_lpd_npz
+
+# parse_args
+def parse_args():
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Parses arguments for preprocess_lpd using argparse
+    ----------
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("npz_file", type=str, help="LPD-5 npz file (see download_data.sh)")
+    parser.add_argument("-output_dir", type=str, default="./dataset/lpd_5_mmap", help="Output folder for the memory-mapped dataset")
+    parser.add_argument("-val_p", type=float, default=0.1, help="Fraction of the phrases used for validation")
+    parser.add_argument("-test_p", type=float, default=0.1, help="Fraction of the phrases used for testing")
+    parser.add_argument("--packed", action="store_true", help="Store bit-packed frames (53 bytes instead of 420)")
+
+    return parser.parse_args()
+
+# main
+def main():
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Entry point. Converts an LPD-5 npz to the memory-mapped format of LpdMmapDataset (train.py
+    with --mmap_dataset)
+    ----------
+    """
+
+    args = parse_args()
+
+    print("Converting", args.npz_file, "to", args.output_dir)
+    counts = convert_lpd_npz(args.npz_file, args.output_dir, args.val_p, args.test_p, args.packed)
+
+    print("Num Train:", counts["train"])
+    print("Num Val:", counts["val"])
+    print("Num Test:", counts["test"])
+    print("Done!")
+    print("")
+
+if __name__ == "__main__":
+    main()
@@ -3,30 +3,32 @@ import os
 import pickle
 import json
 import random
-from pathlib import Path
+import multiprocessing
 
+from dataset.token_shards import TokenShardWriter, TOKEN_COLUMNS, VOCAB_FILE, MAX_TOKEN_INDEX
 import third_party.midi_processor.processor as midi_processor
 
 JSON_FILE = "maestro-v2.0.0.json"
 
+# Midi files encoded per process pool task
+FILES_PER_TASK = 4
+
+# Output folder of each split type
+SPLIT_DIRS = {"train": "train", "validation": "val", "test": "test"}
+
 # prep_midi
-def prep_maestro_midi(maestro_root, output_dir):
+def prep_maestro_midi(maestro_root, output_dir, n_workers=1):
     """
     ----------
     Author: Damon Gwinn
     ----------
     Pre-processes the maestro dataset, putting processed midi data (train, eval, test) into the
-    given output folder
+    given output folder as int16 token shards with the vocab alongside (see write_token_shards).
+    Files are encoded in parallel by n_workers processes, files that fail to encode are reported
+    and left out.
     ----------
     """
 
-    train_dir = os.path.join(output_dir, "train")
-    os.makedirs(train_dir, exist_ok=True)
-    val_dir = os.path.join(output_dir, "val")
-    os.makedirs(val_dir, exist_ok=True)
-    test_dir = os.path.join(output_dir, "test")
-    os.makedirs(test_dir, exist_ok=True)
-
     maestro_json_file = os.path.join(maestro_root, JSON_FILE)
     if(not os.path.isfile(maestro_json_file)):
         print("ERROR: Could not find file:", maestro_json_file)
@@ -36,125 +38,38 @@ def prep_maestro_midi(maestro_root, output_dir):
     print("Found", len(maestro_json), "pieces")
     print("Preprocessing...")
 
-    total_count = 0
-    train_count = 0
-    val_count   = 0
-    test_count  = 0
-
-    vocab_note_all = set()
-    vocab_duration_all = set()
-    vocab_chord_all = set()
-
+    jobs = []
     for piece in maestro_json:
         mid         = os.path.join(maestro_root, piece["midi_filename"])
         split_type  = piece["split"]
-        f_name      = mid.split("/")[-1] + ".pickle"
-
-        if(split_type == "train"):
-            o_file = os.path.join(train_dir, f_name)
-            train_count += 1
-        elif(split_type == "validation"):
-            o_file = os.path.join(val_dir, f_name)
-            val_count += 1
-        elif(split_type == "test"):
-            o_file = os.path.join(test_dir, f_name)
-            test_count += 1
-        else:
+        f_name      = os.path.basename(mid)
+
+        if(split_type not in SPLIT_DIRS):
             print("ERROR: Unrecognized split type:", split_type)
             return False
 
-        # prepped = midi_processor.encode_midi(mid)
-        prepped, vocab_note, vocab_duration, vocab_chord = midi_processor.encode_midi_music21(mid)
-        
-        vocab_note_all = vocab_note_all | vocab_note
-        vocab_duration_all = vocab_duration_all | vocab_duration
-        vocab_chord_all = vocab_chord_all | vocab_chord
-
-        o_stream = open(o_file, "wb")
-        pickle.dump(prepped, o_stream)
-        o_stream.close()
-
-        total_count += 1
-        if(total_count % 50 == 0):
-            print(total_count, "/", len(maestro_json))
-
-    print("Num Train:", train_count)
-    print("Num Val:", val_count)
-    print("Num Test:", test_count)
-
-    vocab_note_all = {key: index for index, key in enumerate(vocab_note_all)}
-    vocab_duration_all = {key: index for index, key in enumerate(vocab_duration_all)}
-    vocab_chord_all = {key: index for index, key in enumerate(vocab_chord_all)}
-    print("vocab_note:", vocab_note_all)
-    print("vocab_duration:", vocab_duration_all)
-    print("vocab_chord:", vocab_chord_all)
-    # o_stream = open(output_dir + "\\vocab.pickle", "wb")
-    # pickle.dump(vocab_note, o_stream)
-    # pickle.dump(vocab_duration, o_stream)
-    # pickle.dump(vocab_chord, o_stream)
-    # o_stream.close()
-
-    # try:
-    #     with open(output_dir + "\\vocab.pickle", 'rb') as f:
-    #         vocab_note = pickle.load(f)
-    #         vocab_note = {key: index for index, key in enumerate(vocab_note)}
-    #         vocab_duration = pickle.load(f)
-    #         vocab_duration = {key: index for index, key in enumerate(vocab_duration)}
-    #         vocab_chord = pickle.load(f)
-    #         vocab_chord = {key: index for index, key in enumerate(vocab_chord)}
-    # except Exception as e:
-    #     print(f"Failed to load pickle file: {e}")
-    
-    dataset_list = ["train", "test", "val"]
-    for type in dataset_list:
-        path_train = Path(os.path.join(output_dir, type))
-        for file_path in path_train.rglob("*"):  # 匹配所有文件和子文件夹
-            if file_path.is_file():
-                with open(file_path, 'rb') as i_stream:
-                    data = pickle.load(i_stream)
-                    notes = data['notes']
-                    durations = data['durations']
-                    chords = data['chords']
-                    replaced_notes = [vocab_note_all.get(note, note) for note in notes]
-                    replaced_durations = [vocab_duration_all.get(duration, duration) for duration in durations]
-                    replaced_chords = [vocab_chord_all.get(chord, chord) for chord in chords]
-                replaced_data = {"notes": replaced_notes, "durations": replaced_durations, "chords": replaced_chords}
-                print("Replacing: " + str(file_path))
-                with open(file_path, 'wb') as o_stream:
-                    pickle.dump(replaced_data, o_stream)
-
-    print("Write vocab to dict...")
-    with open(output_dir + "\\vocab.pickle", "wb") as o_stream:
-        pickle.dump(vocab_note_all, o_stream)
-        pickle.dump(vocab_duration_all, o_stream)
-        pickle.dump(vocab_chord_all, o_stream)
+        jobs.append((mid, split_type, f_name))
 
+    write_token_shards(jobs, output_dir, n_workers)
     return True
 
-def prep_custom_midi(custom_midi_root, output_dir, valid_p = 0.1, test_p = 0.2):
+def prep_custom_midi(custom_midi_root, output_dir, valid_p = 0.1, test_p = 0.2, n_workers=1):
     """
     ----------
     Author: Corentin Nelias
     ----------
     Pre-processes custom midi files that are not part of the maestro dataset, putting processed midi data (train, eval, test) into the
-    given output folder. 
+    given output folder. Files are encoded in parallel by n_workers processes (see write_token_shards).
     ----------
     """
-    train_dir = os.path.join(output_dir, "train")
-    os.makedirs(train_dir, exist_ok=True)
-    val_dir = os.path.join(output_dir, "val")
-    os.makedirs(val_dir, exist_ok=True)
-    test_dir = os.path.join(output_dir, "test")
-    os.makedirs(test_dir, exist_ok=True)
-    
-    print("Found", len(os.listdir(custom_midi_root)), "pieces")
+
+    pieces = sorted(os.listdir(custom_midi_root))
+    print("Found", len(pieces), "pieces")
     print("Preprocessing custom data...")
-    total_count = 0
-    train_count = 0
-    val_count   = 0
-    test_count  = 0
-    
-    for piece in os.listdir(custom_midi_root):
+
+    # Splits are drawn here in file order, so they don't depend on the workers
+    jobs = []
+    for piece in pieces:
         #deciding whether the data should be part of train, valid or test dataset
         is_train = True if random.random() > valid_p else False
         if not is_train:
@@ -165,36 +80,122 @@ def prep_custom_midi(custom_midi_root, output_dir, valid_p = 0.1, test_p = 0.2):
             split_type = "validation"
         else:
             split_type = "test"
-            
+
         mid         = os.path.join(custom_midi_root, piece)
-        f_name      = piece.split(".")[0] + ".pickle"
-
-        if(split_type == "train"):
-            o_file = os.path.join(train_dir, f_name)
-            train_count += 1
-        elif(split_type == "validation"):
-            o_file = os.path.join(val_dir, f_name)
-            val_count += 1
-        elif(split_type == "test"):
-            o_file = os.path.join(test_dir, f_name)
-            test_count += 1
-        
-        # prepped = midi_processor.encode_midi(mid)
-        prepped = midi_processor.encode_midi_music21(mid)
-
-        o_stream = open(o_file, "wb")
-        pickle.dump(prepped, o_stream)
-        o_stream.close()
-
-        total_count += 1
-        if(total_count % 50 == 0):
-            print(total_count, "/", len(os.listdir(custom_midi_root)))
-
-    print("Num Train:", train_count)
-    print("Num Val:", val_count)
-    print("Num Test:", test_count)
+        f_name      = piece.split(".")[0]
+
+        jobs.append((mid, split_type, f_name))
+
+    write_token_shards(jobs, output_dir, n_workers)
     return True
 
+# write_token_shards
+def write_token_shards(jobs, output_dir, n_workers=1):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Encodes the midi files of jobs, a list of (midi file, split type, piece name), and writes them
+    in a single pass: each piece is mapped to vocab indices as it comes back from encode_files and
+    added to the TokenShardWriter of its split folder (train, val, test), read back by
+    TokenShardDataset. Nothing is written per file.
+
+    Vocab indices are given in order of first appearance over the jobs, so they don't depend on
+    scheduling. The run stops at the first piece that takes a vocab past what int16 shards hold
+    (see MAX_TOKEN_INDEX). The vocab_note, vocab_duration and vocab_chord dicts are pickled one
+    after another to VOCAB_FILE in output_dir, their sizes are the pad indices of the shards.
+
+    Returns the number of pieces written to each split.
+    ----------
+    """
+
+    writers = {split_type: TokenShardWriter(os.path.join(output_dir, split_dir)) for split_type, split_dir in SPLIT_DIRS.items()}
+    counts = {split_type: 0 for split_type in SPLIT_DIRS}
+    vocabs = ({}, {}, {})
+
+    for (mid, split_type, f_name), prepped, error in encode_files(jobs, n_workers):
+        if(error is not None):
+            print("ERROR: Could not encode", mid, "-", error)
+            continue
+
+        columns = [[vocab.setdefault(token, len(vocab)) for token in prepped[column]] for vocab, column in zip(vocabs, TOKEN_COLUMNS)]
+        for vocab, column in zip(vocabs, TOKEN_COLUMNS):
+            if(len(vocab) > MAX_TOKEN_INDEX + 1):
+                raise ValueError("Too many distinct " + column + " for int16 shards (at " + mid + ")")
+
+        writers[split_type].add(f_name, columns)
+        counts[split_type] += 1
+
+    for writer in writers.values():
+        writer.close([len(vocab) for vocab in vocabs])
+
+    print("Num Train:", counts["train"])
+    print("Num Val:", counts["validation"])
+    print("Num Test:", counts["test"])
+
+    vocab_note, vocab_duration, vocab_chord = vocabs
+    print("vocab_note:", vocab_note)
+    print("vocab_duration:", vocab_duration)
+    print("vocab_chord:", vocab_chord)
+
+    print("Write vocab to dict...")
+    with open(os.path.join(output_dir, VOCAB_FILE), "wb") as o_stream:
+        pickle.dump(vocab_note, o_stream)
+        pickle.dump(vocab_duration, o_stream)
+        pickle.dump(vocab_chord, o_stream)
+
+    return counts
+
+# encode_files
+def encode_files(jobs, n_workers=1):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Encodes the midi files of jobs (tuples starting with the midi file) with encode_midi_music21
+    in a pool of n_workers processes (in this process if n_workers is 1). Files go out in tasks
+    of FILES_PER_TASK.
+
+    Yields (job, tokens, error) in job order, so results don't depend on scheduling. tokens is the
+    notes, durations and chords dict of the file, or None if it failed to encode with error (the
+    run goes on).
+    ----------
+    """
+
+    tasks = [[job[0] for job in jobs[i:i + FILES_PER_TASK]] for i in range(0, len(jobs), FILES_PER_TASK)]
+
+    done = 0
+    for task_results in _pool_imap(_encode_task, tasks, n_workers):
+        for prepped, error in task_results:
+            yield jobs[done], prepped, error
+            done += 1
+
+            if(done % 50 == 0):
+                print(done, "/", len(jobs))
+
+def _pool_imap(func, tasks, n_workers):
+    # Results of func over tasks in task order
+    if(n_workers <= 1):
+        for task in tasks:
+            yield func(task)
+        return
+
+    with multiprocessing.Pool(n_workers) as pool:
+        for result in pool.imap(func, tasks):
+            yield result
+
+def _encode_task(mids):
+    results = []
+    for mid in mids:
+        try:
+            prepped, _, _, _ = midi_processor.encode_midi_music21(mid)
+        except Exception as e:
+            results.append((None, repr(e)))
+            continue
+
+        results.append(({column: prepped[column] for column in TOKEN_COLUMNS}, None))
+
+    return results
 
 # parse_args
 def parse_args():
@@ -211,6 +212,7 @@ def parse_args():
     parser.add_argument("root", type=str, help="Root folder for the Maestro dataset or for custom data.")
     parser.add_argument("-output_dir", type=str, default="./dataset/e_piano", help="Output folder to put the preprocessed midi into.")
     parser.add_argument("--custom_dataset", action="store_true", help="Whether or not the specified root folder contains custom data.")
+    parser.add_argument("-n_workers", type=int, default=os.cpu_count(), help="Number of processes encoding midi files (1 encodes in this process)")
 
     return parser.parse_args()
 
@@ -230,9 +232,9 @@ def main():
 
     print("Preprocessing midi files and saving to", output_dir)
     if args.custom_dataset:
-        prep_custom_midi(root, output_dir)
+        prep_custom_midi(root, output_dir, n_workers=args.n_workers)
     else:
-        prep_maestro_midi(root, output_dir)
+        prep_maestro_midi(root, output_dir, n_workers=args.n_workers)
     print("Done!")
     print("")
 
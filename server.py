@@ -0,0 +1,269 @@
+import asyncio
+import base64
+import json
+import numpy as np
+import torch
+
+from utilities.argument_funcs import parse_server_args, print_server_args, parse_per_track
+from utilities.batch_scheduler import BatchScheduler, GenerationRequest
+from utilities.piano_roll import MidiStreamWriter
+from model.music_transformer import MusicTransformer
+from model.sampling import PianoRollSampler
+from model.quantization import quantize_dynamic_int8
+
+from utilities.constants import *
+from utilities.device import get_device, use_cuda
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+# frames_to_notes
+def frames_to_notes(frames):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Converts binary frames (n_frames, 84, 5) into a list with the sounding [pitch, track] pairs of
+    each frame. Pitches are indices into the 84 piano-roll pitches.
+    ----------
+    """
+
+    return [np.argwhere(frame > 0).tolist() for frame in frames]
+
+# notes_to_frames
+def notes_to_frames(notes):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Inverse of frames_to_notes. Returns a (n_frames, 84, 5) float tensor. Raises ValueError for a
+    pitch or track out of range.
+    ----------
+    """
+
+    frames = torch.zeros((len(notes), N_PITCHES, N_TRACKS), dtype=TORCH_FLOAT)
+    for i, frame in enumerate(notes):
+        for pitch, track in frame:
+            if(not (0 <= pitch < N_PITCHES and 0 <= track < N_TRACKS)):
+                raise ValueError("Note out of range: " + str([pitch, track]))
+            frames[i, pitch, track] = 1.0
+
+    return frames
+
+# GenerationServer
+class GenerationServer:
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Minimal asyncio HTTP/1.1 front end for a BatchScheduler, served over TCP or a Unix socket.
+
+    POST /generate with a json body {"num_frames": int, "primer": [[[pitch, track], ...], ...]}
+    (primer is optional, default is one empty frame). The response is chunked newline delimited
+    json: one line per streamed chunk with its "frames" in the frames_to_notes format and its midi
+    "events" as [tick, [status, pitch, velocity]] (see MidiStreamWriter), then a final
+    {"done": true, "latency": ..., "ttft": ..., "midi": <base64 midi of primer and generation>}.
+
+    GET /metrics returns the scheduler metrics as json.
+    ----------
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    # handle
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").strip()
+            if(request_line == ""):
+                return
+
+            method, path = request_line.split(" ")[:2]
+
+            headers = {}
+            while(True):
+                line = (await reader.readline()).decode("latin-1").strip()
+                if(line == ""):
+                    break
+                key, _, value = line.partition(":")
+                headers[key.strip().lower()] = value.strip()
+
+            try:
+                content_length = int(headers.get("content-length", 0))
+                if(content_length < 0):
+                    raise ValueError("negative length")
+            except ValueError as e:
+                await self.respond(writer, 400, {"error": "Bad Content-Length: " + str(e)})
+                return
+
+            body = await reader.readexactly(content_length)
+
+            if(path == "/metrics"):
+                if(method != "GET"):
+                    await self.respond(writer, 405, {"error": "Use GET"})
+                else:
+                    await self.respond(writer, 200, self.scheduler.metrics.snapshot())
+            elif(path == "/generate"):
+                if(method != "POST"):
+                    await self.respond(writer, 405, {"error": "Use POST"})
+                else:
+                    await self.generate(reader, writer, body)
+            else:
+                await self.respond(writer, 404, {"error": "Unknown path " + path})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # respond
+    async def respond(self, writer, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        head = "HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+        writer.write((head % (status, HTTP_REASONS[status], len(data))).encode("latin-1") + data)
+        await writer.drain()
+
+    # send_chunk
+    async def send_chunk(self, writer, payload):
+        data = (json.dumps(payload) + "\n").encode("utf-8")
+        writer.write(("%x\r\n" % len(data)).encode("latin-1") + data + b"\r\n")
+        await writer.drain()
+
+    # generate
+    async def generate(self, reader, writer, body):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Submits a generation request and streams its frames back as they are sampled. The request
+        is cancelled if the client goes away before it is done.
+        ----------
+        """
+
+        try:
+            params = json.loads(body.decode("utf-8"))
+            num_frames = int(params["num_frames"])
+            primer = notes_to_frames(params.get("primer", [[]]))
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            await self.respond(writer, 400, {"error": "Bad request body: " + str(e)})
+            return
+
+        # Scheduler callbacks run on its thread, so they hand over through the event loop
+        loop = asyncio.get_running_loop()
+        updates = asyncio.Queue()
+
+        on_frames = lambda req, frames: loop.call_soon_threadsafe(updates.put_nowait, frames)
+        on_done = lambda req: loop.call_soon_threadsafe(updates.put_nowait, None)
+
+        request = GenerationRequest(primer, num_frames, on_frames=on_frames, on_done=on_done)
+        try:
+            self.scheduler.submit(request)
+        except ValueError as e:
+            await self.respond(writer, 400, {"error": str(e)})
+            return
+
+        # The connection is closed after the response and the body was read, so this read only
+        # ends when the client disconnects
+        disconnect = asyncio.ensure_future(self.cancel_on_disconnect(reader, request))
+
+        try:
+            head = "HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+            writer.write(head.encode("latin-1"))
+
+            # The primer is written first so the streamed events continue after it
+            midi_writer = MidiStreamWriter()
+            midi_writer.write(primer)
+
+            while(True):
+                frames = await updates.get()
+                if(frames is None):
+                    break
+                events = [[tick, list(message)] for tick, message in midi_writer.write(frames)]
+                await self.send_chunk(writer, {"frames": frames_to_notes(frames), "events": events})
+        finally:
+            # Frees the batch row if writing to the client failed
+            disconnect.cancel()
+            if(request.done_time is None):
+                request.cancel()
+
+        if(request.error is not None):
+            await self.send_chunk(writer, {"done": True, "error": request.error})
+        else:
+            await self.send_chunk(writer, {
+                "done": True,
+                "latency": request.latency,
+                "ttft": request.time_to_first_frame,
+                "midi": base64.b64encode(midi_writer.close()).decode("ascii")
+            })
+
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    # cancel_on_disconnect
+    async def cancel_on_disconnect(self, reader, request):
+        try:
+            await reader.read()
+        except ConnectionError:
+            pass
+        request.cancel()
+
+# serve
+async def serve(server, args):
+    if(args.socket is not None):
+        tcp = await asyncio.start_unix_server(server.handle, path=args.socket)
+        print("Serving on unix socket", args.socket)
+    else:
+        tcp = await asyncio.start_server(server.handle, args.host, args.port)
+        print("Serving on", args.host + ":" + str(args.port))
+
+    async with tcp:
+        await tcp.serve_forever()
+
+# main
+def main():
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Entry point. Loads the model once and serves generation requests until interrupted
+    ----------
+    """
+
+    args = parse_server_args()
+    print_server_args(args)
+
+    if(args.force_cpu or args.quantize):
+        use_cuda(False)
+        print("WARNING: Forced CPU usage, expect model to perform slower")
+        print("")
+
+    model = MusicTransformer(n_layers=args.n_layers, num_heads=args.num_heads,
+                d_model=args.d_model, dim_feedforward=args.dim_feedforward,
+                max_sequence=args.max_sequence, rpr=args.rpr).to(get_device())
+
+    if(args.model_weights is not None):
+        model.load_state_dict(torch.load(args.model_weights, map_location=get_device()))
+    else:
+        print("WARNING: No model_weights given, serving a randomly initialized model")
+
+    model.eval()
+
+    if(args.quantize):
+        print("Quantizing model to int8")
+        model = quantize_dynamic_int8(model)
+
+    sampler = PianoRollSampler(temperature=args.temperature, thresholds=parse_per_track(args.thresholds, float),
+                               top_k=args.top_k_notes, max_polyphony=parse_per_track(args.max_polyphony, int),
+                               greedy=args.greedy)
+
+    scheduler = BatchScheduler(model, sampler, max_batch=args.max_batch, stream_interval=args.stream_interval)
+    scheduler.start()
+
+    try:
+        asyncio.run(serve(GenerationServer(scheduler), args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.stop()
+
+
+if __name__ == "__main__":
+    main()
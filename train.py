@@ -9,16 +9,19 @@ from torch.utils.data import DataLoader
 from torch.optim import Adam
 
 from dataset.e_piano import create_epiano_datasets,create_lpd_datasets, compute_epiano_accuracy
+from dataset.segments import create_segment_datasets, SegmentSampler
+from dataset.lpd_mmap import create_lpd_mmap_datasets, unpack_collate, active_collate
 
 from model.music_transformer import MusicTransformer
-from model.loss import SmoothCrossEntropyLoss
-from torch.nn import BCEWithLogitsLoss
+from model.sparse_attention import AttentionPattern
+from model.loss import SmoothCrossEntropyLoss, SmoothBCEWithLogitsLoss
 
 from utilities.constants import *
 from utilities.device import get_device, use_cuda
 from utilities.lr_scheduling import LrStepTracker, get_lr
 from utilities.argument_funcs import parse_train_args, print_train_args, write_model_params
-from utilities.run_model import train_epoch, eval_model
+from utilities.run_model import train_epoch, train_epoch_segments, eval_model
+from utilities.precision import keep_norms_fp32, MasterWeights
 
 CSV_HEADER = ["Epoch", "Learn rate", "Avg Train loss", "Train Accuracy", "Avg Eval loss", "Eval accuracy"]
 
@@ -75,16 +78,60 @@ def main():
         tensorboad_dir = os.path.join(args.output_dir, "tensorboard")
         tensorboard_summary = SummaryWriter(log_dir=tensorboad_dir)
 
+    if(args.mem_len is not None and not args.mmap_dataset):
+        print("ERROR: Segment recurrence (-mem_len) reads whole pieces from a --mmap_dataset (see preprocess_lpd.py)")
+        return
+
+    if(args.mem_len is not None and args.attn_pattern is not None):
+        print("ERROR: Segment recurrence (-mem_len) does not support attention patterns (-attn_pattern)")
+        return
+
     ##### Datasets #####
-    train_dataset, val_dataset, test_dataset = create_lpd_datasets(args.input_dir, args.max_sequence)
+    if(args.unpack_in_workers and not args.mmap_dataset):
+        print("ERROR: Unpacking in workers (--unpack_in_workers) needs a bit-packed --mmap_dataset")
+        return
 
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, num_workers=args.n_workers, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, num_workers=args.n_workers)
-    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.n_workers)
+    if(args.sparse_input and not args.mmap_dataset):
+        print("ERROR: Sparse input frames (--sparse_input) need a --mmap_dataset")
+        return
+
+    if(args.mmap_dataset):
+        train_dataset, val_dataset, test_dataset = create_lpd_mmap_datasets(args.input_dir, args.max_sequence)
+    else:
+        train_dataset, val_dataset, test_dataset = create_lpd_datasets(args.input_dir, args.max_sequence)
+
+    if(args.unpack_in_workers and not train_dataset.packed):
+        print("ERROR: Unpacking in workers (--unpack_in_workers) needs a dataset converted with preprocess_lpd.py --packed")
+        return
+
+    # Bit-packed frames are unpacked on the device unless asked for in the workers
+    if(args.sparse_input):
+        collate_fn = active_collate
+    elif(args.unpack_in_workers):
+        collate_fn = unpack_collate
+    else:
+        collate_fn = None
+
+    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, num_workers=args.n_workers, shuffle=True, collate_fn=collate_fn)
+    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, num_workers=args.n_workers, collate_fn=collate_fn)
+    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.n_workers, collate_fn=collate_fn)
+
+    # Segment recurrence trains on consecutive segments of whole pieces, evaluation stays on windows
+    if(args.mem_len is not None):
+        segment_dataset, _, _ = create_segment_datasets(args.input_dir, args.max_sequence)
+        segment_sampler = SegmentSampler(segment_dataset.lengths(), args.batch_size, args.max_sequence)
+        segment_loader = DataLoader(segment_dataset, batch_sampler=segment_sampler, num_workers=args.n_workers)
+
+    attn_pattern = None
+    if(args.attn_pattern is not None):
+        attn_pattern = AttentionPattern(args.attn_pattern, args.pattern_block, args.pattern_window, args.pattern_dilation)
 
     model = MusicTransformer(n_layers=args.n_layers, num_heads=args.num_heads,
                 d_model=args.d_model, dim_feedforward=args.dim_feedforward, dropout=args.dropout,
-                max_sequence=args.max_sequence, rpr=args.rpr).to("cuda")
+                max_sequence=args.max_sequence, rpr=args.rpr, attn_block_size=args.attn_block_size,
+                checkpoint=args.checkpoint, checkpoint_every=args.checkpoint_every,
+                attn_pattern=attn_pattern, attention=args.attention, feature_map=args.feature_map,
+                ff_chunk_size=args.ff_chunk_size).to(get_device())
 
     ##### Continuing from previous training session #####
     start_epoch = BASELINE_EPOCH
@@ -99,6 +146,16 @@ def main():
         print("ERROR: Need continue weights (-continue_weights) when using continue_epoch")
         return
 
+    ##### bf16 with layer norm in fp32, optionally fp32 master weights for a bf16 model #####
+    master_weights = None
+    if(args.precision == "bf16"):
+        keep_norms_fp32(model)
+        if(args.master_weights):
+            master_weights = MasterWeights(model)
+    elif(args.master_weights):
+        print("ERROR: Master weights (--master_weights) need -precision bf16")
+        return
+
     ##### Lr Scheduler vs static lr #####
     if(args.lr is None):
         if(args.continue_epoch is None):
@@ -111,17 +168,22 @@ def main():
     else:
         lr = args.lr
 
-    ##### Not smoothing evaluation loss #####
-    eval_loss_func = BCEWithLogitsLoss()
+    ##### Not smoothing evaluation loss (padding frames are still masked) #####
+    eval_loss_func = SmoothBCEWithLogitsLoss()
 
-    ##### SmoothCrossEntropyLoss or CrossEntropyLoss for training #####
+    ##### Label smoothed or plain binary cross entropy for training #####
     if(args.ce_smoothing is None):
         train_loss_func = eval_loss_func
     else:
-        train_loss_func = BCEWithLogitsLoss()
+        train_loss_func = SmoothBCEWithLogitsLoss(args.ce_smoothing)
 
     ##### Optimizer #####
-    opt = Adam(model.parameters(), lr=lr, betas=(ADAM_BETA_1, ADAM_BETA_2), eps=ADAM_EPSILON)
+    if(master_weights is None):
+        opt_params = model.parameters()
+    else:
+        opt_params = master_weights.params()
+
+    opt = Adam(opt_params, lr=lr, betas=(ADAM_BETA_1, ADAM_BETA_2), eps=ADAM_EPSILON)
 
     if(args.lr is None):
         lr_scheduler = LambdaLR(opt, lr_stepper.step)
@@ -151,7 +213,13 @@ def main():
             print("")
 
             # Train
-            train_epoch(epoch+1, model, train_loader, train_loss_func, opt, lr_scheduler, args.print_modulus)
+            if(args.mem_len is None):
+                train_epoch(epoch+1, model, train_loader, train_loss_func, opt, lr_scheduler, args.print_modulus, args.head_chunk_size,
+                            args.precision, master_weights)
+            else:
+                segment_sampler.set_epoch(epoch)
+                train_epoch_segments(epoch+1, model, segment_loader, train_loss_func, opt, lr_scheduler, args.print_modulus, args.mem_len,
+                                     args.precision, master_weights)
 
             print(SEPERATOR)
             print("Evaluating:")
@@ -160,8 +228,14 @@ def main():
             print("Baseline model evaluation (Epoch 0):")
 
         # Eval
-        train_loss, train_acc = eval_model(model, train_loader, train_loss_func)
-        eval_loss, eval_acc = eval_model(model, test_loader, eval_loss_func)
+        train_loss, train_acc = eval_model(model, train_loader, train_loss_func, args.precision)
+        eval_loss, eval_acc = eval_model(model, test_loader, eval_loss_func, args.precision)
+
+        # fp32 weights to save
+        if(master_weights is None):
+            state_dict = model.state_dict()
+        else:
+            state_dict = master_weights.state_dict()
 
         # Learn rate
         lr = get_lr(opt)
@@ -179,13 +253,13 @@ def main():
         if(eval_acc > best_eval_acc):
             best_eval_acc = eval_acc
             best_eval_acc_epoch  = epoch+1
-            torch.save(model.state_dict(), best_acc_file)
+            torch.save(state_dict, best_acc_file)
             new_best = True
 
         if(eval_loss < best_eval_loss):
             best_eval_loss       = eval_loss
             best_eval_loss_epoch = epoch+1
-            torch.save(model.state_dict(), best_loss_file)
+            torch.save(state_dict, best_loss_file)
             new_best = True
 
         # Writing out new bests
@@ -209,7 +283,7 @@ def main():
         if((epoch+1) % args.weight_modulus == 0):
             epoch_str = str(epoch+1).zfill(PREPEND_ZEROS_WIDTH)
             path = os.path.join(weights_folder, "epoch_" + epoch_str + ".pickle")
-            torch.save(model.state_dict(), path)
+            torch.save(state_dict, path)
 
         with open(results_file, "a", newline="") as o_stream:
             writer = csv.writer(o_stream)
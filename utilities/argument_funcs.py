@@ -1,6 +1,6 @@
 import argparse
 
-from .constants import SEPERATOR
+from .constants import SEPERATOR, BENCHMARK_MODES, CHECKPOINT_MODES, ATTENTION_PATTERNS, ATTENTION_TYPES, FEATURE_MAPS, PRECISIONS
 
 # parse_train_args
 def parse_train_args():
@@ -15,6 +15,9 @@ def parse_train_args():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-input_dir", type=str, default="./dataset/lpd_5", help="Folder of preprocessed and pickled midi files")
+    parser.add_argument("--mmap_dataset", action="store_true", help="input_dir is a memory-mapped LPD-5 dataset written by preprocess_lpd.py")
+    parser.add_argument("--unpack_in_workers", action="store_true", help="Unpack a bit-packed --mmap_dataset in the DataLoader workers instead of on the device")
+    parser.add_argument("--sparse_input", action="store_true", help="Feed the model sparse active-note frames built in the DataLoader workers (sparse embedding path)")
     parser.add_argument("-output_dir", type=str, default="./saved_models", help="Folder to save model weights. Saves one every epoch")
     parser.add_argument("-vocab_dir", type=str, default="./dataset/maestro2/vocab.pickle", help="The vocabulary generated during the preprocessing stage")
     parser.add_argument("-weight_modulus", type=int, default=1, help="How often to save epoch weights (ex: value of 10 means save every 10 epochs)")
@@ -41,6 +44,20 @@ def parse_train_args():
     parser.add_argument("-dim_feedforward", type=int, default=1024, help="Dimension of the feedforward layer")
 
     parser.add_argument("-dropout", type=float, default=0.1, help="Dropout rate")
+    parser.add_argument("-attn_block_size", type=int, default=None, help="Query block size for memory efficient RPR attention (default is full attention)")
+    parser.add_argument("-checkpoint", type=str, default=None, choices=CHECKPOINT_MODES, help="Activation checkpointing of RPR layers: layers (every checkpoint_every-th layer) or attention (attention blocks only)")
+    parser.add_argument("-checkpoint_every", type=int, default=1, help="With -checkpoint layers, checkpoint every k-th layer (1 is every layer)")
+    parser.add_argument("-attn_pattern", type=str, default=None, choices=ATTENTION_PATTERNS, help="Block-sparse RPR attention pattern (default is full attention)")
+    parser.add_argument("-pattern_block", type=int, default=64, help="Block size in frames of the attention pattern")
+    parser.add_argument("-pattern_window", type=int, default=4, help="Key blocks each query block attends to under the attention pattern")
+    parser.add_argument("-pattern_dilation", type=int, default=4, help="Block spacing of the dilated heads of the dilated attention pattern")
+    parser.add_argument("-attention", type=str, default="full", choices=ATTENTION_TYPES, help="Encoder attention: full (softmax, optionally RPR) or linear (kernelized, O(L))")
+    parser.add_argument("-feature_map", type=str, default="elu", choices=FEATURE_MAPS, help="Feature map of linear attention")
+    parser.add_argument("-mem_len", type=int, default=None, help="Train with segment recurrence over whole pieces, keeping this many frames of memory (needs --rpr and --mmap_dataset)")
+    parser.add_argument("-ff_chunk_size", type=int, default=None, help="Run the feedforward of RPR or linear layers in sequence chunks of this size")
+    parser.add_argument("-head_chunk_size", type=int, default=None, help="Run the output head and loss in sequence chunks of this size, never holding the full logits")
+    parser.add_argument("-precision", type=str, default="fp32", choices=PRECISIONS, help="Training precision: fp32, or bf16 autocast (softmax, layer norm and loss stay fp32)")
+    parser.add_argument("--master_weights", action="store_true", help="With -precision bf16, store the model in bf16 and keep fp32 master weights for the optimizer")
 
     return parser.parse_args()
 
@@ -56,6 +73,9 @@ def print_train_args(args):
 
     print(SEPERATOR)
     print("input_dir:", args.input_dir)
+    print("mmap_dataset:", args.mmap_dataset)
+    print("unpack_in_workers:", args.unpack_in_workers)
+    print("sparse_input:", args.sparse_input)
     print("output_dir:", args.output_dir)
     print("weight_modulus:", args.weight_modulus)
     print("print_modulus:", args.print_modulus)
@@ -69,6 +89,10 @@ def print_train_args(args):
     print("")
     print("lr:", args.lr)
     print("ce_smoothing:", args.ce_smoothing)
+    print("n_steps:", args.n_steps)
+    print("loss_tolerance:", args.loss_tolerance)
+    print("n_phrases:", args.n_phrases)
+    print("worker_counts:", args.worker_counts)
     print("batch_size:", args.batch_size)
     print("epochs:", args.epochs)
     print("")
@@ -80,6 +104,20 @@ def print_train_args(args):
     print("")
     print("dim_feedforward:", args.dim_feedforward)
     print("dropout:", args.dropout)
+    print("attn_block_size:", args.attn_block_size)
+    print("checkpoint:", args.checkpoint)
+    print("checkpoint_every:", args.checkpoint_every)
+    print("attn_pattern:", args.attn_pattern)
+    print("pattern_block:", args.pattern_block)
+    print("pattern_window:", args.pattern_window)
+    print("pattern_dilation:", args.pattern_dilation)
+    print("attention:", args.attention)
+    print("feature_map:", args.feature_map)
+    print("mem_len:", args.mem_len)
+    print("ff_chunk_size:", args.ff_chunk_size)
+    print("head_chunk_size:", args.head_chunk_size)
+    print("precision:", args.precision)
+    print("master_weights:", args.master_weights)
     print(SEPERATOR)
     print("")
 
@@ -129,6 +167,8 @@ def print_eval_args(args):
     print("force_cpu:", args.force_cpu)
     print("")
     print("batch_size:", args.batch_size)
+    print("beam:", args.beam)
+    print("window:", args.window)
     print("")
     print("rpr:", args.rpr)
     print("max_sequence:", args.max_sequence)
@@ -154,13 +194,34 @@ def parse_generate_args():
 
     parser.add_argument("-midi_root", type=str, default="./dataset/maestro/", help="Midi file to prime the generator with")
     parser.add_argument("-output_dir", type=str, default="./gen", help="Folder to write generated midi to")
-    parser.add_argument("-primer_file", type=str, default=None, help="File path or integer index to the evaluation dataset. Default is to select a random index.")
+    parser.add_argument("-primer_file", type=str, default=None, help="File path or integer index to the evaluation dataset (comma separate for multiple primers). Default is to select a random index.")
     parser.add_argument("--force_cpu", action="store_true", help="Forces model to run on a cpu even when gpu is available")
 
     parser.add_argument("-target_seq_length", type=int, default=1024, help="Target length you'd like the midi to be")
     parser.add_argument("-num_prime", type=int, default=256, help="Amount of messages to prime the generator with")
     parser.add_argument("-model_weights", type=str, default="./saved_models/model.pickle", help="Pickled model weights file saved with torch.save and model.state_dict()")
     parser.add_argument("-beam", type=int, default=0, help="Beam search k. 0 for random probability sample and 1 for greedy")
+    parser.add_argument("-length_penalty", type=float, default=0.0, help="Beam search length normalization exponent (0 for no normalization)")
+    parser.add_argument("-num_samples", type=int, default=1, help="Number of continuations to generate per primer")
+    parser.add_argument("-batch_size", type=int, default=32, help="Number of sequences generated together as one batch")
+    parser.add_argument("-window", type=int, default=None, help="Attention window for long-form generation. Used automatically (as max_sequence) when target_seq_length exceeds max_sequence")
+    parser.add_argument("-end_silence", type=int, default=None, help="End a sequence after this many consecutive empty frames (default is to always generate target_seq_length)")
+
+    parser.add_argument("-draft_weights", type=str, default=None, help="Weights of a small draft model for speculative decoding (off by default)")
+    parser.add_argument("-n_draft", type=int, default=4, help="Frames proposed by the draft model per speculative step")
+    parser.add_argument("--draft_rpr", action="store_true", help="Draft model uses Relative Position Representations")
+    parser.add_argument("-draft_n_layers", type=int, default=2, help="Number of layers of the draft model")
+    parser.add_argument("-draft_num_heads", type=int, default=4, help="Number of heads of the draft model")
+    parser.add_argument("-draft_d_model", type=int, default=256, help="Dimension of the draft model")
+    parser.add_argument("-draft_dim_feedforward", type=int, default=512, help="Dimension of the draft model's feedforward layer")
+
+    parser.add_argument("-temperature", type=float, default=1.0, help="Sampling temperature applied to the note logits")
+    parser.add_argument("-thresholds", type=str, default=None, help="Note probability threshold, one value or one per track (comma separated)")
+    parser.add_argument("-top_k_notes", type=int, default=None, help="Only the k most likely notes of a frame may sound")
+    parser.add_argument("-max_polyphony", type=str, default=None, help="Max notes per frame, one value or one per track (comma separated)")
+    parser.add_argument("--greedy", action="store_true", help="Play every note whose probability reaches the threshold (0.5 by default) instead of sampling")
+    parser.add_argument("--quantize", action="store_true", help="Run an int8 dynamically quantized model (cpu only)")
+    parser.add_argument("-precision", type=str, default="fp32", choices=PRECISIONS, help="Inference precision: fp32, or bf16 autocast")
 
     parser.add_argument("--rpr", action="store_true", help="Use a modified Transformer for Relative Position Representations")
     parser.add_argument("-max_sequence", type=int, default=2048, help="Maximum midi sequence to consider")
@@ -169,6 +230,12 @@ def parse_generate_args():
     parser.add_argument("-d_model", type=int, default=512, help="Dimension of the model (output dim of embedding layers, etc.)")
 
     parser.add_argument("-dim_feedforward", type=int, default=1024, help="Dimension of the feedforward layer")
+    parser.add_argument("-attn_pattern", type=str, default=None, choices=ATTENTION_PATTERNS, help="Block-sparse RPR attention pattern (default is full attention)")
+    parser.add_argument("-pattern_block", type=int, default=64, help="Block size in frames of the attention pattern")
+    parser.add_argument("-pattern_window", type=int, default=4, help="Key blocks each query block attends to under the attention pattern")
+    parser.add_argument("-pattern_dilation", type=int, default=4, help="Block spacing of the dilated heads of the dilated attention pattern")
+    parser.add_argument("-attention", type=str, default="full", choices=ATTENTION_TYPES, help="Encoder attention: full (softmax, optionally RPR) or linear (kernelized, O(L))")
+    parser.add_argument("-feature_map", type=str, default="elu", choices=FEATURE_MAPS, help="Feature map of linear attention")
 
     return parser.parse_args()
 
@@ -192,6 +259,27 @@ def print_generate_args(args):
     print("num_prime:", args.num_prime)
     print("model_weights:", args.model_weights)
     print("beam:", args.beam)
+    print("length_penalty:", args.length_penalty)
+    print("num_samples:", args.num_samples)
+    print("batch_size:", args.batch_size)
+    print("window:", args.window)
+    print("end_silence:", args.end_silence)
+    print("")
+    print("draft_weights:", args.draft_weights)
+    print("n_draft:", args.n_draft)
+    print("draft_rpr:", args.draft_rpr)
+    print("draft_n_layers:", args.draft_n_layers)
+    print("draft_num_heads:", args.draft_num_heads)
+    print("draft_d_model:", args.draft_d_model)
+    print("draft_dim_feedforward:", args.draft_dim_feedforward)
+    print("")
+    print("temperature:", args.temperature)
+    print("thresholds:", args.thresholds)
+    print("top_k_notes:", args.top_k_notes)
+    print("max_polyphony:", args.max_polyphony)
+    print("greedy:", args.greedy)
+    print("quantize:", args.quantize)
+    print("precision:", args.precision)
     print("")
     print("rpr:", args.rpr)
     print("max_sequence:", args.max_sequence)
@@ -200,9 +288,34 @@ def print_generate_args(args):
     print("d_model:", args.d_model)
     print("")
     print("dim_feedforward:", args.dim_feedforward)
+    print("attn_pattern:", args.attn_pattern)
+    print("pattern_block:", args.pattern_block)
+    print("pattern_window:", args.pattern_window)
+    print("pattern_dilation:", args.pattern_dilation)
+    print("attention:", args.attention)
+    print("feature_map:", args.feature_map)
     print(SEPERATOR)
     print("")
 
+# parse_per_track
+def parse_per_track(value, type_func):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Parses a single value or comma separated per-track values given on the command line
+    ----------
+    """
+
+    if(value is None):
+        return None
+
+    values = [type_func(v) for v in value.split(",")]
+    if(len(values) == 1):
+        return values[0]
+
+    return values
+
 # write_model_params
 def write_model_params(args, output_file):
     """
@@ -225,5 +338,312 @@ def write_model_params(args, output_file):
     o_stream.write("d_model: " + str(args.d_model) + "\n")
     o_stream.write("dim_feedforward: " + str(args.dim_feedforward) + "\n")
     o_stream.write("dropout: " + str(args.dropout) + "\n")
+    o_stream.write("attn_block_size: " + str(args.attn_block_size) + "\n")
+    o_stream.write("checkpoint: " + str(args.checkpoint) + "\n")
+    o_stream.write("checkpoint_every: " + str(args.checkpoint_every) + "\n")
+    o_stream.write("attn_pattern: " + str(args.attn_pattern) + "\n")
+    o_stream.write("pattern_block: " + str(args.pattern_block) + "\n")
+    o_stream.write("pattern_window: " + str(args.pattern_window) + "\n")
+    o_stream.write("pattern_dilation: " + str(args.pattern_dilation) + "\n")
+    o_stream.write("attention: " + str(args.attention) + "\n")
+    o_stream.write("feature_map: " + str(args.feature_map) + "\n")
+    o_stream.write("mem_len: " + str(args.mem_len) + "\n")
+    o_stream.write("ff_chunk_size: " + str(args.ff_chunk_size) + "\n")
+    o_stream.write("head_chunk_size: " + str(args.head_chunk_size) + "\n")
+    o_stream.write("precision: " + str(args.precision) + "\n")
+    o_stream.write("master_weights: " + str(args.master_weights) + "\n")
 
     o_stream.close()
+
+# parse_benchmark_args
+def parse_benchmark_args():
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Argparse arguments for benchmarks and numerical checks
+    ----------
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("mode", type=str, choices=BENCHMARK_MODES, help="Which benchmark or check to run")
+    parser.add_argument("-model_weights", type=str, default=None, help="Optional pickled model weights. Default is a randomly initialized model")
+    parser.add_argument("--force_cpu", action="store_true", help="Forces model to run on a cpu even when gpu is available")
+
+    parser.add_argument("-seq_len", type=int, default=256, help="Sequence length to benchmark with")
+    parser.add_argument("-n_primer", type=int, default=16, help="Number of primer frames for generation benchmarks")
+    parser.add_argument("-n_trials", type=int, default=3, help="Number of timed trials to average over")
+    parser.add_argument("-batch_size", type=int, default=8, help="Batch size to benchmark with")
+    parser.add_argument("-beam", type=int, default=4, help="Beam size for beam search benchmarks")
+    parser.add_argument("-window", type=int, default=None, help="Attention window for long-form benchmarks (default is max_sequence)")
+    parser.add_argument("-stream_chunk", type=int, default=4, help="Frames per chunk for streaming benchmarks")
+
+    parser.add_argument("-draft_weights", type=str, default=None, help="Weights of the draft model for speculative benchmarks (default is random, or the main model with --self_draft)")
+    parser.add_argument("-n_draft", type=int, default=4, help="Frames proposed by the draft model per speculative step")
+    parser.add_argument("--draft_rpr", action="store_true", help="Draft model uses Relative Position Representations")
+    parser.add_argument("-draft_n_layers", type=int, default=2, help="Number of layers of the draft model")
+    parser.add_argument("-draft_num_heads", type=int, default=4, help="Number of heads of the draft model")
+    parser.add_argument("-draft_d_model", type=int, default=256, help="Dimension of the draft model")
+    parser.add_argument("-draft_dim_feedforward", type=int, default=512, help="Dimension of the draft model's feedforward layer")
+    parser.add_argument("-attn_block_size", type=int, default=128, help="Query block size for blockwise RPR attention benchmarks")
+    parser.add_argument("-checkpoint_every", type=int, default=2, help="k for the every k-th layer case of checkpoint benchmarks")
+    parser.add_argument("-pattern_block", type=int, default=64, help="Block size in frames of the attention patterns in sparse attention benchmarks")
+    parser.add_argument("-pattern_window", type=int, default=4, help="Key blocks per query block of the attention patterns in sparse attention benchmarks")
+    parser.add_argument("-pattern_dilation", type=int, default=4, help="Block spacing of the dilated heads in sparse attention benchmarks")
+    parser.add_argument("-chunk_sizes", type=str, default="512,256,128,64", help="Comma separated chunk sizes for chunked feedforward / output head benchmarks")
+    parser.add_argument("-seq_lens", type=str, default="512,1024,2048,4096,8192", help="Comma separated sequence lengths for scaling benchmarks")
+    parser.add_argument("-ce_smoothing", type=float, default=0.1, help="Label smoothing for loss benchmarks")
+    parser.add_argument("-n_steps", type=int, default=50, help="Training steps of each loss curve in bf16 benchmarks")
+    parser.add_argument("-loss_tolerance", type=float, default=0.02, help="Largest relative loss curve difference to the fp32 run the bf16 check accepts")
+    parser.add_argument("-n_phrases", type=int, default=1000, help="Number of random LPD-5 phrases for dataset benchmarks")
+    parser.add_argument("-worker_counts", type=str, default="0,2,4", help="Comma separated DataLoader worker counts for dataset benchmarks")
+    parser.add_argument("-input_dir", type=str, default=None, help="Memory-mapped dataset (preprocess_lpd.py) whose test split quantize benchmarks evaluate on (default is random frames)")
+    parser.add_argument("--self_draft", action="store_true", help="Use the main model as its own draft (all proposals are accepted, measures the overhead)")
+    parser.add_argument("-seed", type=int, default=0, help="Random seed")
+
+    parser.add_argument("--rpr", action="store_true", help="Use a modified Transformer for Relative Position Representations")
+    parser.add_argument("-max_sequence", type=int, default=2048, help="Maximum midi sequence to consider")
+    parser.add_argument("-n_layers", type=int, default=6, help="Number of decoder layers to use")
+    parser.add_argument("-num_heads", type=int, default=8, help="Number of heads to use for multi-head attention")
+    parser.add_argument("-d_model", type=int, default=512, help="Dimension of the model (output dim of embedding layers, etc.)")
+
+    parser.add_argument("-dim_feedforward", type=int, default=1024, help="Dimension of the feedforward layer")
+
+    return parser.parse_args()
+
+# print_benchmark_args
+def print_benchmark_args(args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Prints benchmark arguments
+    ----------
+    """
+
+    print(SEPERATOR)
+    print("mode:", args.mode)
+    print("model_weights:", args.model_weights)
+    print("force_cpu:", args.force_cpu)
+    print("")
+    print("seq_len:", args.seq_len)
+    print("n_primer:", args.n_primer)
+    print("n_trials:", args.n_trials)
+    print("batch_size:", args.batch_size)
+    print("beam:", args.beam)
+    print("window:", args.window)
+    print("stream_chunk:", args.stream_chunk)
+    print("draft_weights:", args.draft_weights)
+    print("n_draft:", args.n_draft)
+    print("draft_rpr:", args.draft_rpr)
+    print("draft_n_layers:", args.draft_n_layers)
+    print("draft_num_heads:", args.draft_num_heads)
+    print("draft_d_model:", args.draft_d_model)
+    print("draft_dim_feedforward:", args.draft_dim_feedforward)
+    print("self_draft:", args.self_draft)
+    print("attn_block_size:", args.attn_block_size)
+    print("checkpoint_every:", args.checkpoint_every)
+    print("pattern_block:", args.pattern_block)
+    print("pattern_window:", args.pattern_window)
+    print("pattern_dilation:", args.pattern_dilation)
+    print("seq_lens:", args.seq_lens)
+    print("chunk_sizes:", args.chunk_sizes)
+    print("ce_smoothing:", args.ce_smoothing)
+    print("n_steps:", args.n_steps)
+    print("loss_tolerance:", args.loss_tolerance)
+    print("n_phrases:", args.n_phrases)
+    print("worker_counts:", args.worker_counts)
+    print("input_dir:", args.input_dir)
+    print("seed:", args.seed)
+    print("")
+    print("rpr:", args.rpr)
+    print("max_sequence:", args.max_sequence)
+    print("n_layers:", args.n_layers)
+    print("num_heads:", args.num_heads)
+    print("d_model:", args.d_model)
+    print("")
+    print("dim_feedforward:", args.dim_feedforward)
+    print(SEPERATOR)
+    print("")
+
+# parse_server_args
+def parse_server_args():
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Argparse arguments for the generation server
+    ----------
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-model_weights", type=str, default=None, help="Pickled model weights file saved with torch.save and model.state_dict()")
+    parser.add_argument("--force_cpu", action="store_true", help="Forces model to run on a cpu even when gpu is available")
+
+    parser.add_argument("-host", type=str, default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("-port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("-socket", type=str, default=None, help="Listen on this Unix socket path instead of host and port")
+    parser.add_argument("-max_batch", type=int, default=32, help="Maximum number of requests decoded together")
+    parser.add_argument("-stream_interval", type=int, default=4, help="Number of frames per streamed chunk")
+
+    parser.add_argument("-temperature", type=float, default=1.0, help="Sampling temperature applied to the note logits")
+    parser.add_argument("-thresholds", type=str, default=None, help="Note probability threshold, one value or one per track (comma separated)")
+    parser.add_argument("-top_k_notes", type=int, default=None, help="Only the k most likely notes of a frame may sound")
+    parser.add_argument("-max_polyphony", type=str, default=None, help="Max notes per frame, one value or one per track (comma separated)")
+    parser.add_argument("--greedy", action="store_true", help="Play every note whose probability reaches the threshold (0.5 by default) instead of sampling")
+    parser.add_argument("--quantize", action="store_true", help="Run an int8 dynamically quantized model (cpu only)")
+
+    parser.add_argument("--rpr", action="store_true", help="Use a modified Transformer for Relative Position Representations")
+    parser.add_argument("-max_sequence", type=int, default=2048, help="Maximum midi sequence to consider")
+    parser.add_argument("-n_layers", type=int, default=6, help="Number of decoder layers to use")
+    parser.add_argument("-num_heads", type=int, default=8, help="Number of heads to use for multi-head attention")
+    parser.add_argument("-d_model", type=int, default=512, help="Dimension of the model (output dim of embedding layers, etc.)")
+
+    parser.add_argument("-dim_feedforward", type=int, default=1024, help="Dimension of the feedforward layer")
+
+    return parser.parse_args()
+
+# print_server_args
+def print_server_args(args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Prints generation server arguments
+    ----------
+    """
+
+    print(SEPERATOR)
+    print("model_weights:", args.model_weights)
+    print("force_cpu:", args.force_cpu)
+    print("")
+    print("host:", args.host)
+    print("port:", args.port)
+    print("socket:", args.socket)
+    print("max_batch:", args.max_batch)
+    print("stream_interval:", args.stream_interval)
+    print("")
+    print("temperature:", args.temperature)
+    print("thresholds:", args.thresholds)
+    print("top_k_notes:", args.top_k_notes)
+    print("max_polyphony:", args.max_polyphony)
+    print("greedy:", args.greedy)
+    print("quantize:", args.quantize)
+    print("")
+    print("rpr:", args.rpr)
+    print("max_sequence:", args.max_sequence)
+    print("n_layers:", args.n_layers)
+    print("num_heads:", args.num_heads)
+    print("d_model:", args.d_model)
+    print("")
+    print("dim_feedforward:", args.dim_feedforward)
+    print(SEPERATOR)
+    print("")
+
+# parse_load_test_args
+def parse_load_test_args():
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Argparse arguments for the synthetic load generator
+    ----------
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-host", type=str, default="127.0.0.1", help="Host of the generation server")
+    parser.add_argument("-port", type=int, default=8765, help="Port of the generation server")
+    parser.add_argument("-socket", type=str, default=None, help="Connect to this Unix socket path instead of host and port")
+
+    parser.add_argument("-n_requests", type=int, default=64, help="Total number of requests to send")
+    parser.add_argument("-concurrency", type=int, default=16, help="Number of requests in flight at once")
+    parser.add_argument("-min_frames", type=int, default=32, help="Minimum number of frames per request")
+    parser.add_argument("-max_frames", type=int, default=256, help="Maximum number of frames per request")
+    parser.add_argument("-primer_len", type=int, default=16, help="Number of random primer frames per request")
+    parser.add_argument("-seed", type=int, default=0, help="Random seed")
+
+    return parser.parse_args()
+
+# print_load_test_args
+def print_load_test_args(args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Prints load generator arguments
+    ----------
+    """
+
+    print(SEPERATOR)
+    print("host:", args.host)
+    print("port:", args.port)
+    print("socket:", args.socket)
+    print("")
+    print("n_requests:", args.n_requests)
+    print("concurrency:", args.concurrency)
+    print("min_frames:", args.min_frames)
+    print("max_frames:", args.max_frames)
+    print("primer_len:", args.primer_len)
+    print("seed:", args.seed)
+    print(SEPERATOR)
+    print("")
+
+# parse_export_args
+def parse_export_args():
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Argparse arguments for exporting a model to TorchScript
+    ----------
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-model_weights", type=str, default=None, help="Pickled model weights file saved with torch.save and model.state_dict()")
+    parser.add_argument("-output_file", type=str, default="./saved_models/model_scripted.pt", help="File to write the TorchScript model to")
+    parser.add_argument("--force_cpu", action="store_true", help="Forces model to run on a cpu even when gpu is available")
+
+    parser.add_argument("-n_primer", type=int, default=16, help="Number of primer frames for the equivalence check")
+    parser.add_argument("-n_steps", type=int, default=16, help="Number of single frame steps for the equivalence check")
+
+    parser.add_argument("--rpr", action="store_true", help="Use a modified Transformer for Relative Position Representations")
+    parser.add_argument("-max_sequence", type=int, default=2048, help="Maximum midi sequence to consider")
+    parser.add_argument("-n_layers", type=int, default=6, help="Number of decoder layers to use")
+    parser.add_argument("-num_heads", type=int, default=8, help="Number of heads to use for multi-head attention")
+    parser.add_argument("-d_model", type=int, default=512, help="Dimension of the model (output dim of embedding layers, etc.)")
+
+    parser.add_argument("-dim_feedforward", type=int, default=1024, help="Dimension of the feedforward layer")
+
+    return parser.parse_args()
+
+# print_export_args
+def print_export_args(args):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Prints export arguments
+    ----------
+    """
+
+    print(SEPERATOR)
+    print("model_weights:", args.model_weights)
+    print("output_file:", args.output_file)
+    print("force_cpu:", args.force_cpu)
+    print("")
+    print("n_primer:", args.n_primer)
+    print("n_steps:", args.n_steps)
+    print("")
+    print("rpr:", args.rpr)
+    print("max_sequence:", args.max_sequence)
+    print("n_layers:", args.n_layers)
+    print("num_heads:", args.num_heads)
+    print("d_model:", args.d_model)
+    print("")
+    print("dim_feedforward:", args.dim_feedforward)
+    print(SEPERATOR)
+    print("")
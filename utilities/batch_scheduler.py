@@ -0,0 +1,381 @@
+import queue
+import threading
+import time
+import numpy as np
+import torch
+
+from .constants import *
+
+# GenerationRequest
+class GenerationRequest:
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    One generation job for the BatchScheduler. primer is (primer_len, 84, 5) and num_frames new
+    frames are generated after it.
+
+    on_frames(request, frames) is called from the scheduler thread with every chunk of new frames
+    as a numpy array (n_frames, 84, 5). on_done(request) is called once when the request finishes
+    or fails (error is then set). cancel() frees its batch row before the next decoding step.
+    ----------
+    """
+
+    def __init__(self, primer, num_frames, on_frames=None, on_done=None):
+        self.primer     = primer
+        self.num_frames = num_frames
+        self.on_frames  = on_frames
+        self.on_done    = on_done
+
+        self.generated  = 0
+        self.error      = None
+        self.cancelled  = False
+        self._chunk     = []
+
+        self.submit_time        = time.time()
+        self.first_frame_time   = None
+        self.done_time          = None
+
+    # latency
+    @property
+    def latency(self):
+        if(self.done_time is None):
+            return None
+        return self.done_time - self.submit_time
+
+    # time_to_first_frame
+    @property
+    def time_to_first_frame(self):
+        if(self.first_frame_time is None):
+            return None
+        return self.first_frame_time - self.submit_time
+
+    # add_frame
+    def add_frame(self, frame, stream_interval):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Adds a sampled frame and hands the buffered chunk to on_frames every stream_interval frames
+        and at the end. Returns True once num_frames frames were generated.
+        ----------
+        """
+
+        if(self.first_frame_time is None):
+            self.first_frame_time = time.time()
+
+        self._chunk.append(frame)
+        self.generated += 1
+
+        finished = self.generated >= self.num_frames
+        if(finished or len(self._chunk) >= stream_interval):
+            chunk = np.stack(self._chunk)
+            self._chunk = []
+            if(self.on_frames is not None):
+                self.on_frames(self, chunk)
+
+        return finished
+
+    # cancel
+    def cancel(self):
+        # Safe from any thread, the scheduler drops the request before its next step
+        self.cancelled = True
+
+    # finish
+    def finish(self, error=None):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Marks the request as done (or failed with error) and calls on_done
+        ----------
+        """
+
+        self.error = error
+        self.done_time = time.time()
+        if(self.on_done is not None):
+            self.on_done(self)
+
+# ServerMetrics
+class ServerMetrics:
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Thread safe counters for the generation server: queue depth, batch occupancy per decoding step
+    and latency / time to first frame of recent requests. snapshot() returns them as a dict.
+    ----------
+    """
+
+    def __init__(self, max_batch, history=1000):
+        self.max_batch  = max_batch
+        self.history    = history
+        self.lock       = threading.Lock()
+        self.start_time = time.time()
+
+        self.queue_depth    = 0
+        self.active         = 0
+        self.submitted      = 0
+        self.completed      = 0
+        self.failed         = 0
+        self.steps          = 0
+        self.frames         = 0
+        self.occupancy_sum  = 0.0
+
+        self.latencies  = []
+        self.ttfts      = []
+
+    # record_submit
+    def record_submit(self):
+        with self.lock:
+            self.submitted += 1
+            self.queue_depth += 1
+
+    # record_admit
+    def record_admit(self, n_requests):
+        with self.lock:
+            self.queue_depth -= n_requests
+            self.active += n_requests
+
+    # record_step
+    def record_step(self, batch_size):
+        with self.lock:
+            self.steps += 1
+            self.frames += batch_size
+            self.occupancy_sum += batch_size / self.max_batch
+
+    # record_done
+    def record_done(self, request):
+        with self.lock:
+            self.active -= 1
+            if(request.error is not None):
+                self.failed += 1
+                return
+
+            self.completed += 1
+            self.latencies = (self.latencies + [request.latency])[-self.history:]
+            self.ttfts = (self.ttfts + [request.time_to_first_frame])[-self.history:]
+
+    # snapshot
+    def snapshot(self):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Current metrics as a json serializable dict. Latency percentiles are over the last history
+        completed requests.
+        ----------
+        """
+
+        with self.lock:
+            uptime = time.time() - self.start_time
+            metrics = {
+                "uptime": uptime,
+                "queue_depth": self.queue_depth,
+                "active_requests": self.active,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "steps": self.steps,
+                "frames_per_second": self.frames / uptime if uptime > 0 else 0.0,
+                "mean_batch_size": self.frames / self.steps if self.steps > 0 else 0.0,
+                "mean_batch_occupancy": self.occupancy_sum / self.steps if self.steps > 0 else 0.0,
+            }
+
+            for name, values in (("latency", self.latencies), ("ttft", self.ttfts)):
+                for p in (50, 90, 99):
+                    metrics[name + "_p" + str(p)] = float(np.percentile(values, p)) if values else None
+
+        return metrics
+
+# BatchScheduler
+class BatchScheduler:
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Runs a MusicTransformer in a background thread and serves GenerationRequests with
+    iteration-level scheduling. All running requests share one batch and one AttentionCache.
+    Between decoding steps, waiting requests are prefilled together and merged into the running
+    batch (up to max_batch rows), and requests that reached num_frames are dropped from it, so a
+    long request never holds up a short one.
+
+    Frames are copied to the host every step to stream them, in chunks of stream_interval frames.
+    ----------
+    """
+
+    def __init__(self, model, sampler, max_batch=32, stream_interval=1):
+        assert (not model.training), "Cannot generate while in training mode"
+
+        self.model              = model
+        self.sampler            = sampler
+        self.max_batch          = max_batch
+        self.stream_interval    = stream_interval
+        self.metrics            = ServerMetrics(max_batch)
+
+        self.pending    = queue.Queue()
+        self._stop      = threading.Event()
+        self._thread    = threading.Thread(target=self._run, daemon=True)
+
+    # start
+    def start(self):
+        self._thread.start()
+
+    # stop
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    # submit
+    def submit(self, request):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Queues a request. It joins the running batch before the next decoding step with a free row.
+        Raises ValueError for a request that cannot be served.
+        ----------
+        """
+
+        if(len(request.primer) == 0):
+            raise ValueError("Primer must have at least one frame")
+        if(request.num_frames <= 0):
+            raise ValueError("num_frames must be positive")
+        if(len(request.primer) + request.num_frames > self.model.max_seq):
+            raise ValueError("Primer plus num_frames must not exceed max_sequence")
+
+        self.metrics.record_submit()
+        self.pending.put(request)
+
+    # _run
+    def _run(self):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Scheduler loop. Blocks on the queue while idle, otherwise admits waiting requests and runs
+        one decoding step for the whole batch. If prefilling fails only the waiting requests fail,
+        the running batch goes on. If a decoding step fails every running request fails.
+        ----------
+        """
+
+        active  = []
+        cache   = None
+        y       = None
+
+        while(not self._stop.is_set()):
+            waiting = []
+            if(len(active) == 0):
+                try:
+                    waiting.append(self.pending.get(timeout=0.1))
+                except queue.Empty:
+                    continue
+
+            while(len(active) + len(waiting) < self.max_batch):
+                try:
+                    waiting.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            if(len(waiting) > 0):
+                self.metrics.record_admit(len(waiting))
+                waiting = self._drop_cancelled(waiting)
+
+            if(len(waiting) > 0):
+                try:
+                    with torch.set_grad_enabled(False):
+                        cache, y = self._admit(active, waiting, cache, y)
+                    active = active + waiting
+                except Exception as e:
+                    self._fail(waiting, e)
+
+            if(len(active) == 0):
+                continue
+
+            try:
+                with torch.set_grad_enabled(False):
+                    active, cache, y = self._step(active, cache, y)
+            except Exception as e:
+                self._fail(active, e)
+                active, cache, y = [], None, None
+
+    # _fail
+    def _fail(self, requests, error):
+        for request in requests:
+            request.finish(error=str(error))
+            self.metrics.record_done(request)
+
+    # _drop_cancelled
+    def _drop_cancelled(self, requests):
+        # Finishes the cancelled requests, returns the others
+        keep = []
+        for request in requests:
+            if(request.cancelled):
+                request.finish(error="Cancelled")
+                self.metrics.record_done(request)
+            else:
+                keep.append(request)
+        return keep
+
+    # _admit
+    def _admit(self, active, waiting, cache, y):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Prefills the waiting requests as one batch and merges them after the running rows. The new
+        cache has room for every row to reach its num_frames.
+        ----------
+        """
+
+        max_primer = max(len(r.primer) for r in waiting)
+        max_remaining = max(r.num_frames - r.generated for r in active + waiting)
+
+        new_cache, new_y = self.model.prefill([r.primer for r in waiting], max_primer + max_remaining)
+        if(cache is None):
+            return new_cache, new_y
+
+        length = max(cache.length, new_cache.length)
+        cache = cache.merge(new_cache, length + max_remaining)
+        y = torch.cat([y, new_y], dim=0)
+
+        return cache, y
+
+    # _step
+    def _step(self, active, cache, y):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Samples a frame for every running request, hands it out, drops finished and cancelled
+        requests and runs the model on the new frames. Returns the new (active, cache, y).
+        ----------
+        """
+
+        frames = self.sampler(y)
+        frames_host = frames.cpu().numpy()
+        self.metrics.record_step(len(active))
+
+        keep = []
+        for i, request in enumerate(active):
+            if(request.cancelled):
+                request.finish(error="Cancelled")
+                self.metrics.record_done(request)
+            elif(request.add_frame(frames_host[i], self.stream_interval)):
+                request.finish()
+                self.metrics.record_done(request)
+            else:
+                keep.append(i)
+
+        if(len(keep) == 0):
+            return [], None, None
+
+        if(len(keep) < len(active)):
+            rows = torch.tensor(keep, dtype=TORCH_LABEL_TYPE, device=frames.device)
+            cache.select(rows)
+            frames = frames.index_select(0, rows)
+            active = [active[i] for i in keep]
+
+        y = self.model.forward_step(frames.unsqueeze(1), cache)[:, -1]
+
+        return active, cache, y
@@ -20,9 +20,48 @@ TOKEN_PAD               = TOKEN_END + 1
 
 # VOCAB_SIZE              = TOKEN_PAD + 1
 
+# LPD-5 piano-roll frames
+N_PITCHES               = 84
+N_TRACKS                = 5
+LOWEST_PITCH            = 24
+FRAMES_PER_BEAT         = 12
+FRAMES_PER_BAR          = 48
+
+# Bytes of a bit-packed frame (84 * 5 = 420 cells, see pack_frames)
+PACKED_FRAME_BYTES      = (N_PITCHES * N_TRACKS + 7) // 8
+
+# Padding cell index of sparse active-note frames (see frames_to_active)
+ACTIVE_PAD              = N_PITCHES * N_TRACKS
+
+# LPD-5 tracks are drums, piano, guitar, bass and strings
+TRACK_NAMES             = ["Drums", "Piano", "Guitar", "Bass", "Strings"]
+TRACK_PROGRAMS          = [0, 0, 24, 32, 48]
+TRACK_IS_DRUM           = [True, False, False, False, False]
+TRACK_CHANNELS          = [9, 0, 1, 2, 3]
+
+MIDI_TEMPO              = 100.0
+MIDI_VELOCITY           = 100
+MIDI_TICKS_PER_BEAT     = 480
+
 TORCH_FLOAT             = torch.float32
 TORCH_INT               = torch.int32
 
 TORCH_LABEL_TYPE        = torch.long
 
 PREPEND_ZEROS_WIDTH     = 4
+
+# Activation checkpointing modes of TransformerEncoderRPR (None is no checkpointing)
+CHECKPOINT_MODES        = ["layers", "attention"]
+
+# Block-sparse attention patterns (see AttentionPattern)
+ATTENTION_PATTERNS      = ["local", "dilated", "global"]
+
+# Encoder attention of MusicTransformer and feature maps of its linear attention
+ATTENTION_TYPES         = ["full", "linear"]
+FEATURE_MAPS            = ["elu", "favor"]
+
+# Training / inference precisions (see utilities.precision.autocast)
+PRECISIONS              = ["fp32", "bf16"]
+
+# Modes accepted by benchmark.py
+BENCHMARK_MODES         = ["kv_cache", "batch_generate", "sampler", "beam_search", "long_form", "stream", "quantize", "export", "speculative", "rpr_attention", "self_attention", "masks", "checkpoint", "sparse_attention", "linear_attention", "segment_memory", "chunked_ffn", "loss", "bf16", "mmap_dataset", "bitpack", "sparse_embedding"]
@@ -0,0 +1,275 @@
+import numpy as np
+import torch
+
+from .constants import *
+
+MIDI_NOTE_OFF       = 0x80
+MIDI_NOTE_ON        = 0x90
+MIDI_PROGRAM_CHANGE = 0xC0
+
+# MidiStreamWriter
+class MidiStreamWriter:
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Incremental piano-roll to midi conversion. Frames (n_frames, 84, 5) are fed in with write() as
+    they are generated. Only the previous frame is kept, so each call turns the new frames into
+    note on / note off messages in time proportional to the new frames, never the whole history.
+
+    write() returns the new messages as (tick, bytes) for live playback, and close() ends every
+    sounding note and returns the complete format 0 midi file. Each LPD-5 track gets its own
+    channel (drums on channel 10).
+    ----------
+    """
+
+    def __init__(self, tempo=MIDI_TEMPO, velocity=MIDI_VELOCITY):
+        self.tempo          = tempo
+        self.velocity       = velocity
+        self.ticks_per_frame = MIDI_TICKS_PER_BEAT // FRAMES_PER_BEAT
+
+        self.frame      = 0
+        self.sounding   = np.zeros((N_PITCHES, N_TRACKS), dtype=bool)
+        self.closed     = False
+
+        self._track     = bytearray()
+        self._last_tick = 0
+
+        usec_per_beat = int(round(60000000 / tempo))
+        self._append(0, b"\xff\x51\x03" + usec_per_beat.to_bytes(3, "big"))
+        for track in range(N_TRACKS):
+            if(not TRACK_IS_DRUM[track]):
+                self._append(0, bytes([MIDI_PROGRAM_CHANGE | TRACK_CHANNELS[track], TRACK_PROGRAMS[track]]))
+
+    # seconds_per_tick
+    @property
+    def seconds_per_tick(self):
+        return 60.0 / self.tempo / MIDI_TICKS_PER_BEAT
+
+    # write
+    def write(self, frames):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Adds frames (n_frames, 84, 5) (tensor or array, nonzero is a sounding note) after the frames
+        written so far. Returns the new midi messages as a list of (tick, bytes).
+        ----------
+        """
+
+        assert (not self.closed), "MidiStreamWriter is closed"
+
+        if(hasattr(frames, "cpu")):
+            frames = frames.detach().cpu().numpy()
+        frames = np.asarray(frames) > 0
+        if(len(frames) == 0):
+            return []
+
+        # A note starts or stops wherever a cell differs from the frame before it
+        rolls = np.concatenate([self.sounding[None], frames])
+        t, pitch, track = np.nonzero(rolls[1:] != rolls[:-1])
+        note_on = frames[t, pitch, track]
+
+        events = []
+        for i in range(len(t)):
+            tick = (self.frame + int(t[i])) * self.ticks_per_frame
+            events.append((tick, self._note_message(pitch[i], track[i], note_on[i])))
+
+        for tick, message in events:
+            self._append(tick, message)
+
+        self.sounding = frames[-1].copy()
+        self.frame += len(frames)
+
+        return events
+
+    # close
+    def close(self, file_path=None):
+        """
+        ----------
+        Author: Damon Gwinn
+        ----------
+        Ends all sounding notes and returns the complete midi file as bytes. Also writes it to
+        file_path (a path or a binary file object) if given.
+        ----------
+        """
+
+        if(not self.closed):
+            tick = self.frame * self.ticks_per_frame
+            for pitch, track in np.argwhere(self.sounding):
+                self._append(tick, self._note_message(pitch, track, False))
+
+            self._append(tick, b"\xff\x2f\x00")
+            self.closed = True
+
+        header = b"MThd" + (6).to_bytes(4, "big") + (0).to_bytes(2, "big") + (1).to_bytes(2, "big")
+        header += MIDI_TICKS_PER_BEAT.to_bytes(2, "big")
+        data = header + b"MTrk" + len(self._track).to_bytes(4, "big") + bytes(self._track)
+
+        if(file_path is not None):
+            if(hasattr(file_path, "write")):
+                file_path.write(data)
+            else:
+                with open(file_path, "wb") as f:
+                    f.write(data)
+
+        return data
+
+    # _note_message
+    def _note_message(self, pitch, track, note_on):
+        status = (MIDI_NOTE_ON if note_on else MIDI_NOTE_OFF) | TRACK_CHANNELS[int(track)]
+        velocity = self.velocity if note_on else 0
+        return bytes([status, int(pitch) + LOWEST_PITCH, velocity])
+
+    # _append
+    def _append(self, tick, message):
+        # Midi track events are a variable length delta time followed by the message
+        delta = tick - self._last_tick
+        self._last_tick = tick
+
+        varlen = [delta & 0x7F]
+        delta >>= 7
+        while(delta > 0):
+            varlen.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+
+        self._track += bytes(reversed(varlen)) + message
+
+# frames_to_midi
+def frames_to_midi(frames, file_path=None, tempo=MIDI_TEMPO):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Converts binary piano-roll frames (seq_len, 84, 5) into a midi file with one channel per LPD-5
+    track and returns it as bytes. Consecutive sounding frames of a pitch become a single note.
+    Writes the midi to file_path (a path or a binary file object) if given.
+    ----------
+    """
+
+    writer = MidiStreamWriter(tempo=tempo)
+    writer.write(frames)
+    return writer.close(file_path)
+
+# pack_frames
+def pack_frames(frames):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Bit-packs binary frames (..., 84, 5) (numpy) into uint8 (..., 53). Cells go in (pitch, track)
+    order, most significant bit first, the last 4 bits are 0. 32x smaller than TORCH_FLOAT frames.
+    ----------
+    """
+
+    frames = np.asarray(frames)
+    flat = frames.reshape(frames.shape[:-2] + (N_PITCHES * N_TRACKS,)) != 0
+    return np.packbits(flat, axis=-1)
+
+# unpack_frames
+def unpack_frames(packed, dtype=TORCH_FLOAT):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Unpacks bit-packed frames, a uint8 tensor (..., 53) from pack_frames, into frames (..., 84, 5)
+    of dtype. A single broadcast shift and mask over every byte, so it is cheap enough for a
+    collate function and runs on whatever device packed is on.
+    ----------
+    """
+
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=packed.device)
+    bits = (packed.unsqueeze(-1) >> shifts) & 1
+
+    bits = bits.reshape(packed.shape[:-1] + (PACKED_FRAME_BYTES * 8,))[..., :N_PITCHES * N_TRACKS]
+    return bits.reshape(packed.shape[:-1] + (N_PITCHES, N_TRACKS)).type(dtype)
+
+# is_packed
+def is_packed(frames):
+    # Bit-packed frames are uint8 ending in PACKED_FRAME_BYTES bytes instead of (84, 5)
+    return frames.dtype == torch.uint8 and frames.shape[-1] == PACKED_FRAME_BYTES
+
+# is_active
+def is_active(frames):
+    # Sparse active-note frames are integer cell indices, any other integer dtype than uint8
+    return (not frames.is_floating_point()) and frames.dtype not in (torch.uint8, torch.bool)
+
+# frames_to_active
+def frames_to_active(frames, max_active=None):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Sparse form of binary frames (..., 84, 5): the cell indices (pitch * 5 + track) of the active
+    notes of every frame in ascending order (..., max_active) int16, padded with ACTIVE_PAD.
+    max_active defaults to the most active notes of any frame (at least 1), frames with more
+    raise. Vectorized as a sort of every frame's cells, pads sorting last.
+    ----------
+    """
+
+    flat = frames.reshape(frames.shape[:-2] + (N_PITCHES * N_TRACKS,)) != 0
+
+    n_active = int(flat.sum(dim=-1).max()) if flat.numel() > 0 else 0
+    if(max_active is None):
+        max_active = max(n_active, 1)
+    assert n_active <= max_active, "A frame has " + str(n_active) + " active notes, more than max_active"
+
+    cells = torch.arange(N_PITCHES * N_TRACKS, dtype=torch.int16, device=frames.device)
+    keys = torch.where(flat, cells, torch.full_like(cells, ACTIVE_PAD))
+    active = keys.sort(dim=-1).values[..., :max_active]
+
+    if(active.shape[-1] < max_active):
+        pad = torch.full(active.shape[:-1] + (max_active - active.shape[-1],), ACTIVE_PAD, dtype=torch.int16, device=frames.device)
+        active = torch.cat([active, pad], dim=-1)
+
+    return active
+
+# active_to_frames
+def active_to_frames(active, dtype=TORCH_FLOAT):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Dense frames (..., 84, 5) of dtype from sparse active-note frames (see frames_to_active)
+    ----------
+    """
+
+    flat = torch.zeros(active.shape[:-1] + (N_PITCHES * N_TRACKS + 1,), dtype=dtype, device=active.device)
+    flat.scatter_(-1, active.long(), 1)
+
+    return flat[..., :N_PITCHES * N_TRACKS].reshape(active.shape[:-1] + (N_PITCHES, N_TRACKS))
+
+# to_frames
+def to_frames(frames, device):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Moves a batch of frames to device as TORCH_FLOAT (..., 84, 5). Bit-packed, sparse or uint8
+    frames are sent as is and unpacked or cast on device, so the transfer stays small.
+    ----------
+    """
+
+    frames = frames.to(device)
+    if(is_packed(frames)):
+        return unpack_frames(frames)
+    elif(is_active(frames)):
+        return active_to_frames(frames)
+
+    return frames.type(TORCH_FLOAT)
+
+# to_model_input
+def to_model_input(frames, device):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Same as to_frames, except that sparse active-note frames stay sparse (as TORCH_LABEL_TYPE),
+    for the sparse embedding path of MusicTransformer
+    ----------
+    """
+
+    if(is_active(frames)):
+        return frames.to(device).type(TORCH_LABEL_TYPE)
+
+    return to_frames(frames, device)
@@ -0,0 +1,102 @@
+# For all things related to numerical precision
+
+import contextlib
+import torch
+import torch.nn as nn
+
+from .constants import *
+
+# autocast
+def autocast(precision, device):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Context manager running the enclosed forward passes in the given precision (see PRECISIONS)
+    on device. "bf16" is torch.autocast to bfloat16: matmuls and linear layers run in bf16 and
+    the ops autocast keeps in fp32 stay there. The model takes care of its own softmax and
+    linear attention sums, see keep_norms_fp32 for layer norm. "fp32" does nothing.
+    ----------
+    """
+
+    assert precision in PRECISIONS, "Unknown precision " + str(precision)
+
+    if(precision == "bf16"):
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
+    return contextlib.nullcontext()
+
+# keep_norms_fp32
+def keep_norms_fp32(model):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Makes every LayerNorm of model normalize in TORCH_FLOAT: its input is upcast by a forward
+    pre-hook, so its output (and through the residual adds, the residual stream) is fp32 under
+    bf16 autocast. A no-op for fp32 inputs. Safe to call more than once.
+    ----------
+    """
+
+    for module in model.modules():
+        if(isinstance(module, nn.LayerNorm) and not getattr(module, "fp32_hooked", False)):
+            module.register_forward_pre_hook(_upcast_input)
+            module.fp32_hooked = True
+
+    return model
+
+def _upcast_input(module, inputs):
+    return tuple(x.type(TORCH_FLOAT) if torch.is_tensor(x) and x.is_floating_point() else x for x in inputs)
+
+# MasterWeights
+class MasterWeights:
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    fp32 master weights for bf16 training. The model's weights (all but its LayerNorms) are
+    stored in bfloat16, halving their memory and the casts autocast makes every step, while the
+    optimizer works on the fp32 copies in params() so small updates are not rounded away.
+
+    After backward, copy_grads() moves the bf16 gradients onto the master weights, then after
+    opt.step(), copy_weights() rounds the updated master weights back into the model. Save
+    state_dict() rather than the model's to keep the full precision weights.
+    ----------
+    """
+
+    def __init__(self, model):
+        self.model          = model
+        self.named_params   = [(name, p) for name, p in model.named_parameters() if p.requires_grad]
+        self.master_params  = [p.detach().clone().type(TORCH_FLOAT).requires_grad_() for _, p in self.named_params]
+
+        for module in model.modules():
+            if(isinstance(module, nn.LayerNorm)):
+                continue
+            for p in module.parameters(recurse=False):
+                p.data = p.data.type(torch.bfloat16)
+
+    # params
+    def params(self):
+        return self.master_params
+
+    # copy_grads
+    def copy_grads(self):
+        # Gradients of the model onto the master weights, the model's are cleared
+        for (_, p), master in zip(self.named_params, self.master_params):
+            master.grad = None if p.grad is None else p.grad.type(TORCH_FLOAT)
+            p.grad = None
+
+    # copy_weights
+    def copy_weights(self):
+        # Updated master weights back into the model (rounded to its dtype)
+        with torch.no_grad():
+            for (_, p), master in zip(self.named_params, self.master_params):
+                p.copy_(master)
+
+    # state_dict
+    def state_dict(self):
+        # Model state dict with the fp32 master weights in place of its parameters
+        state = self.model.state_dict()
+        for (name, _), master in zip(self.named_params, self.master_params):
+            state[name] = master.detach().clone()
+        return state
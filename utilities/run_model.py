@@ -3,40 +3,123 @@ import time
 
 from .constants import *
 from utilities.device import get_device
+from utilities.precision import autocast
+from utilities.piano_roll import to_frames, to_model_input
 from .lr_scheduling import get_lr
 
 from dataset.e_piano import compute_epiano_accuracy
+from model.loss import chunked_head_loss, SmoothBCEWithLogitsLoss
 
 
 # train_epoch
-def train_epoch(cur_epoch, model, dataloader, loss, opt, lr_scheduler=None, print_modulus=1):
+def train_epoch(cur_epoch, model, dataloader, loss, opt, lr_scheduler=None, print_modulus=1, head_chunk_size=None,
+                precision="fp32", master_weights=None):
     """
     ----------
     Author: Damon Gwinn
     ----------
-    Trains a single model epoch
+    Trains a single model epoch. With head_chunk_size, the output head and loss run fused in
+    chunks (see chunked_head_loss). loss is then used if it is a SmoothBCEWithLogitsLoss, any
+    other loss falls back to plain binary cross entropy.
+
+    The forward runs in precision (see autocast), the loss is always taken on fp32 logits. With
+    master_weights (a MasterWeights), opt steps the fp32 master weights, which are copied back
+    into the model after each step.
+    ----------
+    """
+
+    out = -1
+    model.train()
+    for batch_num, batch in enumerate(dataloader):
+        time_before = time.time()
+
+        opt.zero_grad()
+
+        # Frames may come as uint8, bit-packed or sparse (LpdMmapDataset), converted after the transfer
+        x   = to_model_input(batch[0], get_device())
+        tgt = to_frames(batch[1], get_device())
+
+        if(head_chunk_size is None):
+            with autocast(precision, x.device):
+                y = model(x)
+
+            y   = y.type(TORCH_FLOAT).flatten()
+            tgt = tgt.flatten()
+
+            out = loss.forward(y, tgt)
+        else:
+            with autocast(precision, x.device):
+                if(isinstance(loss, SmoothBCEWithLogitsLoss)):
+                    out = chunked_head_loss(model.forward_hidden(x), model.Wout, tgt, head_chunk_size,
+                                            loss_func=loss, ignore_index=loss.ignore_index)
+                else:
+                    out = chunked_head_loss(model.forward_hidden(x), model.Wout, tgt, head_chunk_size)
+
+        out.backward()
+        if(master_weights is not None):
+            master_weights.copy_grads()
+        opt.step()
+        if(master_weights is not None):
+            master_weights.copy_weights()
+
+        if(lr_scheduler is not None):
+            lr_scheduler.step()
+
+        time_after = time.time()
+        time_took = time_after - time_before
+
+        if((batch_num+1) % print_modulus == 0):
+            print(SEPERATOR)
+            print("Epoch", cur_epoch, " Batch", batch_num+1, "/", len(dataloader))
+            print("LR:", get_lr(opt))
+            print("Train loss:", float(out))
+            print("")
+            print("Time (s):", time_took)
+            print(SEPERATOR)
+            print("")
+
+    return
+
+# train_epoch_segments
+def train_epoch_segments(cur_epoch, model, dataloader, loss, opt, lr_scheduler=None, print_modulus=1, mem_len=None,
+                         precision="fp32", master_weights=None):
+    """
+    ----------
+    Author: Damon Gwinn
+    ----------
+    Trains a single model epoch with segment recurrence. dataloader gives consecutive segments of
+    each piece in the same batch slot (see SegmentSampler). Memory of the previous segments is
+    carried from batch to batch (gradients stopped) and reset where a new piece starts.
+    precision and master_weights are as in train_epoch.
     ----------
     """
 
     out = -1
     model.train()
+    memory = None
     for batch_num, batch in enumerate(dataloader):
         time_before = time.time()
 
         opt.zero_grad()
 
-        x   = batch[0].to(get_device())
-        tgt = batch[1].to(get_device())
+        x       = to_model_input(batch[0], get_device())
+        tgt     = to_frames(batch[1], get_device())
+        reset   = batch[2].to(get_device())
 
-        y = model(x)
+        with autocast(precision, x.device):
+            y, memory = model.forward_segment(x, memory, reset, mem_len)
 
-        y   = y.flatten()
+        y   = y.type(TORCH_FLOAT).flatten()
         tgt = tgt.flatten()
 
         out = loss.forward(y, tgt)
 
         out.backward()
+        if(master_weights is not None):
+            master_weights.copy_grads()
         opt.step()
+        if(master_weights is not None):
+            master_weights.copy_weights()
 
         if(lr_scheduler is not None):
             lr_scheduler.step()
@@ -57,12 +140,13 @@ def train_epoch(cur_epoch, model, dataloader, loss, opt, lr_scheduler=None, prin
     return
 
 # eval_model
-def eval_model(model, dataloader, loss):
+def eval_model(model, dataloader, loss, precision="fp32"):
     """
     ----------
     Author: Damon Gwinn
     ----------
-    Evaluates the model and prints the average loss and accuracy
+    Evaluates the model and prints the average loss and accuracy. The forward runs in precision
+    (see autocast), loss and accuracy are taken on fp32 logits.
     ----------
     """
 
@@ -75,10 +159,12 @@ def eval_model(model, dataloader, loss):
         sum_loss   = 0.0
         sum_acc    = 0.0
         for batch in dataloader:
-            x   = batch[0].to(get_device())
-            tgt = batch[1].to(get_device())
+            x   = to_model_input(batch[0], get_device())
+            tgt = to_frames(batch[1], get_device())
 
-            y = model(x)
+            with autocast(precision, x.device):
+                y = model(x)
+            y = y.type(TORCH_FLOAT)
 
             sum_acc += float(compute_epiano_accuracy(y, tgt))
 